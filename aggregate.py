@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Hero stats across a whole harvest
+
+Splits the harvested matches into shards (blocks of a match store, files of a saved_matches directory, or API payload files),
+and reduces each shard in its own worker process to participant counts, wins and stat sums by hero, game mode and patch.
+The partial results are then merged into the win rate and the average kills, deaths, assists, KDA, gold and farm of each group.
+
+The harvest also keeps meta tables (by hero, patch, game mode and skill tier) up to date as each match is saved,
+in meta_aggregates.json next to the saved matches, so they can be read without scanning the harvest (see MetaAggregates).
+
+./aggregate.py match_store
+./aggregate.py match_store --group-by hero -o heroes.csv
+./aggregate.py saved_matches --meta hero
+./aggregate.py saved_matches --check
+./vainstats.py --aggregate match_store
+'''
+from __future__ import print_function
+from __future__ import division
+import os
+import csv
+import time
+import json
+import argparse
+import functools
+import multiprocessing
+from collections import OrderedDict
+
+import records
+from payload import PayloadIndex, relationship_ids
+
+# (group name, record, record field)
+dimensions = [
+('hero', 'participant', 'actor'),
+('gameMode', 'match', 'gameMode'),
+('patchVersion', 'match', 'patchVersion'),
+('skillTier', 'participant', 'skillTier'),
+]
+
+# dimensions of the aggregate command's table
+default_group_by = ['hero', 'gameMode', 'patchVersion']
+
+# the meta tables kept up to date by the harvest: table name -> dimensions
+meta_tables = OrderedDict([
+('hero', ['hero']),
+('patchVersion', ['patchVersion']),
+('gameMode', ['gameMode']),
+('skillTier', ['skillTier']),
+('hero_gameMode_patchVersion', default_group_by),
+])
+
+# participant stats that are summed for the averages
+stat_fields = ['kills', 'deaths', 'assists', 'gold', 'farm']
+
+
+def make_row(group_by, group, sums):
+    '''
+    Return the row for one group: the group values, the participant count, wins and win rate, and the average stats
+    '''
+    participants, wins = sums[:2]
+    averages = dict((field, total / participants) for field, total in zip(stat_fields, sums[2:]))
+    row = OrderedDict(zip(group_by, group))
+    row['participants'] = participants
+    row['wins'] = wins
+    row['win_rate'] = wins / participants
+    for field in ['kills', 'deaths', 'assists']:
+        row[field] = averages[field]
+    row['kda'] = (averages['kills'] + averages['assists']) / max(averages['deaths'], 1)
+    row['gold'] = averages['gold']
+    row['farm'] = averages['farm']
+    return(row)
+
+
+class HeroAggregates(object):
+    '''
+    Participant counts, wins and stat sums for each group of the given dimensions, e.g. (hero, game mode, patch)
+    Aggregates of different matches add up with merge(), so shards can be reduced separately
+
+    >>> aggregates = HeroAggregates(group_by = ['hero'])
+    >>> aggregates.add_match(match_record)
+    >>> aggregates.merge(other_aggregates)
+    >>> aggregates.rows()
+    >>> aggregates.row('*Ardan*')
+    '''
+    def __init__(self, group_by = default_group_by):
+        self.group_by = list(group_by)
+        fields = dict((name, (record, field)) for name, record, field in dimensions)
+        self.fields = [fields[name] for name in self.group_by]
+        self.groups = {} # group key -> [participants, wins] + a sum for each stat field
+        self.num_matches = 0
+
+    def __len__(self):
+        return(self.num_matches)
+
+    def add_match(self, match):
+        '''
+        Add the participants of a Match record
+        '''
+        for participant in match.participants():
+            sources = {'match': match, 'participant': participant}
+            key = tuple(getattr(sources[record], field) for record, field in self.fields)
+            sums = self.groups.get(key)
+            if sums == None:
+                sums = [0] * (2 + len(stat_fields))
+                self.groups[key] = sums
+            sums[0] += 1
+            if participant.winner == True:
+                sums[1] += 1
+            for i, field in enumerate(stat_fields):
+                value = getattr(participant, field)
+                if value != None:
+                    sums[2 + i] += value
+        self.num_matches += 1
+
+    def add_payload(self, payload):
+        for match in records.iter_match_records(payload):
+            self.add_match(match)
+
+    def merge(self, other):
+        '''
+        Add the counts and sums of another HeroAggregates with the same dimensions to this one
+        '''
+        for key, other_sums in other.groups.items():
+            sums = self.groups.get(key)
+            if sums == None:
+                self.groups[key] = list(other_sums)
+            else:
+                for i, value in enumerate(other_sums):
+                    sums[i] += value
+        self.num_matches += other.num_matches
+        return(self)
+
+    def row(self, *group):
+        '''
+        Return the row for one group, e.g. row('*Ardan*') for a table by hero, or None
+        '''
+        sums = self.groups.get(tuple(group))
+        if sums == None:
+            return(None)
+        return(make_row(self.group_by, group, sums))
+
+    def rows(self, group_by = None):
+        '''
+        Return a row for each group, sorted by group, with the win rate and average stats
+        group_by is a list of this table's dimensions to keep; the others are added up
+        '''
+        if group_by == None:
+            group_by = self.group_by
+        positions = [self.group_by.index(name) for name in group_by]
+        totals = {}
+        for key, sums in self.groups.items():
+            group = tuple(key[i] for i in positions)
+            if group not in totals:
+                totals[group] = [0] * len(sums)
+            group_sums = totals[group]
+            for i, value in enumerate(sums):
+                group_sums[i] += value
+        return([make_row(group_by, group, totals[group]) for group in sorted(totals, key = lambda group: tuple((value == None, value if value != None else 0) for value in group))])
+
+    def to_dict(self):
+        return({'group_by': self.group_by, 'num_matches': self.num_matches, 'groups': [list(key) + sums for key, sums in self.groups.items()]})
+
+    @classmethod
+    def from_dict(cls, data):
+        aggregates = cls(group_by = data['group_by'])
+        num_keys = len(aggregates.group_by)
+        aggregates.groups = dict((tuple(values[:num_keys]), values[num_keys:]) for values in data['groups'])
+        aggregates.num_matches = data['num_matches']
+        return(aggregates)
+
+    def differences(self, other, tolerance = 1e-9):
+        '''
+        Return the groups whose counts or sums differ from another HeroAggregates, as (group, these sums, other sums)
+        The float sums are compared with a relative tolerance, since they depend on the order the matches were added in
+        '''
+        differences = []
+        for key in set(self.groups) | set(other.groups):
+            sums = self.groups.get(key)
+            other_sums = other.groups.get(key)
+            if sums == None or other_sums == None or any(abs(a - b) > tolerance * max(1, abs(a), abs(b)) for a, b in zip(sums, other_sums)):
+                differences.append((key, sums, other_sums))
+        return(differences)
+
+
+class MetaAggregates(object):
+    '''
+    The meta tables (see meta_tables), kept up to date as a harvest saves matches, and saved to a JSON file
+    so that they are read in constant time instead of being recomputed from every match
+
+    >>> aggregates = MetaAggregates('saved_matches/meta_aggregates.json')
+    >>> aggregates.add_item(item, new = True)    # for each match and included item saved
+    >>> aggregates.save()                        # adds the matches that have all of their items, and saves the tables
+    >>> aggregates.query('hero', '*Ardan*')
+    '''
+    def __init__(self, path = None):
+        self.path = path
+        self.tables = OrderedDict((name, HeroAggregates(group_by = group_by)) for name, group_by in meta_tables.items())
+        self.pending_matches = [] # new match items that are waiting for their rosters, participants or players
+        self.pending_items = {} # (type, id) -> included item
+        self.updated_at = None
+        if path != None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return(self.tables['hero'].num_matches)
+
+    def add_match(self, match):
+        for table in self.tables.values():
+            table.add_match(match)
+
+    def add_payload(self, payload, skip = ()):
+        '''
+        Add every match in a payload, except the match IDs in skip (e.g. a MatchStore, for the matches it already has)
+        '''
+        for match in records.iter_match_records(payload):
+            if match.id not in skip:
+                self.add_match(match)
+
+    def add_item(self, item, new = True):
+        '''
+        Collect a match or included item as it is saved; a match is added by flush() once all of its items are in
+        Matches that are not new (they were saved before) are not added again
+        '''
+        if item['type'] == 'match':
+            if new == True:
+                self.pending_matches.append(item)
+        else:
+            self.pending_items[(item['type'], item['id'])] = item
+
+    def flush(self):
+        '''
+        Add the pending matches that have all of their rosters, participants and players
+        Returns the number of matches added
+        '''
+        if len(self.pending_matches) < 1:
+            self.pending_items = {}
+            return(0)
+        index = PayloadIndex({'data': self.pending_matches, 'included': list(self.pending_items.values())})
+        waiting = []
+        for match in self.pending_matches:
+            if match_complete(index, match['id']):
+                self.add_match(records.match_record(index, match['id']))
+            else:
+                waiting.append(match)
+        num_added = len(self.pending_matches) - len(waiting)
+        self.pending_matches = waiting
+        self.pending_items = dict(((item['type'], item['id']), item) for match in waiting for item in index.included(match['id']))
+        return(num_added)
+
+    def merge(self, other):
+        for name, table in self.tables.items():
+            table.merge(other.tables[name])
+        return(self)
+
+    def query(self, table, *group):
+        '''
+        Return the row for one group of a table, e.g. query('hero', '*Ardan*'), or None
+        '''
+        return(self.tables[table].row(*group))
+
+    def rows(self, table):
+        return(self.tables[table].rows())
+
+    def to_dict(self):
+        return({'updated_at': self.updated_at, 'tables': OrderedDict((name, table.to_dict()) for name, table in self.tables.items())})
+
+    def save(self, path = None):
+        '''
+        Add the matches that are complete, and write the tables to the JSON file
+        '''
+        self.flush()
+        if path != None:
+            self.path = path
+        self.updated_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        self.updated_at = data.get('updated_at')
+        for name, table in data['tables'].items():
+            if name in self.tables:
+                self.tables[name] = HeroAggregates.from_dict(table)
+
+    def differences(self, other):
+        '''
+        Return (table name, group, these sums, other sums) for every group that differs from another MetaAggregates
+        '''
+        return([(name, group, sums, other_sums) for name, table in self.tables.items() for group, sums, other_sums in table.differences(other.tables[name])])
+
+def match_complete(index, match_id):
+    '''
+    Return True if every roster, participant and player that a match refers to is in a PayloadIndex
+    '''
+    match = index.match(match_id)
+    roster_keys = relationship_ids(match, 'rosters')
+    if len(index.resolve(roster_keys)) < len(roster_keys):
+        return(False)
+    for roster in index.rosters(match_id):
+        participant_keys = relationship_ids(roster, 'participants')
+        participants = index.resolve(participant_keys)
+        if len(participants) < len(participant_keys):
+            return(False)
+        for participant in participants:
+            player_keys = relationship_ids(participant, 'player')
+            if len(index.resolve(player_keys)) < len(player_keys):
+                return(False)
+    return(True)
+
+
+# ~~~~~ SHARDS ~~~~~ #
+def iter_shards(input_paths, shard_size = 256):
+    '''
+    Yield (kind, path, items) shards of the input paths, of about shard_size matches each:
+    a list of store blocks, a list of saved_matches match files, or a whole payload file
+    A payload file can only be read from the start, so a large harvest should be split into several files (see synthetic.py --per-file) or stored
+    '''
+    for input_path in input_paths:
+        if os.path.isdir(input_path) and os.path.exists(os.path.join(input_path, 'index.tsv')):
+            from store import MatchStore
+            store = MatchStore(input_path)
+            blocks = store.blocks()
+            num_blocks = max(1, shard_size // store.block_records)
+            for i in range(0, len(blocks), num_blocks):
+                yield(('store', input_path, blocks[i:i + num_blocks]))
+        elif os.path.isdir(input_path):
+            match_files = sorted(name for name in os.listdir(input_path) if name.endswith('_data.json'))
+            for i in range(0, len(match_files), shard_size):
+                yield(('saved_matches', input_path, match_files[i:i + shard_size]))
+        else:
+            yield(('file', input_path, None))
+
+# match stores opened by this worker process, by path
+open_stores = {}
+
+def iter_shard_payloads(shard):
+    '''
+    Yield the match payloads of a shard
+    '''
+    kind, path, items = shard
+    if kind == 'store':
+        from store import MatchStore
+        if path not in open_stores:
+            open_stores[path] = MatchStore(path)
+        for payload in open_stores[path].iter_block_matches(items):
+            yield(payload)
+    elif kind == 'saved_matches':
+        from store import load_saved_match
+        for match_file in items:
+            yield(load_saved_match(path, match_file))
+    else:
+        import jsonstream
+        for payload in jsonstream.iter_match_payloads(path, in_order = True):
+            yield(payload)
+
+def reduce_shard(make_aggregates, shard):
+    '''
+    Parse and reduce the matches of one shard; run in the worker processes
+    '''
+    aggregates = make_aggregates()
+    for payload in iter_shard_payloads(shard):
+        aggregates.add_payload(payload)
+    return(aggregates)
+
+def aggregate_corpus(input_paths, processes = None, shard_size = 256, make_aggregates = HeroAggregates):
+    '''
+    Reduce every match in the inputs with a pool of worker processes, and merge the results
+    make_aggregates makes an empty HeroAggregates or MetaAggregates for each shard; it has to be picklable, e.g. a class or functools.partial
+    processes defaults to the number of CPUs; with 1, the shards are reduced in this process
+    '''
+    if processes == None:
+        processes = multiprocessing.cpu_count()
+    shards = list(iter_shards(input_paths, shard_size = shard_size))
+    reduce_function = functools.partial(reduce_shard, make_aggregates)
+    aggregates = make_aggregates()
+    if processes <= 1:
+        for shard in shards:
+            aggregates.merge(reduce_function(shard))
+        return(aggregates)
+    pool = multiprocessing.Pool(processes = processes)
+    try:
+        # imap keeps the shard order, so the float sums come out the same on every run
+        for shard_aggregates in pool.imap(reduce_function, shards):
+            aggregates.merge(shard_aggregates)
+    finally:
+        pool.close()
+        pool.join()
+    return(aggregates)
+
+
+# ~~~~~ OUTPUT ~~~~~ #
+def print_rows(rows, group_by):
+    '''
+    Print the aggregate rows as a table
+    '''
+    if len(rows) < 1:
+        print('No matches found')
+        return
+    row_format = ''.join(['{:<20}'] * len(group_by)) + '{:>14}{:>10}{:>8}{:>8}{:>8}{:>8}{:>10}{:>8}'
+    print(row_format.format(*(group_by + ['Participants', 'Win rate', 'Kills', 'Deaths', 'Assists', 'KDA', 'Gold', 'Farm'])))
+    for row in rows:
+        values = [str(row[name]) for name in group_by]
+        values += [row['participants'], '{0:.1%}'.format(row['win_rate']), '{0:.2f}'.format(row['kills']), '{0:.2f}'.format(row['deaths']),
+        '{0:.2f}'.format(row['assists']), '{0:.2f}'.format(row['kda']), '{0:.0f}'.format(row['gold']), '{0:.1f}'.format(row['farm'])]
+        print(row_format.format(*values))
+
+def write_rows(rows, output_file):
+    if len(rows) < 1:
+        return
+    with open(output_file, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames = list(rows[0].keys()))
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+def run_aggregation(input_paths, processes = None, group_by = None, output_file = None):
+    '''
+    Aggregate the inputs, print the table, and save it to a CSV file if one is given
+    '''
+    start_time = time.time()
+    if group_by == None:
+        group_by = default_group_by
+    aggregates = aggregate_corpus(input_paths, processes = processes, make_aggregates = functools.partial(HeroAggregates, group_by = group_by))
+    rows = aggregates.rows()
+    print_rows(rows, group_by = group_by)
+    print('Aggregated {0} matches in {1:.2f}s'.format(len(aggregates), time.time() - start_time))
+    if output_file != None:
+        write_rows(rows, output_file)
+        print('Saved {0} rows to {1}'.format(len(rows), output_file))
+    return(aggregates)
+
+def meta_path(harvest_dir):
+    '''
+    Return the meta tables file of a saved_matches or match store directory
+    '''
+    return(os.path.join(harvest_dir, 'meta_aggregates.json'))
+
+def print_meta(harvest_dir, table):
+    '''
+    Print one of the saved meta tables of a harvest directory, without reading any matches
+    '''
+    aggregates = MetaAggregates(meta_path(harvest_dir))
+    print_rows(aggregates.rows(table), group_by = meta_tables[table])
+    print('{0} matches, updated at {1}'.format(len(aggregates), aggregates.updated_at))
+
+def check_meta(harvest_dir, processes = None):
+    '''
+    Rebuild the meta tables of a harvest directory from every saved match, report how they differ from the saved tables,
+    and save the rebuilt tables in their place
+    Returns the differences
+    '''
+    start_time = time.time()
+    saved = MetaAggregates(meta_path(harvest_dir))
+    rebuilt = aggregate_corpus([harvest_dir], processes = processes, make_aggregates = MetaAggregates)
+    differences = saved.differences(rebuilt)
+    for name, group, saved_sums, rebuilt_sums in differences:
+        print('{0} {1}: saved {2}, rebuilt {3}'.format(name, list(group), saved_sums, rebuilt_sums))
+    print('Rebuilt the meta tables from {0} matches in {1:.2f}s ({2} saved): {3} groups differ'.format(len(rebuilt), time.time() - start_time, len(saved), len(differences)))
+    rebuilt.save(meta_path(harvest_dir))
+    return(differences)
+
+def run():
+    '''
+    Arg parsing for the script when run from command line
+    '''
+    parser = argparse.ArgumentParser(description='Hero win rates and average stats across harvested matches')
+    parser.add_argument("input_paths", nargs = '+', help="Match store directories, saved_matches directories, or API payload JSON files")
+    parser.add_argument("-j", "--processes", default = None, type = int, dest = 'processes', metavar = 'processes', help="Number of worker processes; defaults to the number of CPUs")
+    parser.add_argument("--group-by", default = None, nargs = '+', choices = [name for name, record, field in dimensions], dest = 'group_by', help="Dimensions to group by; defaults to hero, game mode and patch")
+    parser.add_argument("-o", default = None, type = str, dest = 'output_file', metavar = 'output_file', help="CSV file to save the table to")
+    parser.add_argument("--meta", default = None, choices = list(meta_tables.keys()), dest = 'meta_table', help="Print a meta table saved by the harvest, instead of reading the matches")
+    parser.add_argument("--check", default = False, action = 'store_true', dest = 'check', help="Rebuild the saved meta tables from scratch, and report any differences")
+    args = parser.parse_args()
+    if args.meta_table != None or args.check == True:
+        for input_path in args.input_paths:
+            if not os.path.isdir(input_path):
+                print('Meta tables are kept for saved_matches and match store directories, not {0}'.format(input_path))
+            elif args.check == True:
+                check_meta(input_path, processes = args.processes)
+            else:
+                print_meta(input_path, args.meta_table)
+        return
+    run_aggregation(args.input_paths, processes = args.processes, group_by = args.group_by, output_file = args.output_file)
+
+if __name__ == "__main__":
+    run()
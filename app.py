@@ -7,6 +7,8 @@ Dash app for the vainstats API querying and player ranking
 # ~~~~~ LOGGING SETUP ~~~~~ #
 # set up the first logger for the app
 import os
+import time
+app_start_time = time.time()
 import log as vlog
 # path to the current script's dir
 scriptdir = os.path.dirname(os.path.realpath(__file__))
@@ -27,6 +29,8 @@ logger.debug("App is starting...")
 # ~~~~~ LIBRARIES ~~~~~ #
 # system modules
 import sys
+import json
+import logging
 import gamelocker
 import argparse
 
@@ -46,6 +50,7 @@ import offline_data as vod # initializes the data for the app
 import offline_layout as vol
 
 import layout as vl
+import metrics as vm
 
 
 # ~~~~ GET SCRIPT ARGS ~~~~~~ #
@@ -53,15 +58,56 @@ parser = argparse.ArgumentParser(description='Vainglory Player Stats App')
 # optional flags
 parser.add_argument("--include-offline", default = False, action='store_true', dest = 'include_offline', help="Include the offline portion of the app")
 parser.add_argument("--exclude-online", default = False, action='store_true', dest = 'exclude_online', help="Exclude the online portion of the app.")
+parser.add_argument("--log-level", default = 'INFO', choices = ['DEBUG', 'INFO', 'WARNING', 'ERROR'], dest = 'log_level', help="Level of the app log messages; the DataFrame dumps are only made at DEBUG")
+parser.add_argument("--meta-file", default = 'saved_matches/meta_aggregates.json', dest = 'meta_file', metavar = 'meta_file', help="Hero and meta tables saved by a harvest; the demo data is used if the file does not exist")
+parser.add_argument("--refresh-interval", default = 300, type = int, dest = 'refresh_interval', metavar = 'seconds', help="How often to query the API for new matches in the background")
+parser.add_argument("--cache-file", default = 'http_cache.db', dest = 'cache_file', metavar = 'cache_file', help="On-disk cache of API responses; matches are kept, match queries are asked again after --cache-ttl seconds")
+parser.add_argument("--cache-ttl", default = 60, type = float, dest = 'cache_ttl', metavar = 'seconds', help="How long cached API match queries are used")
+parser.add_argument("--no-cache", default = False, action='store_true', dest = 'no_cache', help="Do not use the response cache")
 args = parser.parse_args()
 include_offline = args.include_offline
 exclude_online = args.exclude_online
+refresh_interval = args.refresh_interval
+cache_file = args.cache_file if args.no_cache == False else None
+vod.meta_aggregates = vod.load_meta_aggregates(args.meta_file)
+for logger_name in ['app', 'tools', 'data']:
+    logging.getLogger(logger_name).setLevel(args.log_level)
 
 
 # ~~~~ APP SETUP ~~~~~~ #
 app = dash.Dash()
 
 
+# ~~~~ APP METRICS ~~~~~~ #
+# time every callback, and every function in the data and tools modules
+vm.registry.instrument_callbacks(app)
+# after the timing, so a callback that leaves its output as it is still records its call time
+vt.allow_prevent_update(app)
+for module in [vt, vd, vod]:
+    vm.registry.instrument_module(module)
+
+if exclude_online == False:
+    @app.server.before_request
+    def start_background_load():
+        '''
+        Start the API refresher on the first request, so it also runs when a WSGI server imports the app instead of __main__
+        '''
+        vd.start_background_load(interval = refresh_interval, cache_file = cache_file, cache_ttl = args.cache_ttl)
+
+@app.server.route('/metrics')
+def metrics():
+    '''
+    Callback and function latency histograms, in the Prometheus text format; add ?format=json for JSON
+    Only served to local requests
+    '''
+    import flask
+    if flask.request.remote_addr not in ['127.0.0.1', '::1']:
+        flask.abort(403)
+    if flask.request.args.get('format') == 'json':
+        return(flask.Response(json.dumps(vm.registry.to_dict(), indent = 4), mimetype = 'application/json'))
+    return(flask.Response(vm.registry.prometheus_text(), mimetype = 'text/plain; version=0.0.4'))
+
+
 # ~~~~ APP UI ~~~~~~ #
 # layout sections
 offline_div = vol.offline_div
@@ -74,10 +120,12 @@ api_div = html.Div(children = [
         html.H2(children = 'API Queried Matches:'),
 
         html.Div(children = [
-        # dropdown menu for the API matches
-        vt.match_dropdown(matches = vd.api_matches, id = 'api-match-selection')
+        # dropdown menu for the API matches; filled in once the background API load finishes
+        dcc.Dropdown(id = 'api-match-selection', options = [], placeholder = 'Loading matches from the API...')
         ],
         id = 'api-match-selection-div'),
+        html.Div(id = 'api-match-load-status'),
+        dcc.Interval(id = 'api-match-load-interval', interval = 1000),
 
 
         html.Button('Get New Matches', id='api-match-update-matches-button'),
@@ -180,6 +228,42 @@ if include_offline == True:
         else:
             return('No match selected')
 
+    @app.callback(
+        Output(component_id = 'demo-participant-table', component_property = 'children'),
+        [Input(component_id = 'demo-participant-table-sort-by', component_property = 'value'),
+        Input(component_id = 'demo-participant-table-sort-order', component_property = 'value'),
+        Input(component_id = 'demo-participant-table-page', component_property = 'value')]
+    )
+    def update_demo_participant_table(sort_by, sort_order, page):
+        '''
+        Show one page of the participant stats table; the paging and sorting is done on the server
+        '''
+        page_size = 20
+        num_pages = vt.count_pages(len(vod.demo_participant_df), page_size)
+        page = min(max(int(page or 1), 1), num_pages)
+        logger.debug("Showing participant table page {0} of {1}, sorted by {2}".format(page, num_pages, sort_by))
+        return([
+        html.Div(children = 'Page {0} of {1} ({2} players)'.format(page, num_pages, len(vod.demo_participant_df))),
+        vt.html_df_table(df = vod.demo_participant_df, max_rows = page_size, page = page - 1, sort_by = sort_by, ascending = sort_order == 'ascending')
+        ])
+
+    @app.callback(
+        Output(component_id = 'demo-meta-table', component_property = 'children'),
+        [Input(component_id = 'demo-meta-table-type', component_property = 'value')]
+    )
+    def update_demo_meta_table(table):
+        '''
+        Show one of the meta tables, as saved by the harvest
+        '''
+        if table == None:
+            return('No table selected')
+        meta_df = vod.make_meta_df(table)
+        return([
+        html.Div(children = '{0} matches, updated at {1}'.format(len(vod.meta_aggregates), vod.meta_aggregates.updated_at)),
+        vt.html_df_table(df = meta_df, max_rows = len(meta_df))
+        ])
+
+
 
 
 
@@ -187,15 +271,74 @@ if include_offline == True:
 
 # api data
 if exclude_online == False:
+    @app.callback(
+        Output(component_id = 'api-match-load-status', component_property = 'children'),
+        events = [Event('api-match-load-interval', 'interval')])
+    def update_api_load_status():
+        '''
+        Show the status of the background API refresh, with how long it took and how old the matches are
+        '''
+        status = vd.refresher.status()
+        if status['loaded'] == False:
+            return('Loading matches from the API...')
+        messages = []
+        if status['staleness'] != None:
+            messages.append('{0} matches from the API, refreshed in {1:.1f}s, {2:.0f}s ago'.format(status['num_matches'], status['refresh_seconds'], status['staleness']))
+        if status['error'] != None:
+            messages.append('Could not refresh matches from the API: {0}'.format(status['error']))
+        return('; '.join(messages))
+
+    @app.callback(
+        Output(component_id = 'api-match-selection', component_property = 'options'),
+        events = [Event('api-match-load-interval', 'interval')],
+        state = [State(component_id = 'api-match-selection', component_property = 'options')])
+    def update_api_match_options(options):
+        '''
+        Fill in the match dropdown from the latest API snapshot; leave it as it is until the snapshot changes
+        '''
+        new_options = [{'label': '{0}: {1}'.format(i + 1, match), 'value': match} for i, match in enumerate(vd.snapshot.api_matches)]
+        if new_options == options:
+            raise vt.PreventUpdate()
+        return(new_options)
+
+    @app.callback(
+        Output(component_id = 'api-match-selection', component_property = 'value'),
+        events = [Event('api-match-load-interval', 'interval')],
+        state = [State(component_id = 'api-match-selection', component_property = 'value')])
+    def update_api_match_value(match_id):
+        '''
+        Select the first match of the latest snapshot; keep the user's selection while it is still in the snapshot
+        '''
+        snapshot = vd.snapshot
+        if match_id in snapshot.match_index or len(snapshot.api_matches) < 1:
+            # re-sending the same match would rebuild every view and reset the plot and roster buttons
+            raise vt.PreventUpdate()
+        return(snapshot.api_matches[0])
+
+    @app.callback(
+        Output(component_id = 'api-match-load-interval', component_property = 'interval'),
+        events = [Event('api-match-load-interval', 'interval')],
+        state = [State(component_id = 'api-match-load-interval', component_property = 'interval')])
+    def update_api_load_interval(interval):
+        '''
+        Poll quickly until the first API load has finished, then only check now and then for a refreshed snapshot
+        '''
+        new_interval = 1000
+        if vd.refresher.status()['loaded'] == True:
+            new_interval = 30 * 1000
+        if new_interval == interval:
+            raise vt.PreventUpdate()
+        return(new_interval)
+
     @app.callback(
         Output(component_id = 'api-roster-table', component_property = 'children'),
         [Input(component_id = 'api-match-selection', component_property = 'value')]
     )
     def update_api_roster_table(match_id):
-        if match_id != None:
+        view = vd.get_match_view(match_id = match_id)
+        if view != None:
             logger.debug("Updating selected-api-match-id value: {0}".format(match_id))
-            roster_df = vd.make_api_roster_df(match_id = match_id)
-            return(vt.html_df_table(df = roster_df))
+            return(vt.html_df_table(df = view['roster_df']))
         else:
             return('No match selected')
 
@@ -207,9 +350,10 @@ if exclude_online == False:
         Rebuild the radio button component for the roster plot based on selected match
         '''
         logger.debug("Rebuilding radio buttons for plot selection for match: {0}".format(match_id))
-        roster_df = vd.make_api_roster_df(match_id = match_id)
-
-        plot_types = [c for c in roster_df.columns if c != 'side']
+        view = vd.get_match_view(match_id = match_id)
+        if view == None:
+            return(vt.create_radio_buttons(options = [], id = 'api-roster-plot-data-type-selection'))
+        plot_types = view['plot_types']
         logger.debug("plot_types are: {0}".format(plot_types))
 
         plot_type_options = [{'label': i, 'value': i} for i in plot_types]
@@ -225,10 +369,10 @@ if exclude_online == False:
     )
     def update_api_roster_plot(match_id, plot_type):
         logger.debug("Updating input value for match, plot type: {0}, {1}".format(match_id, plot_type))
-        if match_id != None and plot_type != None:
-            roster_df = vd.make_api_roster_df(match_id = match_id)
+        view = vd.get_match_view(match_id = match_id)
+        if view != None and plot_type != None:
             try:
-                return(vt.roster_df_plot(roster_df = roster_df, plot_type = plot_type))
+                return(vt.roster_df_plot(roster_df = view['roster_df'], plot_type = plot_type))
             except:
                 logger.debug("Plot could not be created for match: {0}, {1}".format(match_id, plot_type))
                 return('Plot could not be created')
@@ -245,8 +389,10 @@ if exclude_online == False:
         Update the radio buttons with the available team roster IDs
         '''
         logger.debug("Rebuilding radio buttons for api_team_roster_buttons for match: {0}".format(match_id))
-        match = vt.get_glmatch(data = vd.matches, match_id = match_id)
-        roster_ids = [roster.id for roster in match.rosters]
+        view = vd.get_match_view(match_id = match_id)
+        if view == None:
+            return(vt.create_radio_buttons(options = [], id = 'api-team-roster-selection'))
+        roster_ids = view['roster_ids']
         logger.debug("Available rosters are: {0}".format(roster_ids))
         roster_options = [{'label': i, 'value': i} for i in roster_ids]
         selected_roster = roster_options[0]
@@ -262,7 +408,10 @@ if exclude_online == False:
         Show the game mode
         '''
         logger.debug("Getting gameMode for match: {0}".format(match_id))
-        match = vt.get_glmatch(data = vd.matches, match_id = match_id)
+        view = vd.get_match_view(match_id = match_id)
+        if view == None:
+            return('')
+        match = view['match']
         gameMode = str(match.gameMode)
         return(gameMode)
 
@@ -276,10 +425,10 @@ if exclude_online == False:
         Create a table based on the player stats in the match
         !!! this does not work for some reason !!!
         '''
-        if match_id != None:
+        view = vd.get_match_view(match_id = match_id)
+        if view != None:
             logger.debug("Creating player stats table for match: {0}".format(match_id))
-            match = vt.get_glmatch(data = vd.matches, match_id = match_id)
-            stats_df = vt.make_glparticipant_stats_df(match = match)
+            stats_df = view['stats_df']
             # cols = [c for c in stats_df.columns if c not in ['itemGrants', 'itemUses', 'itemSells']]
             player_cols = ['elo_earned_season_4', 'elo_earned_season_5', 'elo_earned_season_6', 'elo_earned_season_7', 'karmaLevel', 'level', 'lifetimeGold', 'lossStreak', 'played', 'played_ranked', 'skillTier', 'winStreak', 'wins', 'xp']
             # participant_cols = ['assists', 'crystalMineCaptures', 'deaths', 'farm', 'firstAfkTime',
@@ -292,14 +441,8 @@ if exclude_online == False:
             player_summary_cols = ['hero', 'skinKey', 'name', 'side']
             player_summary_cols = [c for c in stats_df.columns if c in player_summary_cols]
             logger.debug('player_summary_cols:\n{0}'.format(player_summary_cols))
-            logger.debug(stats_df[player_summary_cols])
-
-            # convert float cols to int
-            stats_df[vt.find_coltypes(df = stats_df, coltype = float)] = stats_df[vt.find_coltypes(df = stats_df, coltype = float)].applymap(int)
-            # convert booleans to strings
-            stats_df[vt.find_coltypes(df = stats_df, coltype = bool)] = stats_df[vt.find_coltypes(df = stats_df, coltype = bool)].applymap(str)
-            # add numbers column
-            stats_df[''] = stats_df.index
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(stats_df[player_summary_cols])
             return([
             html.Div(children = [
                 html.H4(children = 'Player Info'),
@@ -318,17 +461,21 @@ if exclude_online == False:
         events = [Event('api-match-update-matches-button', 'click')])
     def update_api_data():
         '''
-        Update the matches that have been queried from the API
-        Rebuild the dropdown selection menu div
+        Ask the background refresher to query the API for new matches
+        Rebuild the dropdown selection menu div right away from the latest snapshot; the dropdown is updated again when the refresh finishes
         NOTE: click events might break with future Dash updates
         '''
-        logger.debug("Querying the API for new matches;")
-        logger.debug("old matches:\n{0}".format(vd.api_matches))
-        vd.matches = vd.api.matches({"page[limit]": 5}) #  "filter[playerNames]": "TheLegend27"
-        vd.api_matches = [x.id for x in vd.matches]
-        logger.debug("new matches:\n{0}".format(vd.api_matches))
-        return(vt.match_dropdown(matches = vd.api_matches, id = 'api-match-selection'))
+        snapshot = vd.snapshot
+        vd.refresher.request_refresh()
+        if len(snapshot.api_matches) < 1:
+            logger.debug("The initial API load has not finished yet")
+            return(dcc.Dropdown(id = 'api-match-selection', options = [], placeholder = 'Loading matches from the API...'))
+        logger.debug("Requested an API refresh; current matches:\n{0}".format(snapshot.api_matches))
+        return(vt.match_dropdown(matches = snapshot.api_matches, id = 'api-match-selection'))
 
 
 if __name__ == '__main__':
+    if exclude_online == False:
+        vd.start_background_load(interval = refresh_interval, cache_file = cache_file, cache_ttl = args.cache_ttl)
+    logger.info("App set up in {0:.2f}s; starting server".format(time.time() - app_start_time))
     app.run_server()
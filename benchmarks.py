@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for the hot paths of the app and the command line tool
+
+Times JSON loading, the roster and participant stats dfs, the included assets and Fail Finder code,
+the table rendering, and the harvest writers, over demo-data.txt and over synthetic corpora (see synthetic.py) of 1k and 10k matches,
+or 100k matches when asked for with --corpora (its generated file is almost 900 MB).
+The memory suite measures the bytes per match kept alive by parsed payload dicts and by match records (see records.py).
+Generated corpora are written once to bench_data/ and reused by later runs.
+The results are saved to a JSON file, and two results files can be compared to find regressions.
+
+./benchmarks.py run -o results.json
+./benchmarks.py run --corpora demo 1000 --suites match harvest -o results.json
+./benchmarks.py run --corpora 100000 --suites memory -o memory.json
+./benchmarks.py compare baseline.json results.json
+'''
+from __future__ import print_function
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+
+import numpy as np
+
+import tools as vt
+import columnar
+import jsonstream
+import vainstats
+import synthetic
+import records
+from payload import PayloadIndex, relationship_ids
+from store import MatchStore
+from players import PlayerRegistry
+
+# the 100k match corpus is opt-in, with --corpora, since generating it writes almost 900 MB to bench_data/
+default_corpora = ['demo', '1000', '10000']
+default_suites = ['load', 'match', 'tables', 'harvest', 'memory']
+
+
+# ~~~~~ CORPORA ~~~~~ #
+def corpus_path(corpus, data_dir = 'bench_data', seed = 0):
+    '''
+    Return the payload file for a corpus, generating it first if needed
+    corpus is 'demo' for demo-data.txt, or a number of matches
+    '''
+    if corpus == 'demo':
+        return('demo-data.txt')
+    vainstats.mkdirs(data_dir)
+    path = os.path.join(data_dir, 'synthetic-{0}-seed{1}.json'.format(corpus, seed))
+    if not os.path.exists(path):
+        print('Generating {0} matches: {1}'.format(corpus, path), file = sys.stderr)
+        tmp_path = path + '.tmp'
+        generator = synthetic.PayloadGenerator(seed = seed, num_players = 2 * int(corpus))
+        synthetic.write_payload(tmp_path, generator.iter_matches(int(corpus)))
+        os.rename(tmp_path, path)
+    return(path)
+
+def load_sample(path, num_matches):
+    '''
+    Return up to num_matches single-match payloads from the start of a payload file
+    '''
+    sample = []
+    for match_payload in jsonstream.iter_match_payloads(path, in_order = True):
+        sample.append(match_payload)
+        if len(sample) >= num_matches:
+            break
+    return(sample)
+
+
+class GLObject(object):
+    '''
+    Stand-in for the gamelocker library's Match, Roster, Participant and Player objects, with the same attributes
+    '''
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+def make_glmatch(index, match_id):
+    '''
+    Return a GLObject match, with its rosters, participants and players, from a PayloadIndex
+    '''
+    rosters = []
+    for roster in index.rosters(match_id):
+        participants = []
+        for participant in index.resolve(relationship_ids(roster, 'participants')):
+            player = index.resolve(relationship_ids(participant, 'player'))[0]
+            participants.append(GLObject(
+                id = participant['id'],
+                actor = participant['attributes']['actor'],
+                stats = participant['attributes']['stats'],
+                player = GLObject(id = player['id'], name = player['attributes']['name'], stats = player['attributes']['stats'])))
+        rosters.append(GLObject(id = roster['id'], stats = roster['attributes']['stats'], participants = participants))
+    match = index.match(match_id)
+    return(GLObject(id = match_id, rosters = rosters, gameMode = match['attributes']['gameMode']))
+
+
+# ~~~~~ BENCHMARKS ~~~~~ #
+@contextlib.contextmanager
+def quiet():
+    '''
+    Send anything printed by the benchmarked code to /dev/null
+    '''
+    with open(os.devnull, 'w') as devnull:
+        old_stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = old_stdout
+
+def time_call(function, repeat = 3):
+    '''
+    Return the times in seconds of several calls to function, and its last return value
+    '''
+    times = []
+    for i in range(repeat):
+        start_time = time.time()
+        with quiet():
+            result = function()
+        times.append(time.time() - start_time)
+    return(times, result)
+
+def measure_memory(function):
+    '''
+    Return the time in seconds of a call to function, and its return value, with the bytes still allocated once it returns
+    function returns (number of items, the objects to measure)
+    '''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start_time = time.time()
+        with quiet():
+            items, kept = function()
+        seconds = time.time() - start_time
+        gc.collect()
+        num_bytes = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return(seconds, items, num_bytes)
+
+def html_df_table_by_cell(df, max_rows = 10):
+    '''
+    The original html_df_table, which looks up every cell with df.iloc[i][col]
+    '''
+    html = vt.html
+    return(
+    html.Table(
+    # Header
+    [html.Tr([html.Th(col) for col in df.columns])] +
+
+    # Body
+    [html.Tr([
+        html.Td(df.iloc[i][col]) for col in df.columns
+    ]) for i in range(min(len(df), max_rows))]
+    )
+    )
+
+def make_participant_df(num_rows, input_paths = ['demo-data.txt']):
+    '''
+    Return a participant stats df with num_rows rows, repeating the rows of the input matches
+    '''
+    df = columnar.build_participant_table(input_paths).to_dataframe()
+    return(df.iloc[np.arange(num_rows) % len(df)].reset_index(drop = True))
+
+def load_benchmarks(path, num_matches, options):
+    '''
+    Yield (name, function) for loading the whole payload file; each function returns the number of matches loaded
+    '''
+    if num_matches <= options.max_load_matches:
+        yield('load_json', lambda: len(vt.load_json(input_file = path)['data']))
+    yield('load_json_index', lambda: len(vt.load_json_index(input_file = path).match_ids))
+    yield('iter_match_payloads', lambda: sum(1 for match_payload in jsonstream.iter_match_payloads(path)))
+
+def match_benchmarks(path, num_matches, options):
+    '''
+    Yield (name, function) for the per-match code, run over a sample of the matches
+    '''
+    import offline_data as vod
+    sample = load_sample(path, options.sample)
+    index = PayloadIndex()
+    for match_payload in sample:
+        index.add(match_payload)
+    glmatches = [make_glmatch(index, match_id) for match_id in index.match_ids]
+
+    def make_demo_roster_dfs():
+        demo_index = vod.demo_index
+        vod.demo_index = index
+        try:
+            return(len([vod.make_demo_roster_df(match_id = match_id) for match_id in index.match_ids]))
+        finally:
+            vod.demo_index = demo_index
+
+    def fail_finder():
+        for match_payload in sample:
+            vainstats.fail_finder(vainstats.refactor_included_assets(match_payload['included']))
+        return(len(sample))
+
+    def refactor_included_assets_registry():
+        players = PlayerRegistry()
+        return(len([vainstats.refactor_included_assets(match_payload['included'], players = players, seen = match_payload['data']['attributes']['createdAt']) for match_payload in sample]))
+
+    yield('make_demo_roster_df', make_demo_roster_dfs)
+    yield('make_glparticipant_stats_df', lambda: len([vt.make_glparticipant_stats_df(match = match) for match in glmatches]))
+    yield('make_glparticipant_stats_df_many', lambda: len(vt.make_glparticipant_stats_df(matches = glmatches)) // 6)
+    yield('refactor_included_assets', lambda: len([vainstats.refactor_included_assets(match_payload['included']) for match_payload in sample]))
+    yield('refactor_included_assets_registry', refactor_included_assets_registry)
+    yield('fail_finder', fail_finder)
+
+def table_benchmarks(num_rows, options):
+    '''
+    Yield (name, function) for rendering a participant table of num_rows rows; each function returns the number of rows
+    Whole tables are only rendered up to options.max_full_rows rows; the cell-by-cell version takes about half an hour for 100k rows
+    '''
+    df = make_participant_df(num_rows)
+    page_size = 20
+    if num_rows <= options.max_full_rows:
+        yield('html_df_table_by_cell_all_rows', lambda: len(html_df_table_by_cell(df, max_rows = num_rows).children) - 1)
+        yield('html_df_table_all_rows', lambda: len(vt.html_df_table(df, max_rows = num_rows).children) - 1)
+    yield('html_df_table_by_cell_first_page', lambda: len(html_df_table_by_cell(df, max_rows = page_size).children) - 1)
+    yield('html_df_table_first_page', lambda: len(vt.html_df_table(df, max_rows = page_size).children) - 1)
+    yield('html_df_table_sorted_last_page', lambda: len(vt.html_df_table(df, max_rows = page_size, page = num_rows // page_size, sort_by = 'kills', ascending = False).children) - 1)
+
+def harvest_benchmarks(path, num_matches, options):
+    '''
+    Yield (name, function) for the harvest writers; the per-file writers are run over a sample of the matches
+    '''
+    sample = load_sample(path, options.sample)
+
+    def save_files():
+        output_dir = tempfile.mkdtemp(prefix = 'bench-saved-matches-')
+        try:
+            for match_payload in sample:
+                vainstats.save_match_data(match_payload['data'], harvest_mode = True, output_dir = output_dir, quiet = True)
+                for item in match_payload['included']:
+                    vainstats.save_match_included(item, harvest_mode = True, output_dir = output_dir, quiet = True)
+            return(len(sample))
+        finally:
+            shutil.rmtree(output_dir)
+
+    def store_put_many():
+        store_dir = tempfile.mkdtemp(prefix = 'bench-match-store-')
+        try:
+            return(MatchStore(store_dir).put_many(jsonstream.iter_match_payloads(path)))
+        finally:
+            shutil.rmtree(store_dir)
+
+    yield('save_match_files', save_files)
+    yield('store_put_many', store_put_many)
+
+def memory_benchmarks(path, num_matches, options):
+    '''
+    Yield (name, function) for keeping the matches of a corpus in memory; each function returns (number of matches, the matches)
+    The payload dicts take about 50 KB per match, so they are only loaded for up to options.max_dict_matches matches;
+    there is nothing shared between their matches, so the bytes per match of a sample are the same as for the whole corpus
+    '''
+    def payload_dicts():
+        payloads = load_sample(path, min(num_matches, options.max_dict_matches))
+        return(len(payloads), payloads)
+
+    def match_records():
+        matches = records.match_records(jsonstream.iter_match_payloads(path, in_order = True))
+        return(len(matches), matches)
+
+    yield('payload_dicts', payload_dicts)
+    yield('match_records', match_records)
+
+def memory_results(suite, corpus, benchmarks):
+    '''
+    Yield a result dict for each (name, function) memory benchmark, with the bytes kept alive per item
+    '''
+    for name, function in benchmarks:
+        seconds, items, num_bytes = measure_memory(function)
+        yield({
+        'suite': suite,
+        'name': name,
+        'corpus': corpus,
+        'items': items,
+        'seconds': seconds,
+        'per_item': seconds / max(items, 1),
+        'times': [seconds],
+        'bytes': num_bytes,
+        'bytes_per_item': num_bytes / max(items, 1)
+        })
+
+def time_benchmarks(suite, corpus, benchmarks, repeat = 3):
+    '''
+    Yield a result dict for each (name, function) benchmark
+    '''
+    for name, function in benchmarks:
+        times, items = time_call(function, repeat = repeat)
+        yield({
+        'suite': suite,
+        'name': name,
+        'corpus': corpus,
+        'items': items,
+        'seconds': min(times),
+        'per_item': min(times) / max(items, 1),
+        'times': times
+        })
+
+def run_benchmarks(corpora = default_corpora, suites = default_suites, options = None):
+    '''
+    Yield a result dict for each benchmark in the suites, over each corpus
+    The 'tables' suite runs once for each table size in options.table_rows, with the number of rows as its corpus
+    '''
+    if 'tables' in suites:
+        for num_rows in options.table_rows:
+            for result in time_benchmarks('tables', str(num_rows), table_benchmarks(num_rows, options), repeat = options.repeat):
+                yield(result)
+    for corpus in corpora:
+        path = corpus_path(corpus, data_dir = options.data_dir, seed = options.seed)
+        num_matches = len(vt.load_json_index(path).match_ids) if corpus == 'demo' else int(corpus)
+        for suite in suites:
+            if suite == 'load':
+                benchmarks = load_benchmarks(path, num_matches, options)
+            elif suite == 'match':
+                benchmarks = match_benchmarks(path, num_matches, options)
+            elif suite == 'harvest':
+                benchmarks = harvest_benchmarks(path, num_matches, options)
+            elif suite == 'memory':
+                for result in memory_results(suite, corpus, memory_benchmarks(path, num_matches, options)):
+                    yield(result)
+                continue
+            else:
+                continue
+            for result in time_benchmarks(suite, corpus, benchmarks, repeat = options.repeat):
+                yield(result)
+
+def git_commit():
+    '''
+    Return the current git commit of the repo, or None
+    '''
+    import subprocess
+    try:
+        return(subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr = subprocess.STDOUT).decode('utf-8').strip())
+    except Exception:
+        return(None)
+
+def print_result(result):
+    row_format = "{:<10}{:<36}{:>8}{:>10}{:>14}{:>16}{:>16}"
+    if result == None:
+        print(row_format.format('Suite', 'Benchmark', 'Corpus', 'Items', 'Seconds', 'Per item', 'Bytes per item'))
+        return
+    bytes_per_item = '{0:.0f}'.format(result['bytes_per_item']) if 'bytes_per_item' in result else ''
+    print(row_format.format(result['suite'], result['name'], result['corpus'], result['items'], '{0:.6f}'.format(result['seconds']), '{0:.9f}'.format(result['per_item']), bytes_per_item))
+
+
+# ~~~~~ COMPARE ~~~~~ #
+def compare_results(baseline, results, threshold = 0.1, min_seconds = 0.001):
+    '''
+    Yield (result key, baseline seconds per item, new seconds per item, change, regressed) for each benchmark in both runs
+    A benchmark regressed if its time per item grew by more than threshold, and by more than min_seconds in total
+    Memory benchmarks are compared by bytes per item instead, and regressed if that grew by more than threshold
+    '''
+    baseline_results = {(x['suite'], x['name'], x['corpus']): x for x in baseline['results']}
+    for result in results['results']:
+        key = (result['suite'], result['name'], result['corpus'])
+        if key not in baseline_results:
+            continue
+        old = baseline_results[key]
+        if 'bytes_per_item' in result and 'bytes_per_item' in old:
+            change = result['bytes_per_item'] / old['bytes_per_item'] - 1 if old['bytes_per_item'] > 0 else 0
+            yield(key, old['bytes_per_item'], result['bytes_per_item'], change, change > threshold)
+            continue
+        change = result['per_item'] / old['per_item'] - 1 if old['per_item'] > 0 else 0
+        regressed = change > threshold and result['seconds'] - old['seconds'] > min_seconds
+        yield(key, old['per_item'], result['per_item'], change, regressed)
+
+def run():
+    '''
+    Arg parsing for the script when run from command line
+    '''
+    parser = argparse.ArgumentParser(description='Benchmarks for vainstats')
+    subparsers = parser.add_subparsers(dest = 'command')
+    run_parser = subparsers.add_parser('run', help = 'Run the benchmarks')
+    run_parser.add_argument("--corpora", default = default_corpora, nargs = '+', dest = 'corpora', help="'demo' for demo-data.txt, or numbers of generated matches")
+    run_parser.add_argument("--suites", default = default_suites, nargs = '+', choices = default_suites, dest = 'suites', help="Benchmark suites to run")
+    run_parser.add_argument("--repeat", default = 3, type = int, dest = 'repeat', help="Number of times to time each benchmark; the best time is used")
+    run_parser.add_argument("--sample", default = 1000, type = int, dest = 'sample', help="Number of matches to use for the per-match benchmarks")
+    run_parser.add_argument("--max-load-matches", default = 10000, type = int, dest = 'max_load_matches', help="Largest corpus to load whole with json.load")
+    run_parser.add_argument("--table-rows", default = [10, 1000, 100000], type = int, nargs = '+', dest = 'table_rows', help="Numbers of table rows for the 'tables' suite")
+    run_parser.add_argument("--max-full-rows", default = 1000, type = int, dest = 'max_full_rows', help="Largest table to render whole, instead of a page at a time")
+    run_parser.add_argument("--max-dict-matches", default = 10000, type = int, dest = 'max_dict_matches', help="Number of matches to keep as payload dicts for the 'memory' suite")
+    run_parser.add_argument("--data-dir", default = 'bench_data', dest = 'data_dir', help="Directory for the generated corpora")
+    run_parser.add_argument("--seed", default = 0, type = int, dest = 'seed', help="Random seed for the generated corpora")
+    run_parser.add_argument("-o", default = 'bench_results.json', dest = 'output_file', metavar = 'output_file', help="JSON file to save the results to")
+    compare_parser = subparsers.add_parser('compare', help = 'Compare two results files')
+    compare_parser.add_argument("baseline_file", help="Results from before the change")
+    compare_parser.add_argument("results_file", help="Results from after the change")
+    compare_parser.add_argument("--threshold", default = 0.1, type = float, dest = 'threshold', help="Slowdown that counts as a regression, e.g. 0.1 for 10%%")
+    compare_parser.add_argument("--min-seconds", default = 0.001, type = float, dest = 'min_seconds', help="Ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline_file) as f:
+            baseline = json.load(f)
+        with open(args.results_file) as f:
+            results = json.load(f)
+        row_format = "{:<10}{:<36}{:>8}{:>16}{:>16}{:>10}  {}"
+        print(row_format.format('Suite', 'Benchmark', 'Corpus', 'Before', 'After', 'Change', ''))
+        num_regressions = 0
+        for key, old, new, change, regressed in compare_results(baseline, results, threshold = args.threshold, min_seconds = args.min_seconds):
+            num_regressions += regressed
+            value_format = '{0:.0f}' if key[0] == 'memory' else '{0:.9f}'
+            print(row_format.format(key[0], key[1], key[2], value_format.format(old), value_format.format(new), '{0:+.1%}'.format(change), 'REGRESSION' if regressed else ''))
+        print('{0} regressions'.format(num_regressions))
+        sys.exit(1 if num_regressions > 0 else 0)
+
+    if args.command == None:
+        parser.print_help()
+        sys.exit(2)
+    results = {
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'commit': git_commit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'options': vars(args),
+    'results': []
+    }
+    print_result(None)
+    for result in run_benchmarks(corpora = args.corpora, suites = args.suites, options = args):
+        print_result(result)
+        results['results'].append(result)
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent = 4)
+    print('Saved results to {0}'.format(args.output_file))
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Checkpoints for incremental harvests
+
+Keeps, in a state directory:
+    watermarks.json   # newest match 'createdAt' harvested, per region and player name ('*' for no player)
+    seen_ids.bin      # sorted 16 byte IDs of every match harvested
+
+so that a repeated harvest only asks the API for matches newer than the last run,
+and skips matches it has already saved before they are written again.
+'''
+import os
+import json
+import uuid
+import heapq
+import hashlib
+
+from payload import PayloadIndex
+
+id_size = 16
+
+
+def mkdirs(path):
+    '''
+    Make a directory, and all parent dir's in the path
+    '''
+    import errno
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+    return(path)
+
+def match_id_bytes(match_id):
+    '''
+    Return a 16 byte key for a match ID; the UUID bytes, or an MD5 hash for IDs that are not UUIDs
+    '''
+    try:
+        return(uuid.UUID(match_id).bytes)
+    except ValueError:
+        return(hashlib.md5(match_id.encode('utf-8')).digest())
+
+
+class SeenIDs(object):
+    '''
+    Compact set of match IDs, kept as a sorted file of 16 byte keys
+    The saved keys are searched in place with a binary search; new keys are merged in on save()
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.saved = b''
+        self.new = set()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.saved = f.read()
+
+    def __len__(self):
+        return(len(self.saved) // id_size + len(self.new))
+
+    def __contains__(self, match_id):
+        key = match_id_bytes(match_id)
+        if key in self.new:
+            return(True)
+        low = 0
+        high = len(self.saved) // id_size
+        while low < high:
+            middle = (low + high) // 2
+            middle_key = self.saved[middle * id_size:(middle + 1) * id_size]
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return(True)
+        return(False)
+
+    def add(self, match_id):
+        if match_id not in self:
+            self.new.add(match_id_bytes(match_id))
+
+    def save(self):
+        '''
+        Merge the new keys into the sorted file
+        '''
+        if len(self.new) < 1:
+            return
+        saved_keys = (self.saved[i:i + id_size] for i in range(0, len(self.saved), id_size))
+        self.saved = b''.join(heapq.merge(saved_keys, sorted(self.new)))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.saved)
+        os.replace(tmp_path, self.path)
+        self.new = set()
+
+
+class HarvestState(object):
+    '''
+    Watermarks and seen match IDs for incremental harvests
+
+    >>> state = HarvestState('harvest_state')
+    >>> search_time = state.search_start('na', 'eLiza', default = search_time)
+    >>> payload = state.filter_payload(payload)
+    >>> state.mark_harvested(payload)
+    >>> state.save()
+    '''
+    def __init__(self, path):
+        self.path = mkdirs(path)
+        self.watermark_file = os.path.join(path, 'watermarks.json')
+        self.watermarks = {}
+        if os.path.exists(self.watermark_file):
+            with open(self.watermark_file) as f:
+                self.watermarks = json.load(f)
+        self.seen = SeenIDs(os.path.join(path, 'seen_ids.bin'))
+        self.newest = None
+        self.num_skipped = 0
+
+    def key(self, region, username):
+        return('{0}|{1}'.format(region, username if username != None else '*'))
+
+    def search_start(self, region, username, default):
+        '''
+        Return the start of the search window: the newer of the default time and the last harvest's watermark
+        '''
+        watermark = self.watermarks.get(self.key(region, username))
+        if watermark != None and watermark > default:
+            return(watermark)
+        return(default)
+
+    def filter_payload(self, payload):
+        '''
+        Return the payload with only the matches (and their included items) that have not been harvested yet
+        '''
+        matches = payload['data'] if isinstance(payload['data'], list) else [payload['data']]
+        new_matches = [match for match in matches if match['id'] not in self.seen]
+        self.num_skipped += len(matches) - len(new_matches)
+        if len(new_matches) == len(matches):
+            return(payload)
+        index = PayloadIndex(payload)
+        included = {}
+        for match in new_matches:
+            for item in index.included(match['id']):
+                included[(item['type'], item['id'])] = item
+        return(dict(payload, data = new_matches, included = list(included.values())))
+
+    def mark_harvested(self, payload):
+        '''
+        Record the matches in a payload as harvested
+        '''
+        matches = payload['data'] if isinstance(payload['data'], list) else [payload['data']]
+        for match in matches:
+            self.seen.add(match['id'])
+            created_at = match['attributes']['createdAt']
+            if self.newest == None or created_at > self.newest:
+                self.newest = created_at
+
+    def save(self, region = None, username = None):
+        '''
+        Save the seen match IDs, and the watermark for the search if one is given
+        The watermark should only be saved after a harvest has finished, since the API returns the newest matches first
+        '''
+        self.seen.save()
+        if region != None and self.newest != None:
+            key = self.key(region, username)
+            if self.watermarks.get(key) == None or self.newest > self.watermarks[key]:
+                self.watermarks[key] = self.newest
+            tmp_file = self.watermark_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.watermarks, f, indent = 4, sort_keys = True)
+            os.replace(tmp_file, self.watermark_file)
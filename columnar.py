@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Columnar participant stats table for harvested matches
+
+Flattens the matches, rosters, participants and players of harvested payloads
+into one row per participant, with one typed numpy array per stat.
+String columns (hero, player name, IDs, etc.) are stored as integer codes into a list of categories.
+
+The table is saved in a compact binary file that is loaded with a single read:
+    magic (8 bytes) + header length (8 bytes) + JSON header + column data + category data
+where the JSON header has the number of rows, and the name, dtype and byte offset of each column and of its categories.
+The categories of a column are stored as the byte offset of each value (count + 1 little-endian int64s)
+followed by the UTF-8 values, and are only decoded when the column's strings are first used,
+so a table with millions of distinct IDs still loads with a small header.
+
+Build a table from a match store, a saved_matches directory, or API payload JSON files with:
+./columnar.py match_store -o participants.vcol
+'''
+from __future__ import print_function
+import os
+import json
+import struct
+import argparse
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+from payload import PayloadIndex
+from records import match_record
+
+file_magic = b'VCOL1\n\x00\x00'
+header_length = struct.Struct('<Q')
+
+# array typecode and numpy dtype for each column type
+column_types = {
+'int': ('q', np.int32, 0),
+'float': ('d', np.float64, float('nan')),
+'bool': ('b', np.bool_, False),
+'category': ('q', np.int32, None)
+}
+
+# (column name, source, stat key, column type)
+# source is where the value is found: the match attributes or stats, roster stats, participant stats or attributes, or player stats or attributes
+# the values are read from the match, roster, participant and player records (see records.py), which have a field for each key
+participant_schema = [
+('match_id', 'match', 'id', 'category'),
+('createdAt', 'match_attributes', 'createdAt', 'category'),
+('duration', 'match_attributes', 'duration', 'int'),
+('gameMode', 'match_attributes', 'gameMode', 'category'),
+('patchVersion', 'match_attributes', 'patchVersion', 'category'),
+('shardId', 'match_attributes', 'shardId', 'category'),
+('endGameReason', 'match_stats', 'endGameReason', 'category'),
+('roster_id', 'roster', 'id', 'category'),
+('side', 'roster_stats', 'side', 'category'),
+('roster_acesEarned', 'roster_stats', 'acesEarned', 'int'),
+('roster_gold', 'roster_stats', 'gold', 'int'),
+('roster_heroKills', 'roster_stats', 'heroKills', 'int'),
+('roster_krakenCaptures', 'roster_stats', 'krakenCaptures', 'int'),
+('roster_turretKills', 'roster_stats', 'turretKills', 'int'),
+('roster_turretsRemaining', 'roster_stats', 'turretsRemaining', 'int'),
+('participant_id', 'participant', 'id', 'category'),
+('hero', 'participant_attributes', 'actor', 'category'),
+('skinKey', 'participant_stats', 'skinKey', 'category'),
+('assists', 'participant_stats', 'assists', 'int'),
+('crystalMineCaptures', 'participant_stats', 'crystalMineCaptures', 'int'),
+('deaths', 'participant_stats', 'deaths', 'int'),
+('farm', 'participant_stats', 'farm', 'float'),
+('firstAfkTime', 'participant_stats', 'firstAfkTime', 'float'),
+('gold', 'participant_stats', 'gold', 'float'),
+('goldMineCaptures', 'participant_stats', 'goldMineCaptures', 'int'),
+('jungleKills', 'participant_stats', 'jungleKills', 'int'),
+('karmaLevel', 'participant_stats', 'karmaLevel', 'int'),
+('kills', 'participant_stats', 'kills', 'int'),
+('krakenCaptures', 'participant_stats', 'krakenCaptures', 'int'),
+('level', 'participant_stats', 'level', 'int'),
+('minionKills', 'participant_stats', 'minionKills', 'int'),
+('nonJungleMinionKills', 'participant_stats', 'nonJungleMinionKills', 'int'),
+('skillTier', 'participant_stats', 'skillTier', 'int'),
+('turretCaptures', 'participant_stats', 'turretCaptures', 'int'),
+('wentAfk', 'participant_stats', 'wentAfk', 'bool'),
+('winner', 'participant_stats', 'winner', 'bool'),
+('player_id', 'player', 'id', 'category'),
+('name', 'player_attributes', 'name', 'category'),
+('player_level', 'player_stats', 'level', 'int'),
+('player_karmaLevel', 'player_stats', 'karmaLevel', 'int'),
+('player_skillTier', 'player_stats', 'skillTier', 'int'),
+('player_wins', 'player_stats', 'wins', 'int'),
+('player_played', 'player_stats', 'played', 'int'),
+('player_played_ranked', 'player_stats', 'played_ranked', 'int'),
+('player_winStreak', 'player_stats', 'winStreak', 'int'),
+('player_lossStreak', 'player_stats', 'lossStreak', 'int'),
+('player_lifetimeGold', 'player_stats', 'lifetimeGold', 'float'),
+('player_xp', 'player_stats', 'xp', 'int'),
+('player_elo_earned_season_4', 'player_stats', 'elo_earned_season_4', 'float'),
+('player_elo_earned_season_5', 'player_stats', 'elo_earned_season_5', 'float'),
+('player_elo_earned_season_6', 'player_stats', 'elo_earned_season_6', 'float'),
+('player_elo_earned_season_7', 'player_stats', 'elo_earned_season_7', 'float'),
+]
+
+
+def encode_categories(values):
+    '''
+    Return the binary block for a list of category strings: the byte offset of each value, then the UTF-8 values
+    '''
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype = '<i8')
+    np.cumsum([len(value) for value in encoded], out = offsets[1:])
+    return(offsets.tobytes() + b''.join(encoded))
+
+def decode_categories(data, offset, count):
+    '''
+    Return the list of category strings in the binary block at offset in data
+    '''
+    offsets = np.frombuffer(data, dtype = '<i8', count = count + 1, offset = offset).tolist()
+    start = offset + (count + 1) * 8
+    values = data[start:start + offsets[-1]]
+    text = values.decode('utf-8')
+    if len(text) == len(values):
+        # ASCII, so the byte offsets are also the character offsets
+        return([text[i:j] for i, j in zip(offsets[:-1], offsets[1:])])
+    return([values[i:j].decode('utf-8') for i, j in zip(offsets[:-1], offsets[1:])])
+
+
+class CategoryBlocks(dict):
+    '''
+    The categories of a loaded table; each column's list is decoded from its binary block the first time it is used
+    '''
+    def __init__(self, data):
+        dict.__init__(self)
+        self.data = data
+        # column name -> (offset, number of values) of each column's block
+        self.blocks = {}
+
+    def __missing__(self, name):
+        if name not in self.blocks:
+            raise KeyError(name)
+        offset, count = self.blocks[name]
+        values = decode_categories(self.data, offset, count)
+        self[name] = values
+        return(values)
+
+    def __contains__(self, name):
+        return(name in self.blocks or dict.__contains__(self, name))
+
+    def get(self, name, default = None):
+        if name in self:
+            return(self[name])
+        return(default)
+
+
+class ParticipantTable(object):
+    '''
+    One row per participant, one numpy array per column
+
+    >>> table = ParticipantTable.load('participants.vcol')
+    >>> table['kills'].mean()
+    >>> table.strings('hero')
+    >>> df = table.to_dataframe()
+    '''
+    def __init__(self, columns, categories, schema = participant_schema):
+        self.columns = columns
+        self.categories = categories
+        self.schema = schema
+        self.column_types = OrderedDict((name, column_type) for name, source, key, column_type in schema)
+
+    def __len__(self):
+        if len(self.columns) < 1:
+            return(0)
+        return(len(next(iter(self.columns.values()))))
+
+    def __getitem__(self, name):
+        return(self.columns[name])
+
+    def strings(self, name):
+        '''
+        Return a category column decoded to an array of strings
+        '''
+        return(np.array(self.categories[name], dtype = object)[self.columns[name]])
+
+    def to_dataframe(self, columns = None):
+        '''
+        Return the table as a pandas DataFrame, with pandas Categoricals for the category columns
+        '''
+        import pandas as pd
+        if columns == None:
+            columns = list(self.columns.keys())
+        data = OrderedDict()
+        for name in columns:
+            if self.column_types[name] == 'category':
+                data[name] = pd.Categorical.from_codes(self.columns[name], categories = self.categories[name])
+            else:
+                data[name] = self.columns[name]
+        return(pd.DataFrame(data))
+
+    def save(self, output_file):
+        '''
+        Save the table to a binary file
+        '''
+        with open(output_file, 'wb') as f:
+            f.write(self.to_bytes())
+
+    def to_bytes(self):
+        '''
+        Return the table in the binary file format
+        '''
+        header = {'num_rows': len(self), 'columns': []}
+        offset = 0
+        for name, values in self.columns.items():
+            values = np.ascontiguousarray(values)
+            header['columns'].append({
+            'name': name,
+            'type': self.column_types[name],
+            'dtype': values.dtype.newbyteorder('<').str,
+            'offset': offset,
+            'nbytes': values.nbytes,
+            'categories': None
+            })
+            offset += values.nbytes + (-values.nbytes % 8)
+        category_parts = []
+        for column in header['columns']:
+            if column['name'] not in self.categories:
+                continue
+            data = encode_categories(self.categories[column['name']])
+            column['categories'] = {'offset': offset, 'count': len(self.categories[column['name']]), 'nbytes': len(data)}
+            category_parts.append(data + b'\x00' * (-len(data) % 8))
+            offset += len(category_parts[-1])
+        header_bytes = json.dumps(header, separators = (',', ':')).encode('utf-8')
+        header_bytes += b' ' * (-len(header_bytes) % 8)
+        parts = [file_magic, header_length.pack(len(header_bytes)), header_bytes]
+        for name, values in self.columns.items():
+            data = np.ascontiguousarray(values.astype(values.dtype.newbyteorder('<'), copy = False)).tobytes()
+            parts.append(data)
+            parts.append(b'\x00' * (-len(data) % 8))
+        parts.extend(category_parts)
+        return(b''.join(parts))
+
+    @classmethod
+    def load(cls, input_file):
+        '''
+        Load a table saved with save(), using a single read of the file
+        The columns are read-only views on the file data
+        '''
+        with open(input_file, 'rb') as f:
+            data = f.read()
+        if data[:len(file_magic)] != file_magic:
+            raise ValueError('Not a participant table file: {0}'.format(input_file))
+        return(cls.from_bytes(data))
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''
+        Return the table in data from to_bytes(); the columns are read-only views on data
+        '''
+        if data[:len(file_magic)] != file_magic:
+            raise ValueError('Not a participant table')
+        start = len(file_magic) + header_length.size
+        num_header_bytes = header_length.unpack(data[len(file_magic):start])[0]
+        header = json.loads(data[start:start + num_header_bytes].decode('utf-8'))
+        data_start = start + num_header_bytes
+        columns = OrderedDict()
+        categories = CategoryBlocks(data)
+        schema = []
+        for column in header['columns']:
+            dtype = np.dtype(column['dtype'])
+            columns[column['name']] = np.frombuffer(data, dtype = dtype, count = column['nbytes'] // dtype.itemsize, offset = data_start + column['offset'])
+            if isinstance(column['categories'], list):
+                # tables saved before the categories had their own block
+                categories[column['name']] = column['categories']
+            elif column['categories'] != None:
+                categories.blocks[column['name']] = (data_start + column['categories']['offset'], column['categories']['count'])
+            schema.append((column['name'], None, None, column['type']))
+        return(cls(columns = columns, categories = categories, schema = schema))
+
+
+class ParticipantTableBuilder(object):
+    '''
+    Collects participant rows from payloads into typed column buffers
+
+    >>> builder = ParticipantTableBuilder()
+    >>> builder.add_payload(demo_data)
+    >>> table = builder.build()
+    '''
+    def __init__(self, schema = participant_schema):
+        self.schema = schema
+        self.buffers = OrderedDict()
+        self.category_codes = {}
+        for name, source, key, column_type in schema:
+            self.buffers[name] = array(column_types[column_type][0])
+            if column_type == 'category':
+                self.category_codes[name] = OrderedDict()
+        # the record each column is read from, e.g. 'player' for 'player_stats'
+        self.entities = [source.split('_')[0] for name, source, key, column_type in schema]
+        self.num_matches = 0
+
+    def __len__(self):
+        return(len(self.buffers[self.schema[0][0]]))
+
+    def add_payload(self, payload):
+        '''
+        Add a row for every participant of every match in an API payload
+        '''
+        index = PayloadIndex(payload)
+        for match_id in index.match_ids:
+            self.add_match(index, match_id)
+        return(self)
+
+    def add_match(self, index, match_id):
+        '''
+        Add a row for every participant of a match in a PayloadIndex
+        '''
+        self.add_match_record(match_record(index, match_id))
+
+    def add_match_record(self, match):
+        '''
+        Add a row for every participant of a Match record
+        '''
+        for roster in match.rosters:
+            for participant in roster.participants:
+                self.add_row({'match': match, 'roster': roster, 'participant': participant, 'player': participant.player})
+        self.num_matches += 1
+
+    def add_row(self, records):
+        '''
+        Append one row, from the match, roster, participant and player records of a participant
+        '''
+        for (name, source, key, column_type), entity in zip(self.schema, self.entities):
+            value = getattr(records[entity], key, None)
+            if column_type == 'category':
+                codes = self.category_codes[name]
+                if value == None:
+                    value = ''
+                value = str(value)
+                code = codes.get(value)
+                if code == None:
+                    code = len(codes)
+                    codes[value] = code
+                self.buffers[name].append(code)
+            elif column_type == 'bool':
+                self.buffers[name].append(value in (True, 'true', 'True', 1))
+            elif value == None:
+                self.buffers[name].append(column_types[column_type][2])
+            elif column_type == 'int':
+                self.buffers[name].append(int(value))
+            else:
+                self.buffers[name].append(float(value))
+
+    def build(self):
+        '''
+        Return a ParticipantTable of the rows collected so far
+        '''
+        columns = OrderedDict()
+        categories = {}
+        for name, source, key, column_type in self.schema:
+            columns[name] = np.frombuffer(self.buffers[name], dtype = np.dtype(self.buffers[name].typecode)).astype(column_types[column_type][1])
+            if column_type == 'category':
+                categories[name] = list(self.category_codes[name].keys())
+        return(ParticipantTable(columns = columns, categories = categories, schema = self.schema))
+
+
+def iter_payloads(input_path):
+    '''
+    Yield the API payloads from a match store directory, a saved_matches directory, or a JSON payload file
+    '''
+    if os.path.isdir(input_path) and os.path.exists(os.path.join(input_path, 'index.tsv')):
+        from store import MatchStore
+        for payload in MatchStore(input_path).iter_matches():
+            yield(payload)
+    elif os.path.isdir(input_path):
+        from store import load_saved_match
+        for match_file in sorted(name for name in os.listdir(input_path) if name.endswith('_data.json')):
+            yield(load_saved_match(input_path, match_file))
+    else:
+        import jsonstream
+        for payload in jsonstream.iter_match_payloads(input_path, in_order = True):
+            yield(payload)
+
+def build_participant_table(input_paths):
+    '''
+    Build a ParticipantTable from every payload in the given inputs
+    '''
+    builder = ParticipantTableBuilder()
+    for input_path in input_paths:
+        for payload in iter_payloads(input_path):
+            builder.add_payload(payload)
+    return(builder.build())
+
+def run():
+    '''
+    Arg parsing for the script when run from command line
+    '''
+    import time
+    parser = argparse.ArgumentParser(description='Build a columnar participant stats table from harvested matches')
+    parser.add_argument("input_paths", nargs = '+', help="Match store directories, saved_matches directories, or API payload JSON files")
+    parser.add_argument("-o", default = 'participants.vcol', type = str, dest = 'output_file', metavar = 'output_file', help="Output table file")
+    args = parser.parse_args()
+    start_time = time.time()
+    table = build_participant_table(args.input_paths)
+    table.save(args.output_file)
+    print('Saved {0} participant rows to {1} in {2:.2f}s'.format(len(table), args.output_file, time.time() - start_time))
+
+if __name__ == "__main__":
+    run()
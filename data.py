@@ -5,6 +5,8 @@ Set up data to use in the app
 Functions for manipulating the app data
 and functions that need direct access to the global data objects
 '''
+import time
+import threading
 import logging
 logger = logging.getLogger("data")
 
@@ -20,33 +22,194 @@ import pandas as pd
 # app modules
 import tools as vt
 import gamelocker
+import httpcache
 
 # ~~~~~ DATA SETUP ~~~~~ #
-# API data
-logger.debug("Reading API key from file")
-key = vt.get_api_key(keyfile = "key.txt")
-logger.debug("Querying API for game data")
-api = gamelocker.Gamelocker(key).Vainglory()
-matches = api.matches({"page[limit]": 5}) #  "filter[playerNames]": "TheLegend27"
+class MatchSnapshot(object):
+    '''
+    One complete set of API matches for the app
+    Snapshots are never changed after they are made; a refresh builds a new one and swaps it in,
+    so callbacks that read 'snapshot' once always see a consistent set of matches
+    '''
+    def __init__(self, matches = [], loaded_at = None, refresh_seconds = None):
+        self.matches = matches
+        self.api_matches = [x.id for x in matches]
+        self.match_index = vt.index_glmatches(matches)
+        self.loaded_at = loaded_at
+        self.refresh_seconds = refresh_seconds
+
+# API data; loaded and refreshed in the background by the MatchRefresher so the app server can start right away
+snapshot = MatchSnapshot()
 
 # placeholder for the roster df
 roster_df = None
 
 # vt.save_pydata(data = matches, outfile = "matches.pickle")
 
-api_matches = [x.id for x in matches]
+# per-match view data shared by the api-match-selection callbacks
+match_views = vt.LRUCache(max_size = 32)
+
+
+class MatchRefresher(object):
+    '''
+    Polls the API for new matches in a background thread, and swaps in a new snapshot after each query
+    With a httpcache.ResponseCache, queries repeated within the cache's time to live are answered from the cache
+    '''
+    def __init__(self, keyfile = "key.txt", interval = 300, query = {"page[limit]": 5}, cache = None):
+        self.keyfile = keyfile
+        self.interval = interval
+        self.query = query # e.g. "filter[playerNames]": "TheLegend27"
+        self.cache = cache
+        self.api = None
+        self.error = None
+        self.num_refreshes = 0
+        self.wake = threading.Event()
+        self.thread = None
+        self.start_lock = threading.RLock()
+
+    def connect(self):
+        logger.debug("Reading API key from file")
+        key = vt.get_api_key(keyfile = self.keyfile)
+        self.api = gamelocker.Gamelocker(key).Vainglory()
+        if self.cache != None:
+            httpcache.cache_gamelocker(self.api, self.cache)
+
+    def refresh(self):
+        '''
+        Query the API and swap in a new snapshot of matches; the old snapshot is kept if the query fails
+        '''
+        global snapshot
+        start_time = time.time()
+        try:
+            if self.api == None:
+                self.connect()
+            logger.debug("Querying API for game data")
+            new_matches = self.api.matches(self.query)
+            refresh_seconds = time.time() - start_time
+            snapshot = MatchSnapshot(matches = new_matches, loaded_at = time.time(), refresh_seconds = refresh_seconds)
+            match_views.clear()
+            self.error = None
+            logger.info("API match refresh finished in {0:.2f}s; {1} matches".format(refresh_seconds, len(snapshot.api_matches)))
+            if self.cache != None:
+                logger.debug("Response cache: %s", self.cache.stats())
+        except Exception as e:
+            logger.exception("API match refresh failed")
+            self.error = str(e)
+        self.num_refreshes += 1
+
+    def run(self):
+        while True:
+            self.refresh()
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def start(self):
+        '''
+        Start polling in a daemon thread; the first query runs right away
+        Only the first call starts a thread, so it can be called on every request
+        '''
+        with self.start_lock:
+            if self.thread != None:
+                return(self)
+            self.thread = threading.Thread(target = self.run, name = 'api-match-refresher')
+            self.thread.daemon = True
+            self.thread.start()
+        return(self)
+
+    def request_refresh(self):
+        '''
+        Ask the background thread to refresh now instead of waiting for the next interval
+        '''
+        self.wake.set()
+
+    def status(self):
+        '''
+        Return the refresh status, including how long the last query took and how old the current snapshot is
+        '''
+        current = snapshot
+        staleness = None
+        if current.loaded_at != None:
+            staleness = time.time() - current.loaded_at
+        return({
+        'loaded': self.num_refreshes > 0,
+        'error': self.error,
+        'num_matches': len(current.api_matches),
+        'refresh_seconds': current.refresh_seconds,
+        'staleness': staleness,
+        'interval': self.interval,
+        'cache': self.cache.stats() if self.cache != None else None
+        })
+
+# started by the app on its first request, with start_background_load()
+refresher = MatchRefresher()
 
 # ~~~~~ DATA FUNCTIONS ~~~~~ #
-def make_api_roster_df(match_id):
+def start_background_load(keyfile = "key.txt", interval = 300, cache_file = None, cache_ttl = 60):
+    '''
+    Start loading and refreshing the API matches in a background thread; does nothing once it has started
+    cache_file is an optional on-disk response cache for the API queries
+    '''
+    global refresher
+    with refresher.start_lock:
+        if refresher.thread != None:
+            return(refresher)
+        refresher.keyfile = keyfile
+        refresher.interval = interval
+        if cache_file != None:
+            refresher.cache = httpcache.ResponseCache(cache_file, ttl = cache_ttl)
+        return(refresher.start())
+
+def get_api_match(match_id):
+    '''
+    Return the match with the given ID from the current snapshot, or None
+    '''
+    return(vt.get_glmatch(data = snapshot.match_index, match_id = match_id))
+
+def make_api_roster_df(match):
     '''
     Return a df for the roster of an API quieried match
     '''
-    global matches
-    logger.debug("Match id: {0}".format(match_id))
-    logger.debug("Retreiving specified match from data set")
-    match = vt.get_glmatch(data = matches, match_id = match_id)
+    logger.debug("Match id: {0}".format(match.id))
     logger.debug("Making roster df")
     roster_df_list = [pd.DataFrame.from_dict(item.stats, orient='index') for item in match.rosters]
     roster_df = pd.concat(roster_df_list, axis=1).transpose()
-    logger.debug(roster_df)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(roster_df)
     return(roster_df)
+
+def make_api_stats_df(match):
+    '''
+    Return a df of the player and participant stats for an API queried match, ready for display
+    '''
+    stats_df = vt.make_glparticipant_stats_df(match = match)
+    # add numbers column
+    stats_df[''] = stats_df.index
+    return(stats_df)
+
+def build_match_view(match):
+    '''
+    Build everything the api-match-selection callbacks need for a match
+    '''
+    logger.debug("Building match view for match: {0}".format(match.id))
+    roster_df = make_api_roster_df(match = match)
+    view = {
+    'match': match,
+    'roster_df': roster_df,
+    'stats_df': make_api_stats_df(match = match),
+    'plot_types': [c for c in roster_df.columns if c != 'side'],
+    'roster_ids': [roster.id for roster in match.rosters]
+    }
+    return(view)
+
+def get_match_view(match_id):
+    '''
+    Return the cached view for a match, building it on the first request
+    Returns None if the match is not in the current snapshot
+    '''
+    global match_views
+    match = get_api_match(match_id)
+    if match == None:
+        return(None)
+    view = match_views.get(match_id, builder = lambda match_id: build_match_view(match = match))
+    logger.debug("Match view cache: %s", match_views.stats())
+    return(view)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+On-disk cache of API responses
+
+Responses are kept in a SQLite file, keyed by URL and query parameters (in a fixed order, so the same query
+always has the same key). A match looked up by ID never changes, so it is kept until it is evicted;
+match searches and other queries expire after a short time, and the start of a search window is rounded down to the time to live,
+so the same search repeated within it is answered from the cache. When the cache grows past its size limit,
+the least recently used responses are evicted.
+
+>>> cache = ResponseCache('http_cache.db', max_bytes = 256 * 1024 * 1024, ttl = 60)
+>>> body = cache.get(url, params)      # None on a miss
+>>> cache.put(url, params, body)
+>>> cache.stats()
+'''
+from __future__ import print_function, division
+import re
+import json
+import time
+import calendar
+import sqlite3
+import threading
+try:
+    from urllib.parse import urlparse, parse_qsl, urlencode
+except ImportError: # Python 2
+    from urlparse import urlparse, parse_qsl
+    from urllib import urlencode
+
+schema = [
+'''CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    body BLOB,
+    size INTEGER,
+    stored REAL,
+    permanent INTEGER,
+    last_used REAL
+)''',
+'CREATE INDEX IF NOT EXISTS responses_by_use ON responses (last_used)',
+]
+
+# API URLs of single matches, e.g. .../shards/na/matches/<match ID>
+match_url_pattern = re.compile(r'/matches/[^/?]+/?$')
+
+# query parameters with a time that moves with the clock, e.g. the start of a search window a number of days back
+time_params = ('filter[createdAt-start]', 'filter[createdAt-end]')
+time_format = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def round_time(value, seconds):
+    '''
+    Round an API time, e.g. '2017-07-01T01:02:22Z', down to a whole number of seconds since the epoch
+    Values that are not API times are returned as they are
+    '''
+    try:
+        timestamp = calendar.timegm(time.strptime(value, time_format))
+    except ValueError:
+        return(value)
+    return(time.strftime(time_format, time.gmtime(timestamp - timestamp % seconds)))
+
+def cache_key(url, params = None, time_step = None):
+    '''
+    Return the cache key for a request: the URL without its query, and every query parameter in sorted order
+    With a time_step, the search window times are rounded down to it, so the same search repeated within time_step seconds has the same key
+    '''
+    url_parts = urlparse(url)
+    query = parse_qsl(url_parts.query)
+    if params != None:
+        query.extend((str(key), str(value)) for key, value in params.items())
+    if time_step != None and time_step > 0:
+        query = [(key, round_time(value, time_step) if key in time_params else value) for key, value in query]
+    base_url = url_parts._replace(query = '').geturl()
+    if len(query) < 1:
+        return(base_url)
+    return('{0}?{1}'.format(base_url, urlencode(sorted(query))))
+
+def never_expires(url):
+    '''
+    True for the URLs of responses that never change: matches looked up by ID
+    '''
+    return(match_url_pattern.search(urlparse(url).path) != None)
+
+
+class ResponseCache(object):
+    '''
+    Size-bounded on-disk cache of response bodies, with a time to live for queries that can change
+    Safe to share between threads
+    '''
+    def __init__(self, path = 'http_cache.db', max_bytes = 256 * 1024 * 1024, ttl = 60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        for statement in schema:
+            self.connection.execute(statement)
+        self.connection.commit()
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stores = 0
+        self.evictions = 0
+        self.hit_bytes = 0
+        # the size limit might be lower than when the cache was filled
+        with self.lock:
+            self.evict()
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return(self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0])
+
+    def get(self, url, params = None):
+        '''
+        Return the cached body for a request, or None if it is not cached or is older than the time to live
+        '''
+        key = cache_key(url, params, time_step = self.ttl)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT body, size, stored, permanent FROM responses WHERE key = ?', (key,)).fetchone()
+            if row == None:
+                self.misses += 1
+                return(None)
+            body, size, stored, permanent = row
+            if not permanent and stored + self.ttl <= now:
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.connection.commit()
+                self.size -= size
+                self.expired += 1
+                self.misses += 1
+                return(None)
+            self.connection.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, key))
+            self.connection.commit()
+            self.hits += 1
+            self.hit_bytes += size
+        return(bytes(body))
+
+    def put(self, url, params, body):
+        '''
+        Cache the body of a successful response, then evict the least recently used responses if the cache is too big
+        '''
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        if len(body) > self.max_bytes:
+            return(False)
+        key = cache_key(url, params, time_step = self.ttl)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if row != None:
+                self.size -= row[0]
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (key, sqlite3.Binary(body), len(body), now, never_expires(url), now))
+            self.size += len(body)
+            self.stores += 1
+            self.evict()
+            self.connection.commit()
+        return(True)
+
+    def evict(self):
+        '''
+        Delete the least recently used responses until the cache fits in max_bytes; call with the lock held
+        '''
+        while self.size > self.max_bytes:
+            rows = self.connection.execute('SELECT key, size FROM responses ORDER BY last_used LIMIT 64').fetchall()
+            if len(rows) < 1:
+                break
+            for key, size in rows:
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= size
+                self.evictions += 1
+                if self.size <= self.max_bytes:
+                    break
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM responses')
+            self.connection.commit()
+            self.size = 0
+
+    def stats(self):
+        '''
+        Return the hit, miss, store and eviction counters since the cache was opened, and the cache size
+        '''
+        lookups = self.hits + self.misses
+        return({
+        'hits': self.hits,
+        'misses': self.misses,
+        'expired': self.expired,
+        'hit_rate': self.hits / lookups if lookups > 0 else None,
+        'hit_bytes': self.hit_bytes,
+        'stores': self.stores,
+        'evictions': self.evictions,
+        'bytes': self.size,
+        'max_bytes': self.max_bytes
+        })
+
+    def print_stats(self):
+        stats = self.stats()
+        hit_rate = '{0:.1f}%'.format(stats['hit_rate'] * 100) if stats['hit_rate'] != None else 'n/a'
+        print('Response cache: {0} hits, {1} misses ({2} expired), hit rate {3}, {4} stored, {5} evicted'.format(
+        stats['hits'], stats['misses'], stats['expired'], hit_rate, stats['stores'], stats['evictions']))
+        print('Response cache: {0:.1f} MB served from cache, {1:.1f} MB of {2:.1f} MB used: {3}'.format(
+        stats['hit_bytes'] / 1e6, stats['bytes'] / 1e6, stats['max_bytes'] / 1e6, self.path))
+
+
+class CachedResponse(object):
+    '''
+    Stands in for a requests response served from the cache
+    '''
+    status_code = 200
+
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+        self.headers = {}
+        self.from_cache = True
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return(json.loads(self.content.decode('utf-8')))
+
+    def iter_content(self, chunk_size = 1, decode_unicode = False):
+        for start in range(0, len(self.content), chunk_size):
+            yield(self.content[start:start + chunk_size])
+
+
+def record_stream(response, store):
+    '''
+    Make a streamed response pass its body to store() once it has been read to the end
+    '''
+    iter_content = response.iter_content
+    def recording_iter_content(chunk_size = 1, decode_unicode = False):
+        chunks = []
+        source = iter_content(chunk_size = chunk_size, decode_unicode = decode_unicode)
+        try:
+            for chunk in source:
+                chunks.append(chunk)
+                yield(chunk)
+        except GeneratorExit:
+            # the reader stopped early, e.g. jsonstream at the end of the payload; read the rest so the whole body is cached
+            try:
+                chunks.extend(source)
+            except Exception:
+                return
+            store(b''.join(chunks))
+            raise
+        store(b''.join(chunks))
+    response.iter_content = recording_iter_content
+    return(response)
+
+
+def cache_gamelocker(api, cache):
+    '''
+    Route the requests of a gamelocker API object through the cache
+    gamelocker sends every request to api._apiurl + endpoint through api._req(endpoint, params) and returns the parsed JSON
+    '''
+    request = api._req
+    def _req(endpoint, params = None):
+        url = api._apiurl + endpoint
+        body = cache.get(url, params)
+        if body != None:
+            return(json.loads(body.decode('utf-8')))
+        data = request(endpoint, params)
+        cache.put(url, params, json.dumps(data))
+        return(data)
+    api._req = _req
+    return(api)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Streaming reader for Gamelocker JSON:API payloads
+
+Reads a payload from a file or an HTTP response body a chunk at a time,
+and yields the 'data' matches and 'included' items one at a time as they are parsed,
+so that large payloads and harvest files never have to be held in memory whole.
+
+>>> for section, item in iter_payload_items('demo-data.txt'): print(section, item['type'], item['id'])
+>>> for match_payload in iter_match_payloads(response): store.put_many([match_payload])
+'''
+import json
+import codecs
+from collections import OrderedDict, deque
+
+from payload import relationship_ids
+
+decoder = json.JSONDecoder()
+whitespace = ' \t\n\r'
+
+
+class PayloadStream(object):
+    '''
+    Incremental parser for the top level of a JSON:API payload
+    Only the current item and the unparsed part of the current chunk are kept in memory
+    '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        # top level values other than 'data' and 'included', e.g. 'links' and 'meta'
+        self.other = {}
+
+    def read_more(self):
+        '''
+        Add the next chunk to the buffer; returns False at the end of the input
+        '''
+        if self.eof:
+            return(False)
+        # drop the part of the buffer that has already been parsed
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.utf8.decode(chunk)
+            if len(chunk) > 0:
+                self.buffer += chunk
+                return(True)
+        self.eof = True
+        return(False)
+
+    def peek(self):
+        '''
+        Skip whitespace and return the next character, or None at the end of the input
+        '''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return(self.buffer[self.pos])
+            if not self.read_more():
+                return(None)
+
+    def expect(self, chars):
+        '''
+        Consume the next character, which must be one of chars
+        '''
+        char = self.peek()
+        if char == None or char not in chars:
+            raise ValueError('Expected one of {0!r} at position {1}, found {2!r}'.format(chars, self.pos, char))
+        self.pos += 1
+        return(char)
+
+    def value(self):
+        '''
+        Decode the next complete JSON value, reading more chunks as needed
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return(value)
+            except ValueError:
+                if self.eof:
+                    raise
+            if not self.read_more() and not self.eof:
+                raise ValueError('Unexpected end of JSON input')
+
+    def items(self):
+        '''
+        Yield ('data', match) and ('included', item) pairs in document order
+        '''
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if key in ('data', 'included') and self.peek() == '[':
+                self.pos += 1
+                if self.peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield(key, self.value())
+                        if self.expect(',]') == ']':
+                            break
+            else:
+                value = self.value()
+                if key == 'data' and isinstance(value, dict):
+                    # a match ID lookup has a single match as its 'data'
+                    yield(key, value)
+                else:
+                    self.other[key] = value
+            if self.expect(',}') == '}':
+                return
+
+    def array_items(self):
+        '''
+        Yield the values of a top level JSON array, e.g. the events of a telemetry file
+        '''
+        self.expect('[')
+        if self.peek() == ']':
+            return
+        while True:
+            yield(self.value())
+            if self.expect(',]') == ']':
+                return
+
+
+def iter_chunks(source, chunk_size = 65536):
+    '''
+    Yield chunks of text or bytes from a file path, an open file, or an HTTP response
+    '''
+    if hasattr(source, 'iter_content'):
+        # requests response; should be requested with stream=True
+        for chunk in source.iter_content(chunk_size = chunk_size):
+            yield(chunk)
+    elif hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield(chunk)
+    else:
+        with open(source, 'rb') as f:
+            for chunk in iter_chunks(f, chunk_size = chunk_size):
+                yield(chunk)
+
+def iter_payload_items(source, chunk_size = 65536):
+    '''
+    Yield ('data', match) and ('included', item) pairs from a payload file, open file, or HTTP response
+    '''
+    stream = PayloadStream(iter_chunks(source, chunk_size = chunk_size))
+    for section, item in stream.items():
+        yield(section, item)
+
+def iter_array_items(source, chunk_size = 65536):
+    '''
+    Yield the values of a JSON array file, open file, or HTTP response
+    '''
+    stream = PayloadStream(iter_chunks(source, chunk_size = chunk_size))
+    for value in stream.array_items():
+        yield(value)
+
+def iter_match_payloads(source, chunk_size = 65536, in_order = False):
+    '''
+    Yield a single-match payload ({'data': match, 'included': [...]}) for each match in a streamed payload,
+    as soon as all of the match's rosters, participants, players and assets have been read,
+    or in the payload's match order if in_order = True
+    Rosters, participants and assets belong to a single match, so they are dropped once their match is done;
+    players can be shared between matches, so they are kept (once each) until the end of the payload
+    '''
+    matches = {} # unfinished match ID -> match
+    match_keys = {} # unfinished match ID -> (type, id) of its included items, in relationship order
+    missing = {} # unfinished match ID -> set of (type, id) not read yet
+    waiting = {} # (type, id) -> unfinished match IDs waiting for it
+    refs = {} # (type, id) -> number of unfinished matches that refer to it
+    items = {}
+    order = deque() # match IDs in payload order
+    finished = {} # match ID -> single-match payload waiting for earlier matches when in_order = True
+
+    def add_ref(match_id, key):
+        if key in match_keys[match_id]:
+            return
+        match_keys[match_id][key] = True
+        refs[key] = refs.get(key, 0) + 1
+        if key in items:
+            for child in children(items[key]):
+                add_ref(match_id, child)
+        else:
+            missing[match_id].add(key)
+            waiting.setdefault(key, []).append(match_id)
+
+    def children(item):
+        return(relationship_ids(item, 'participants') + relationship_ids(item, 'player'))
+
+    def finish(match_id):
+        included = [items[key] for key in match_keys[match_id] if key in items]
+        match_payload = {'data': matches.pop(match_id), 'included': included}
+        for key in match_keys.pop(match_id):
+            refs[key] -= 1
+            if refs[key] < 1:
+                del refs[key]
+                if key[0] != 'player':
+                    items.pop(key, None)
+        del missing[match_id]
+        return(match_payload)
+
+    for section, item in iter_payload_items(source, chunk_size = chunk_size):
+        key = (item['type'], item['id'])
+        if section == 'data':
+            match_id = item['id']
+            matches[match_id] = item
+            match_keys[match_id] = OrderedDict()
+            missing[match_id] = set()
+            for child in relationship_ids(item, 'rosters') + relationship_ids(item, 'assets'):
+                add_ref(match_id, child)
+            order.append(match_id)
+            if len(missing[match_id]) == 0:
+                finished[match_id] = finish(match_id)
+        else:
+            waiting_ids = waiting.pop(key, [])
+            items[key] = item
+            for match_id in waiting_ids:
+                missing[match_id].discard(key)
+                for child in children(item):
+                    add_ref(match_id, child)
+            for match_id in waiting_ids:
+                if match_id in missing and len(missing[match_id]) == 0:
+                    finished[match_id] = finish(match_id)
+        if in_order == False:
+            for match_id in list(finished.keys()):
+                order.remove(match_id)
+                yield(finished.pop(match_id))
+        while len(order) > 0 and order[0] in finished:
+            yield(finished.pop(order.popleft()))
+    # the rest of the matches, including any with items that are not in the payload
+    for match_id in order:
+        if match_id in finished:
+            yield(finished.pop(match_id))
+        else:
+            yield(finish(match_id))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Local SQLite index of harvested matches, for player and match lookups without the API
+
+Keeps one row per match (ID, time, game mode, region, and the saved_matches or store directory it was saved to),
+and one row per participant (player name and ID, hero, side, winner), kept up to date by the harvest.
+vainstats.py --offline answers -n/-d/-p and -m lookups from the index, and only asks the API when nothing is found.
+
+Index existing harvests with:
+./matchindex.py saved_matches match_store
+'''
+from __future__ import print_function
+import os
+import time
+import sqlite3
+import argparse
+
+import records
+from payload import PayloadIndex
+
+schema = [
+'''CREATE TABLE IF NOT EXISTS matches (
+    match_id TEXT PRIMARY KEY,
+    createdAt TEXT,
+    duration INTEGER,
+    gameMode TEXT,
+    patchVersion TEXT,
+    shardId TEXT,
+    endGameReason TEXT,
+    queue TEXT,
+    source TEXT
+)''',
+'''CREATE TABLE IF NOT EXISTS participants (
+    match_id TEXT,
+    player_id TEXT,
+    player_name TEXT,
+    hero TEXT,
+    side TEXT,
+    winner INTEGER,
+    createdAt TEXT,
+    gameMode TEXT,
+    shardId TEXT,
+    PRIMARY KEY (match_id, player_id)
+)''',
+'CREATE INDEX IF NOT EXISTS participants_by_name ON participants (player_name, createdAt)',
+'CREATE INDEX IF NOT EXISTS participants_by_player_id ON participants (player_id, createdAt)',
+'CREATE INDEX IF NOT EXISTS matches_by_time ON matches (shardId, createdAt)',
+]
+
+# the Match record fields kept in the matches table, in column order after match_id
+match_columns = ['createdAt', 'duration', 'gameMode', 'patchVersion', 'shardId', 'endGameReason', 'queue']
+
+
+class MatchIndex(object):
+    '''
+    SQLite index of the matches and participants of harvested matches
+
+    >>> index = MatchIndex('match_index.db')
+    >>> index.add_payload(payload, source = 'saved_matches')
+    >>> index.player_matches('eLiza', search_time = '2017-07-01T00:00:00Z', limit = 3)
+    >>> index.load_payload(match_id)
+    '''
+    def __init__(self, path = 'match_index.db'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        for statement in schema:
+            self.connection.execute(statement)
+        self.connection.commit()
+        self.stores = {}
+
+    def __len__(self):
+        return(self.connection.execute('SELECT COUNT(*) FROM matches').fetchone()[0])
+
+    def __contains__(self, match_id):
+        return(self.connection.execute('SELECT 1 FROM matches WHERE match_id = ?', (match_id,)).fetchone() != None)
+
+    def close(self):
+        self.connection.close()
+
+    # ~~~~~ ADDING MATCHES ~~~~~ #
+    def add_match(self, match, source = None):
+        '''
+        Add or replace a Match record, and its participants
+        source is the saved_matches or match store directory the match was saved to
+        '''
+        self.connection.execute('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [match.id] + [getattr(match, column) for column in match_columns] + [source])
+        rows = []
+        for roster in match.rosters:
+            for participant in roster.participants:
+                player = participant.player
+                rows.append((match.id, player.id if player != None else participant.id, player.name if player != None else None,
+                participant.actor, roster.side, participant.winner, match.createdAt, match.gameMode, match.shardId))
+        self.connection.executemany('INSERT OR REPLACE INTO participants VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def add_payload(self, payload, source = None, commit = True):
+        '''
+        Add every match in an API payload
+        Returns the number of matches added
+        '''
+        index = PayloadIndex(payload)
+        for match_id in index.match_ids:
+            self.add_match(records.match_record(index, match_id), source = source)
+        if commit == True:
+            self.connection.commit()
+        return(len(index.match_ids))
+
+    # ~~~~~ LOOKUPS ~~~~~ #
+    def match_row(self, match_id):
+        return(self.connection.execute('SELECT * FROM matches WHERE match_id = ?', (match_id,)).fetchone())
+
+    def match(self, match_id):
+        '''
+        Return a Match record (without rosters) for an indexed match, or None
+        '''
+        row = self.match_row(match_id)
+        if row == None:
+            return(None)
+        return(records.Match(*row[:len(match_columns) + 1]))
+
+    def player_matches(self, player_name = None, search_time = None, limit = 3, region = None):
+        '''
+        Return Match records for the newest matches since search_time, of a player if a name is given, newest first
+        region is one region, or a list of regions
+        The same query as an API match search with filter[playerNames], filter[createdAt-start] and page[limit]
+        '''
+        conditions = []
+        values = []
+        if player_name != None:
+            conditions.append('match_id IN (SELECT match_id FROM participants WHERE player_name = ?)')
+            values.append(player_name)
+        if search_time != None:
+            conditions.append('createdAt >= ?')
+            values.append(search_time)
+        if isinstance(region, list):
+            conditions.append('shardId IN ({0})'.format(', '.join('?' * len(region))))
+            values.extend(region)
+        elif region != None:
+            conditions.append('shardId = ?')
+            values.append(region)
+        query = 'SELECT * FROM matches'
+        if len(conditions) > 0:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY createdAt DESC LIMIT ?'
+        values.append(limit)
+        return([records.Match(*row[:len(match_columns) + 1]) for row in self.connection.execute(query, values)])
+
+    def participants(self, match_id):
+        '''
+        Return (player name, hero, side, winner) for the participants of a match
+        '''
+        return(self.connection.execute('SELECT player_name, hero, side, winner FROM participants WHERE match_id = ? ORDER BY side, player_name', (match_id,)).fetchall())
+
+    def load_payload(self, match_id):
+        '''
+        Return the saved single-match payload for an indexed match, or None if it is not in the index or its files are gone
+        '''
+        row = self.match_row(match_id)
+        if row == None or row[-1] == None:
+            return(None)
+        source = row[-1]
+        if os.path.exists(os.path.join(source, 'index.tsv')):
+            from store import MatchStore
+            if source not in self.stores:
+                self.stores[source] = MatchStore(source)
+            return(self.stores[source].get(match_id))
+        if not os.path.exists(os.path.join(source, match_id + '_data.json')):
+            return(None)
+        from store import load_saved_match
+        return(load_saved_match(source, match_id + '_data.json'))
+
+
+# ~~~~~ INDEX EXISTING HARVESTS ~~~~~ #
+def index_harvest(index, input_dir):
+    '''
+    Add every match in a saved_matches or match store directory to the index
+    Returns the number of matches added
+    '''
+    import columnar
+    num_matches = 0
+    for payload in columnar.iter_payloads(input_dir):
+        num_matches += index.add_payload(payload, source = input_dir, commit = False)
+    index.connection.commit()
+    return(num_matches)
+
+def run():
+    '''
+    Arg parsing for the script when run from command line
+    '''
+    parser = argparse.ArgumentParser(description='Index harvested matches for offline lookups with vainstats.py --offline')
+    parser.add_argument("input_dirs", nargs = '+', help="saved_matches or match store directories")
+    parser.add_argument("--index-file", default = 'match_index.db', type = str, dest = 'index_file', metavar = 'index_file', help="SQLite index file to add the matches to")
+    args = parser.parse_args()
+    index = MatchIndex(args.index_file)
+    for input_dir in args.input_dirs:
+        start_time = time.time()
+        num_matches = index_harvest(index, input_dir)
+        print('Indexed {0} matches from {1} in {2:.2f}s'.format(num_matches, input_dir, time.time() - start_time))
+    print('{0} matches in {1}'.format(len(index), args.index_file))
+    index.close()
+
+if __name__ == "__main__":
+    run()
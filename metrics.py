@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Latency metrics for the app
+
+Records the wall time, number of calls and number of errors of instrumented functions as histograms,
+and formats them for the app's /metrics route, in the Prometheus text format or as JSON.
+
+>>> registry.instrument_module(tools)       # every function defined in tools.py
+>>> @registry.timed('callback.update_roster_table')
+... def update_roster_table(match_id): ...
+>>> print(registry.prometheus_text())
+'''
+import time
+import bisect
+import threading
+import functools
+from collections import OrderedDict
+
+# upper bounds of the histogram buckets, in seconds
+default_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    '''
+    Counts of call times in fixed buckets, with the total time and the number of errors
+    '''
+    def __init__(self, buckets = default_buckets):
+        self.buckets = list(buckets)
+        # the last count is for times over the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, error = False):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+            if error == True:
+                self.errors += 1
+
+    def cumulative_counts(self):
+        '''
+        Return (upper bound, number of calls that took at most that long) for each bucket, ending with +Inf
+        '''
+        with self.lock:
+            counts = list(self.counts)
+        total = 0
+        cumulative = []
+        for bound, count in zip(self.buckets + [float('inf')], counts):
+            total += count
+            cumulative.append((bound, total))
+        return(cumulative)
+
+    def quantile(self, q):
+        '''
+        Return the upper bound of the bucket that holds the q quantile of the call times
+        '''
+        cumulative = self.cumulative_counts()
+        target = q * cumulative[-1][1]
+        for bound, total in cumulative:
+            if total >= target and total > 0:
+                return(bound if bound != float('inf') else self.max)
+        return(None)
+
+    def to_dict(self):
+        with self.lock:
+            count, total, errors, max_seconds = self.count, self.sum, self.errors, self.max
+        return(OrderedDict([
+        ('count', count),
+        ('errors', errors),
+        ('sum', total),
+        ('mean', total / count if count > 0 else None),
+        ('max', max_seconds),
+        ('p50', self.quantile(0.5)),
+        ('p90', self.quantile(0.9)),
+        ('p99', self.quantile(0.99)),
+        ('buckets', [[bound if bound != float('inf') else '+Inf', total] for bound, total in self.cumulative_counts()])
+        ]))
+
+
+class Registry(object):
+    '''
+    Histograms of call times, by name
+    '''
+    def __init__(self, buckets = default_buckets):
+        self.buckets = buckets
+        self.histograms = OrderedDict()
+        self.lock = threading.Lock()
+
+    def histogram(self, name):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(buckets = self.buckets)
+            return(self.histograms[name])
+
+    def timed(self, name):
+        '''
+        Decorator that records the call times and errors of a function under the given name
+        '''
+        def decorator(function):
+            histogram = self.histogram(name)
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start_time = timer()
+                error = True
+                try:
+                    result = function(*args, **kwargs)
+                    error = False
+                    return(result)
+                except Exception as exception:
+                    # exceptions used for control flow, like tools.PreventUpdate, set timed_error = False
+                    error = getattr(exception, 'timed_error', True)
+                    raise
+                finally:
+                    histogram.observe(timer() - start_time, error = error)
+            wrapper.timed_function = function
+            return(wrapper)
+        return(decorator)
+
+    def instrument_module(self, module, prefix = None):
+        '''
+        Replace every function defined in a module with a timed version, named <prefix>.<function name>
+        Calls between the module's own functions go through the module globals, so they are timed too
+        Returns the names of the instrumented functions
+        '''
+        import inspect
+        if prefix == None:
+            prefix = module.__name__
+        names = []
+        for name, function in list(vars(module).items()):
+            if not inspect.isfunction(function) or function.__module__ != module.__name__:
+                continue
+            if hasattr(function, 'timed_function'):
+                continue
+            setattr(module, name, self.timed('{0}.{1}'.format(prefix, name))(function))
+            names.append(name)
+        return(names)
+
+    def instrument_callbacks(self, app, prefix = 'callback'):
+        '''
+        Make app.callback time every callback registered after this, named <prefix>.<function name>
+        '''
+        register_callback = app.callback
+        def callback(*args, **kwargs):
+            register = register_callback(*args, **kwargs)
+            def decorator(function):
+                return(register(self.timed('{0}.{1}'.format(prefix, function.__name__))(function)))
+            return(decorator)
+        app.callback = callback
+
+    def called(self):
+        '''
+        Return (name, histogram) for every instrumented function that has been called
+        '''
+        with self.lock:
+            return([(name, histogram) for name, histogram in self.histograms.items() if histogram.count > 0])
+
+    def to_dict(self):
+        histograms = self.called()
+        return(OrderedDict((name, histogram.to_dict()) for name, histogram in histograms))
+
+    def prometheus_text(self, metric = 'vainstats_call_seconds'):
+        '''
+        Return the histograms in the Prometheus text format
+        '''
+        histograms = self.called()
+        lines = ['# HELP {0} Wall time of instrumented callbacks and functions'.format(metric), '# TYPE {0} histogram'.format(metric)]
+        for name, histogram in histograms:
+            for bound, total in histogram.cumulative_counts():
+                lines.append('{0}_bucket{{name="{1}",le="{2}"}} {3}'.format(metric, name, '+Inf' if bound == float('inf') else repr(bound), total))
+            lines.append('{0}_sum{{name="{1}"}} {2!r}'.format(metric, name, histogram.sum))
+            lines.append('{0}_count{{name="{1}"}} {2}'.format(metric, name, histogram.count))
+        lines.append('# HELP vainstats_call_errors_total Calls of instrumented callbacks and functions that raised an exception')
+        lines.append('# TYPE vainstats_call_errors_total counter')
+        for name, histogram in histograms:
+            lines.append('vainstats_call_errors_total{{name="{0}"}} {1}'.format(name, histogram.errors))
+        return('\n'.join(lines) + '\n')
+
+# shared registry for the app
+registry = Registry()
@@ -17,14 +17,16 @@ import pandas as pd
 
 # app modules
 import tools as vt
+import records
+import aggregate
 import gamelocker
 
 # ~~~~~ DATA SETUP ~~~~~ #
 # initial datasets for the app
 # demo data
 logger.debug("Loading demo data")
-demo_data = vt.load_json(input_file = "demo-data.txt")
-demo_matches = [x['id'] for x in demo_data['data']]
+demo_index = vt.load_json_index(input_file = "demo-data.txt")
+demo_matches = demo_index.match_ids
 
 
 # ~~~~~ DATA FUNCTIONS ~~~~~ #
@@ -32,19 +34,54 @@ def make_demo_roster_df(match_id):
     '''
     Return a df for the roster of a given match
     '''
-    global demo_data
+    global demo_index
     logger.debug("Match id: {0}".format(match_id))
-    logger.debug("Retreiving specified match from data set")
-    match = vt.get_match(data = demo_data, match_id = match_id)
-    logger.debug("Getting roster ids for the match")
-    rosters_ids = vt.get_roster_ids(match = match)
-    logger.debug("Roster ids: {0}".format(rosters_ids))
     logger.debug("Getting rosters for the match")
-    rosters = vt.get_rosters(roster_ids = rosters_ids, data = demo_data)
-    for item in rosters:
-        logger.debug(item)
+    rosters = demo_index.rosters(match_id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Roster ids: {0}".format([item['id'] for item in rosters]))
+        for item in rosters:
+            logger.debug(item)
     logger.debug("Making roster df")
-    roster_df_list = [pd.DataFrame.from_dict(item['attributes']['stats'], orient='index') for item in rosters]
-    roster_df = pd.concat(roster_df_list, axis=1).transpose()
-    logger.debug(roster_df)
+    roster_df = pd.DataFrame([records.Roster.from_item(item).stats() for item in rosters])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(roster_df)
     return(roster_df)
+
+def make_participant_df(input_paths):
+    '''
+    Return a df of the participant stats for every match in the given payload files, match stores, or .vcol table
+    '''
+    import columnar
+    if len(input_paths) == 1 and input_paths[0].endswith('.vcol'):
+        table = columnar.ParticipantTable.load(input_paths[0])
+    else:
+        table = columnar.build_participant_table(input_paths)
+    logger.debug("Loaded {0} participant rows".format(len(table)))
+    return(table.to_dataframe())
+
+def load_meta_aggregates(path):
+    '''
+    Return the meta tables saved by a harvest, or the tables for the demo data if there are none
+    '''
+    import os
+    if path != None and os.path.exists(path):
+        logger.debug("Loading meta tables from {0}".format(path))
+        return(aggregate.MetaAggregates(path))
+    logger.debug("No meta tables at {0}, using the demo data".format(path))
+    meta_aggregates = aggregate.MetaAggregates()
+    for match_id in demo_index.match_ids:
+        meta_aggregates.add_match(records.match_record(demo_index, match_id))
+    return(meta_aggregates)
+
+def make_meta_df(table):
+    '''
+    Return a df of one of the meta tables, e.g. 'hero'
+    '''
+    return(pd.DataFrame(meta_aggregates.rows(table)))
+
+logger.debug("Making demo participant table")
+demo_participant_df = make_participant_df(input_paths = ["demo-data.txt"])
+
+# hero and meta tables; the app loads the ones saved by the harvest (see --meta-file)
+meta_aggregates = None
@@ -14,6 +14,7 @@ import pandas as pd
 
 import tools as vt
 import offline_data as vod
+import aggregate
 
 # Demo data section
 offline_div = html.Div([
@@ -40,5 +41,18 @@ offline_div = html.Div([
             dcc.Graph(id = 'demo-roster-gold-plot'),
         ])
         ]),
+
+    html.Div([
+        html.H2(children = 'Participant Stats'),
+        vt.table_controls(id = 'demo-participant-table', columns = list(vod.demo_participant_df.columns)),
+        html.Div(id = 'demo-participant-table')
+        ]),
+
+    html.Div([
+        html.H2(children = 'Hero Meta'),
+        html.H3(children = 'Pick a table:'),
+        vt.create_radio_buttons(options = [{'label': table, 'value': table} for table in aggregate.meta_tables.keys()], id = 'demo-meta-table-type', value = 'hero'),
+        html.Div(id = 'demo-meta-table')
+        ]),
 ], id = 'demo-div',
 style = {'width': '48%', 'display': 'inline-block'})
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Functions for indexing Gamelocker JSON:API payloads
+Kept free of the Dash modules so that the command line script can use it too
+'''
+
+def iter_payload_matches(data):
+    '''
+    Yield the match items from a payload; 'data' is a list for match queries
+    and a single dict for match ID lookups
+    '''
+    matches = data.get('data', [])
+    if isinstance(matches, dict):
+        matches = [matches]
+    for item in matches:
+        yield(item)
+
+def relationship_ids(item, relationship):
+    '''
+    Return the (type, id) keys that an item refers to through one of its relationships
+    '''
+    try:
+        refs = item['relationships'][relationship]['data']
+    except (KeyError, TypeError):
+        return([])
+    if refs is None:
+        return([])
+    if isinstance(refs, dict):
+        refs = [refs]
+    return([(ref['type'], ref['id']) for ref in refs])
+
+
+class PayloadIndex(object):
+    '''
+    Index over one or more JSON:API payloads, built once per loaded payload
+    Maps (type, id) to the item, and each match ID to its rosters, participants, players and assets,
+    so that relationship lookups do not need to scan the whole payload
+
+    >>> index = PayloadIndex(demo_data)
+    >>> index.rosters(match_id)
+    [{'type': 'roster', ...}, {'type': 'roster', ...}]
+    '''
+    def __init__(self, data = None):
+        self.items = {}
+        self.match_ids = []
+        self.match_rosters = {}
+        self.match_participants = {}
+        self.match_players = {}
+        self.match_assets = {}
+        if data != None:
+            self.add(data)
+
+    def __len__(self):
+        return(len(self.match_ids))
+
+    def __contains__(self, match_id):
+        return(match_id in self.match_rosters)
+
+    def add(self, data):
+        '''
+        Add the 'included' items and the matches of a payload to the index
+        '''
+        for item in data.get('included', []):
+            self.items[(item['type'], item['id'])] = item
+        new_matches = []
+        for match in iter_payload_matches(data):
+            if match['id'] not in self.match_rosters:
+                self.match_ids.append(match['id'])
+            self.items[(match['type'], match['id'])] = match
+            new_matches.append(match)
+        # resolve the relationships after all items are in place
+        for match in new_matches:
+            self.link_match(match)
+        return(self)
+
+    def link_match(self, match):
+        '''
+        Resolve the rosters, participants, players and assets for a match
+        '''
+        rosters = self.resolve(relationship_ids(match, 'rosters'))
+        participants = []
+        for roster in rosters:
+            participants.extend(self.resolve(relationship_ids(roster, 'participants')))
+        players = []
+        for participant in participants:
+            players.extend(self.resolve(relationship_ids(participant, 'player')))
+        match_id = match['id']
+        self.match_rosters[match_id] = rosters
+        self.match_participants[match_id] = participants
+        self.match_players[match_id] = players
+        self.match_assets[match_id] = self.resolve(relationship_ids(match, 'assets'))
+
+    def resolve(self, keys):
+        '''
+        Return the indexed items for a list of (type, id) keys, skipping any that are not in the payload
+        '''
+        return([self.items[key] for key in keys if key in self.items])
+
+    def get(self, item_type, item_id):
+        '''
+        Return the item with the given type and ID, or None
+        '''
+        return(self.items.get((item_type, item_id)))
+
+    def match(self, match_id):
+        '''
+        Return the match item with the given ID, or None
+        '''
+        return(self.get('match', match_id))
+
+    def matches(self):
+        '''
+        Return the match items, in payload order
+        '''
+        return([self.items[('match', match_id)] for match_id in self.match_ids])
+
+    def roster_ids(self, match_id):
+        return([roster['id'] for roster in self.rosters(match_id)])
+
+    def rosters(self, match_id):
+        return(self.match_rosters.get(match_id, []))
+
+    def participants(self, match_id):
+        return(self.match_participants.get(match_id, []))
+
+    def players(self, match_id):
+        return(self.match_players.get(match_id, []))
+
+    def assets(self, match_id):
+        return(self.match_assets.get(match_id, []))
+
+    def included(self, match_id):
+        '''
+        Return all of the 'included' items that belong to a match
+        '''
+        return(self.rosters(match_id) + self.participants(match_id) + self.players(match_id) + self.assets(match_id))
+
+    def match_payload(self, match_id):
+        '''
+        Return a single-match payload in the same format as a match ID lookup from the API
+        '''
+        return({'data': self.match(match_id), 'included': self.included(match_id)})
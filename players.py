@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Registry of the players in harvested matches
+
+Every match payload includes a full copy of each of its players, so in a large harvest
+the same players are stored and parsed over and over. The registry keeps each player once, keyed by player ID,
+with an integer handle that matches and participants can refer to instead,
+the player's latest stats, and the history of stats changes (by the 'createdAt' of the match they were seen in).
+
+The registry can be saved to an append-only log of JSON lines; new players and stats changes are appended as they are added:
+    {"handle": 0, "id": "...", "seen": "2017-07-01T01:02:22Z", "player": {...}}   # new player
+    {"handle": 0, "seen": "2017-07-02T10:00:00Z", "stats": {...}}                 # new stats for a player
+'''
+import os
+import sys
+import json
+import bisect
+
+
+def deep_sizeof(item):
+    '''
+    Return the approximate memory used by a JSON item, including everything it contains
+    '''
+    size = sys.getsizeof(item)
+    if isinstance(item, dict):
+        size += sum(deep_sizeof(key) + deep_sizeof(value) for key, value in item.items())
+    elif isinstance(item, list):
+        size += sum(deep_sizeof(value) for value in item)
+    return(size)
+
+def item_bytes(item):
+    return(len(json.dumps(item, separators = (',', ':'))))
+
+
+class PlayerRegistry(object):
+    '''
+    Players by ID, each stored once, with an integer handle
+
+    >>> players = PlayerRegistry()
+    >>> handle = players.add(player_item, seen = match['attributes']['createdAt'])
+    >>> players.item(handle)                       # player item with the latest stats
+    >>> players.item(handle, seen = created_at)    # player item with the stats as seen in a match
+    >>> players.stats()                            # how many copies, bytes and memory were saved
+    '''
+    def __init__(self, path = None):
+        self.path = path
+        self.handles = {} # player ID -> handle
+        self.players = {} # handle -> player item, with the latest stats
+        self.history = {} # handle -> [(seen, stats)], sorted by seen, one entry per change
+        self.next_handle = 0
+        # since the registry was opened: the number of references to each player, and the players and stats changes added;
+        # their sizes are only worked out by stats()
+        self.references = {}
+        self.new_players = []
+        self.new_stats = []
+        self.log = None
+        self.log_end = None # end of the last whole line in the log file
+        if path != None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return(len(self.players))
+
+    def __contains__(self, player_id):
+        return(player_id in self.handles)
+
+    def handle(self, player_id):
+        '''
+        Return the handle for a player ID, or None
+        '''
+        return(self.handles.get(player_id))
+
+    def add(self, player, seen = ''):
+        '''
+        Add a player item seen in a match, and return the player's handle
+        The item's stats are recorded in the history if they are different from the stats seen just before them
+        '''
+        stats = player.get('attributes', {}).get('stats') or {}
+        handle = self.handles.get(player['id'])
+        if handle == None:
+            handle = self.next_handle
+            self.put_player(handle, player['id'], player, seen)
+            self.new_players.append(handle)
+            self.write_log({'handle': handle, 'id': player['id'], 'seen': seen, 'player': player})
+        else:
+            self.add_stats(handle, stats, seen)
+        self.references[handle] = self.references.get(handle, 0) + 1
+        return(handle)
+
+    def put_player(self, handle, player_id, player, seen):
+        '''
+        Store a new player at a handle; handles are never reused
+        '''
+        assert handle not in self.players, 'player handle {0} is already used'.format(handle)
+        self.handles[player_id] = handle
+        self.players[handle] = player
+        self.history[handle] = [(seen, player.get('attributes', {}).get('stats') or {})]
+        self.next_handle = max(self.next_handle, handle + 1)
+
+    def add_stats(self, handle, stats, seen, log = True):
+        '''
+        Record a player's stats as seen at a time, if they changed; the newest stats become the player's latest stats
+        '''
+        history = self.history[handle]
+        times = [entry[0] for entry in history]
+        i = bisect.bisect_right(times, seen)
+        if i > 0 and history[i - 1][1] == stats:
+            return(False)
+        if i < len(history) and history[i][1] == stats:
+            # the same stats were seen later; move the change back to this time
+            history[i] = (seen, history[i][1])
+        else:
+            history.insert(i, (seen, stats))
+            if log == True:
+                self.new_stats.append(stats)
+        if history[-1][1] is stats:
+            player = self.players[handle]
+            self.players[handle] = dict(player, attributes = dict(player['attributes'], stats = stats))
+        if log == True:
+            self.write_log({'handle': handle, 'seen': seen, 'stats': stats})
+        return(True)
+
+    def item(self, handle, seen = None):
+        '''
+        Return the player item for a handle, with the latest stats, or with the stats as they were at the time seen
+        '''
+        player = self.players[handle]
+        if seen == None:
+            return(player)
+        history = self.history[handle]
+        i = bisect.bisect_right([entry[0] for entry in history], seen)
+        stats = history[max(i - 1, 0)][1]
+        if stats is player['attributes'].get('stats'):
+            return(player)
+        return(dict(player, attributes = dict(player['attributes'], stats = stats)))
+
+    def changes(self, handle):
+        '''
+        Return the history of a player's stats as (seen, changed stats) pairs, starting with the first stats seen
+        '''
+        changes = []
+        previous = {}
+        for seen, stats in self.history[handle]:
+            changes.append((seen, dict((key, value) for key, value in stats.items() if previous.get(key) != value)))
+            previous = stats
+        return(changes)
+
+    # ~~~~~ PAYLOADS ~~~~~ #
+    def split_payload(self, match_payload):
+        '''
+        Move the players out of a single-match payload and into the registry
+        Returns the payload without its player items, and the handles of its players
+        '''
+        seen = match_payload['data'].get('attributes', {}).get('createdAt', '')
+        included = []
+        handles = []
+        for item in match_payload['included']:
+            if item['type'] == 'player':
+                handles.append(self.add(item, seen = seen))
+            else:
+                included.append(item)
+        return(dict(match_payload, included = included), handles)
+
+    def join_payload(self, match_payload, handles):
+        '''
+        Put the players back into a payload made by split_payload, with the stats they had in that match
+        '''
+        seen = match_payload['data'].get('attributes', {}).get('createdAt', '')
+        return(dict(match_payload, included = match_payload['included'] + [self.item(handle, seen = seen) for handle in handles]))
+
+    # ~~~~~ SAVING ~~~~~ #
+    def write_log(self, entry):
+        if self.log != None:
+            self.log.write(json.dumps(entry, separators = (',', ':')) + '\n')
+
+    def open_log(self, path = None):
+        '''
+        Start appending new players and stats changes to the log file
+        '''
+        if path != None:
+            self.path = path
+        if self.log == None:
+            if self.log_end != None and os.path.exists(self.path) and os.path.getsize(self.path) > self.log_end:
+                # drop the partial line of an interrupted write, so the next entry starts on its own line
+                with open(self.path, 'r+b') as f:
+                    f.truncate(self.log_end)
+            self.log = open(self.path, 'a')
+
+    def flush(self):
+        if self.log != None:
+            self.log.flush()
+
+    def close(self):
+        if self.log != None:
+            self.log.close()
+            self.log = None
+
+    def load(self, path):
+        '''
+        Replay a registry log; each player keeps the handle it was logged with
+        '''
+        self.log_end = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # partial last line from an interrupted write
+                    break
+                self.log_end += len(line)
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                if 'player' in entry:
+                    if entry['id'] in self.handles:
+                        continue
+                    self.put_player(entry['handle'], entry['id'], entry['player'], entry['seen'])
+                elif entry['handle'] in self.players:
+                    self.add_stats(entry['handle'], entry['stats'], entry['seen'], log = False)
+
+    def stats(self):
+        '''
+        Return the number of players and stats changes, and for the players added since the registry was opened,
+        the number of references and the bytes and memory used with one copy per reference (estimated) and with the registry
+        '''
+        # one copy per reference is estimated from each player's latest item
+        raw_bytes = sum(item_bytes(self.players[handle]) * count for handle, count in self.references.items())
+        raw_memory = sum(deep_sizeof(self.players[handle]) * count for handle, count in self.references.items())
+        stored_bytes = sum(item_bytes(self.players[handle]) for handle in self.new_players) + sum(item_bytes(stats) for stats in self.new_stats)
+        stored_memory = sum(deep_sizeof(self.players[handle]) for handle in self.new_players) + sum(deep_sizeof(stats) for stats in self.new_stats)
+        return({
+        'players': len(self.players),
+        'stats_changes': sum(len(history) - 1 for history in self.history.values()),
+        'references': sum(self.references.values()),
+        'raw_bytes': raw_bytes,
+        'stored_bytes': stored_bytes,
+        'saved_bytes': raw_bytes - stored_bytes,
+        'raw_memory': raw_memory,
+        'stored_memory': stored_memory,
+        'saved_memory': raw_memory - stored_memory
+        })
+
+    def print_stats(self):
+        stats = self.stats()
+        print('Player registry: {0} players, {1} references, {2} stats changes'.format(stats['players'], stats['references'], stats['stats_changes']))
+        print('Player registry: saved {0:.1f} MB of {1:.1f} MB on disk, {2:.1f} MB of {3:.1f} MB in memory'.format(
+            stats['saved_bytes'] / 1e6, stats['raw_bytes'] / 1e6, stats['saved_memory'] / 1e6, stats['raw_memory'] / 1e6))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Batch 'Fail Finder' player rankings for many matches at once
+
+Applies the same scoring formula as vainstats.fail_finder, as a vector of weights over the columns
+of a participant stats table (see columnar.py), so every match in a corpus is scored in a few array operations.
+The table rows are read from records.Match records (columnar.ParticipantTableBuilder.add_match_record), not from payload dicts.
+The terms are added in the same order as fail_finder, so the scores are identical to the single match version.
+
+Rank every match in a match store, a saved_matches directory, API payload files, or a saved table with:
+./ranking.py demo-data.txt -o rankings.csv
+'''
+from __future__ import print_function
+import csv
+import argparse
+
+import numpy as np
+
+import columnar
+
+# (score group, table column, weight, whether the weight is a divisor)
+# in the same order as the terms in vainstats.fail_finder; a negative weight subtracts the term
+fail_finder_weights = [
+('user-stats', 'player_level', 1, False),
+('user-stats', 'player_wins', 100, True),
+('user-stats', 'player_played_ranked', 75, True),
+('user-stats', 'player_played', 100, True),
+('user-stats', 'player_winStreak', 10, False),
+('user-stats', 'player_lossStreak', -10, False),
+('match-stats', 'karmaLevel', 10, False),
+('match-stats', 'skillTier', 10, False),
+('match-stats', 'player_lifetimeGold', 1000, True),
+('match-stats', 'player_xp', 100000, True),
+('match-stats', 'gold', -10, True),
+('match-stats', 'deaths', -1, False),
+('match-stats', 'kills', 1, False),
+('match-stats', 'turretCaptures', 3, False),
+('match-stats', 'jungleKills', 1, False),
+('match-stats', 'farm', 1, False),
+('match-stats', 'assists', 0.5, False),
+('match-stats', 'minionKills', 10, True),
+('match-stats', 'krakenCaptures', 5, False),
+('match-stats', 'goldMineCaptures', 3, False),
+('match-stats', 'crystalMineCaptures', 2, False),
+]
+
+# (table column, test, points) for the match-stats terms that depend on a condition
+fail_finder_flags = [
+('winner', lambda values: values == True, 10),
+('firstAfkTime', lambda values: values > 0, -50),
+('wentAfk', lambda values: values != False, -50),
+]
+
+
+def score_table(table):
+    '''
+    Return the user-stats, match-stats and total score arrays for every row of a ParticipantTable
+    '''
+    scores = {'user-stats': np.zeros(len(table)), 'match-stats': np.zeros(len(table))}
+    for group, column, weight, divisor in fail_finder_weights:
+        values = table[column].astype(np.float64)
+        if divisor == True:
+            scores[group] += values / weight
+        else:
+            scores[group] += values * weight
+    for column, test, points in fail_finder_flags:
+        scores['match-stats'] += np.where(test(table[column]), points, 0)
+    return(scores['user-stats'], scores['match-stats'], scores['match-stats'] + scores['user-stats'])
+
+def rank_table(table):
+    '''
+    Return the row order that sorts the table by match and then by total score, highest first,
+    the scores, and the rank of each row within its match (1 = best)
+    '''
+    user_stats, match_stats, totals = score_table(table)
+    match_codes = table['match_id']
+    order = np.lexsort((np.arange(len(table)), -totals, match_codes))
+    sorted_codes = match_codes[order]
+    # position of each sorted row within its match
+    group_starts = np.r_[0, np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1]
+    group_sizes = np.diff(np.r_[group_starts, len(order)])
+    ranks = np.empty(len(table), dtype = np.int32)
+    ranks[order] = np.arange(len(order)) - np.repeat(group_starts, group_sizes) + 1
+    return(order, user_stats, match_stats, totals, ranks)
+
+def print_match_rankings(match_id, rows):
+    '''
+    Print the rankings for one match in the same format as vainstats.fail_finder
+    '''
+    divider = '------------------'
+    print('{0}\n'.format(divider))
+    print('{0}\n{1}'.format(divider, "Player Match Ranking: {0}".format(match_id)))
+    row_format ="{:<15}{:>15}{:>15}{:^25}{:>35}"
+    print(row_format.format('Name', 'Hero', 'Team', 'Score', 'ID'))
+    print(row_format.format('----------','----------', '----------', '----------', '------------------------------'))
+    for row in rows:
+        print(row_format.format(row['name'], row['hero'], row['team'], str(row['total']), row['player_id']))
+
+def iter_rankings(table):
+    '''
+    Yield (match ID, ranked rows) for each match in the table
+    '''
+    order, user_stats, match_stats, totals, ranks = rank_table(table)
+    match_ids = table.strings('match_id')
+    names = table.strings('name')
+    heroes = table.strings('hero')
+    player_ids = table.strings('player_id')
+    winners = table['winner']
+    rows = []
+    for i in order:
+        if len(rows) > 0 and rows[-1]['match_id'] != match_ids[i]:
+            yield(rows[-1]['match_id'], rows)
+            rows = []
+        rows.append({
+        'match_id': match_ids[i],
+        'rank': int(ranks[i]),
+        'name': names[i],
+        'hero': heroes[i],
+        'team': 'won' if winners[i] else 'lost',
+        'user-stats': float(user_stats[i]),
+        'match-stats': float(match_stats[i]),
+        'total': float(totals[i]),
+        'player_id': player_ids[i]
+        })
+    if len(rows) > 0:
+        yield(rows[-1]['match_id'], rows)
+
+def write_rankings(table, output_file, quiet = False):
+    '''
+    Rank every match in the table, print each match's rankings, and write the corpus rankings to a CSV file
+    Returns the number of matches ranked
+    '''
+    fieldnames = ['match_id', 'rank', 'name', 'hero', 'team', 'user-stats', 'match-stats', 'total', 'player_id']
+    num_matches = 0
+    with open(output_file, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames = fieldnames)
+        writer.writeheader()
+        for match_id, rows in iter_rankings(table):
+            if quiet == False:
+                print_match_rankings(match_id, rows)
+            for row in rows:
+                writer.writerow(dict(row, **{key: repr(row[key]) for key in ['user-stats', 'match-stats', 'total']}))
+            num_matches += 1
+    return(num_matches)
+
+def load_table(input_paths):
+    '''
+    Load a saved participant table, or build one from harvested matches
+    '''
+    if len(input_paths) == 1 and input_paths[0].endswith('.vcol'):
+        return(columnar.ParticipantTable.load(input_paths[0]))
+    return(columnar.build_participant_table(input_paths))
+
+def run():
+    '''
+    Arg parsing for the script when run from command line
+    '''
+    parser = argparse.ArgumentParser(description="Batch 'Fail Finder' player rankings for many matches")
+    parser.add_argument("input_paths", nargs = '+', help="Match store directories, saved_matches directories, API payload JSON files, or a .vcol participant table")
+    parser.add_argument("-o", default = 'rankings.csv', type = str, dest = 'output_file', metavar = 'output_file', help="Output CSV file for the rankings of every match")
+    parser.add_argument("-q", "--quiet", default = False, action='store_true', dest = 'quiet', help="Don't print the rankings for each match")
+    args = parser.parse_args()
+    table = load_table(args.input_paths)
+    num_matches = write_rankings(table, output_file = args.output_file, quiet = args.quiet)
+    print('Ranked {0} players in {1} matches, saved to {2}'.format(len(table), num_matches, args.output_file))
+
+if __name__ == "__main__":
+    run()
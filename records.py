@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compact records for the matches, rosters, participants and players of Gamelocker payloads
+
+Each record class has __slots__ for the fields it keeps, with typed values read once from the JSON:API items,
+so parsed matches do not keep the raw payload dicts alive. Repeated strings (heroes, skins, items, game modes)
+are interned, and a player seen with the same stats in many matches is kept as one shared record.
+
+>>> for match in iter_match_records(demo_data): print(match.id, match.gameMode)
+>>> match.rosters[0].participants[0].player.name
+'''
+import sys
+from collections import OrderedDict
+
+from payload import PayloadIndex, relationship_ids
+
+intern = getattr(sys, 'intern', None) or intern
+
+# value converter for each field type; 'category' is for strings that repeat across matches
+field_types = {
+'str': str,
+'category': lambda value: intern(str(value)),
+'int': int,
+# ints or floats, kept as the API sent them
+'number': lambda value: value if isinstance(value, (int, float)) else float(value),
+'bool': lambda value: value in (True, 'true', 'True', 1),
+'list': lambda values: tuple(intern(str(value)) for value in values)
+}
+
+
+def field_readers(fields):
+    '''
+    Return (source, key, converter) for each field, for read_fields
+    '''
+    return([(source, key, field_types[field_type]) for name, source, key, field_type in fields])
+
+def read_fields(item, readers):
+    '''
+    Return the typed values of the fields of a payload item, in field order; missing values are None
+    '''
+    attributes = item.get('attributes') or {}
+    sources = {'item': item, 'attributes': attributes, 'stats': attributes.get('stats') or {}}
+    values = []
+    for source, key, convert in readers:
+        value = sources[source].get(key)
+        values.append(None if value is None else convert(value))
+    return(values)
+
+
+class Record(object):
+    '''
+    Base class for the records; 'fields' lists (field name, source, key, type),
+    where the source is the item itself, its attributes, or its stats
+    '''
+    __slots__ = ()
+    fields = []
+    readers = []
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return('{0}({1!r})'.format(type(self).__name__, self.id))
+
+    @classmethod
+    def from_item(cls, item):
+        return(cls(*read_fields(item, cls.readers)))
+
+    def values(self):
+        return(tuple(getattr(self, name) for name, source, key, field_type in self.fields))
+
+    def to_dict(self):
+        '''
+        Return the fields as an ordered dict, e.g. for a df row
+        '''
+        return(OrderedDict((name, getattr(self, name)) for name, source, key, field_type in self.fields))
+
+
+class Player(Record):
+    fields = [
+    ('id', 'item', 'id', 'str'),
+    ('name', 'attributes', 'name', 'str'),
+    ('shardId', 'attributes', 'shardId', 'category'),
+    ('elo_earned_season_4', 'stats', 'elo_earned_season_4', 'number'),
+    ('elo_earned_season_5', 'stats', 'elo_earned_season_5', 'number'),
+    ('elo_earned_season_6', 'stats', 'elo_earned_season_6', 'number'),
+    ('elo_earned_season_7', 'stats', 'elo_earned_season_7', 'number'),
+    ('karmaLevel', 'stats', 'karmaLevel', 'int'),
+    ('level', 'stats', 'level', 'int'),
+    ('lifetimeGold', 'stats', 'lifetimeGold', 'number'),
+    ('lossStreak', 'stats', 'lossStreak', 'int'),
+    ('played', 'stats', 'played', 'int'),
+    ('played_ranked', 'stats', 'played_ranked', 'int'),
+    ('skillTier', 'stats', 'skillTier', 'int'),
+    ('winStreak', 'stats', 'winStreak', 'int'),
+    ('wins', 'stats', 'wins', 'int'),
+    ('xp', 'stats', 'xp', 'int'),
+    ]
+    __slots__ = [name for name, source, key, field_type in fields]
+    readers = field_readers(fields)
+
+
+class Participant(Record):
+    fields = [
+    ('id', 'item', 'id', 'str'),
+    ('actor', 'attributes', 'actor', 'category'),
+    ('assists', 'stats', 'assists', 'int'),
+    ('crystalMineCaptures', 'stats', 'crystalMineCaptures', 'int'),
+    ('deaths', 'stats', 'deaths', 'int'),
+    ('farm', 'stats', 'farm', 'number'),
+    ('firstAfkTime', 'stats', 'firstAfkTime', 'number'),
+    ('gold', 'stats', 'gold', 'number'),
+    ('goldMineCaptures', 'stats', 'goldMineCaptures', 'int'),
+    ('items', 'stats', 'items', 'list'),
+    ('jungleKills', 'stats', 'jungleKills', 'int'),
+    ('karmaLevel', 'stats', 'karmaLevel', 'int'),
+    ('kills', 'stats', 'kills', 'int'),
+    ('krakenCaptures', 'stats', 'krakenCaptures', 'int'),
+    ('level', 'stats', 'level', 'int'),
+    ('minionKills', 'stats', 'minionKills', 'int'),
+    ('nonJungleMinionKills', 'stats', 'nonJungleMinionKills', 'int'),
+    ('skillTier', 'stats', 'skillTier', 'int'),
+    ('skinKey', 'stats', 'skinKey', 'category'),
+    ('turretCaptures', 'stats', 'turretCaptures', 'int'),
+    ('wentAfk', 'stats', 'wentAfk', 'bool'),
+    ('winner', 'stats', 'winner', 'bool'),
+    ]
+    __slots__ = [name for name, source, key, field_type in fields] + ['player']
+    readers = field_readers(fields)
+
+    def __init__(self, *values):
+        Record.__init__(self, *values)
+        self.player = None
+
+
+class Roster(Record):
+    fields = [
+    ('id', 'item', 'id', 'str'),
+    ('acesEarned', 'stats', 'acesEarned', 'int'),
+    ('gold', 'stats', 'gold', 'int'),
+    ('heroKills', 'stats', 'heroKills', 'int'),
+    ('krakenCaptures', 'stats', 'krakenCaptures', 'int'),
+    ('side', 'stats', 'side', 'category'),
+    ('turretKills', 'stats', 'turretKills', 'int'),
+    ('turretsRemaining', 'stats', 'turretsRemaining', 'int'),
+    ('won', 'attributes', 'won', 'bool'),
+    ]
+    __slots__ = [name for name, source, key, field_type in fields] + ['participants']
+    readers = field_readers(fields)
+
+    def __init__(self, *values):
+        Record.__init__(self, *values)
+        self.participants = ()
+
+    def stats(self):
+        '''
+        Return the roster stats as an ordered dict, in the same order as the API
+        '''
+        return(OrderedDict((name, getattr(self, name)) for name, source, key, field_type in self.fields if source == 'stats'))
+
+
+class Match(Record):
+    fields = [
+    ('id', 'item', 'id', 'str'),
+    ('createdAt', 'attributes', 'createdAt', 'str'),
+    ('duration', 'attributes', 'duration', 'int'),
+    ('gameMode', 'attributes', 'gameMode', 'category'),
+    ('patchVersion', 'attributes', 'patchVersion', 'category'),
+    ('shardId', 'attributes', 'shardId', 'category'),
+    ('endGameReason', 'stats', 'endGameReason', 'category'),
+    ('queue', 'stats', 'queue', 'category'),
+    ]
+    __slots__ = [name for name, source, key, field_type in fields] + ['rosters']
+    readers = field_readers(fields)
+
+    def __init__(self, *values):
+        Record.__init__(self, *values)
+        self.rosters = ()
+
+    def participants(self):
+        return([participant for roster in self.rosters for participant in roster.participants])
+
+    def players(self):
+        return([participant.player for participant in self.participants() if participant.player != None])
+
+
+# ~~~~~ BUILDING RECORDS ~~~~~ #
+def player_record(item, players = None):
+    '''
+    Return the Player record for a player item
+    players is an optional dict of player ID to record; a player seen again with the same stats gets the same record
+    '''
+    values = read_fields(item, Player.readers)
+    if players == None:
+        return(Player(*values))
+    player = players.get(values[0])
+    if player == None or player.values() != tuple(values):
+        player = Player(*values)
+        players[player.id] = player
+    return(player)
+
+def match_record(index, match_id, players = None):
+    '''
+    Return the Match record for a match in a PayloadIndex, with its rosters, participants and players
+    '''
+    match = Match.from_item(index.match(match_id))
+    rosters = []
+    for roster_item in index.rosters(match_id):
+        roster = Roster.from_item(roster_item)
+        participants = []
+        for participant_item in index.resolve(relationship_ids(roster_item, 'participants')):
+            participant = Participant.from_item(participant_item)
+            player_items = index.resolve(relationship_ids(participant_item, 'player'))
+            if len(player_items) > 0:
+                participant.player = player_record(player_items[0], players = players)
+            participants.append(participant)
+        roster.participants = tuple(participants)
+        rosters.append(roster)
+    match.rosters = tuple(rosters)
+    return(match)
+
+def iter_match_records(payload, players = None):
+    '''
+    Yield a Match record for every match in an API payload, in payload order
+    '''
+    index = PayloadIndex(payload)
+    for match_id in index.match_ids:
+        yield(match_record(index, match_id, players = players))
+
+def match_records(payloads, players = None):
+    '''
+    Return the Match records for every match in a list or stream of payloads, sharing player records between them
+    '''
+    if players == None:
+        players = {}
+    return([match for payload in payloads for match in iter_match_records(payload, players = players)])
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Append-only segment store for harvested matches
+
+Each match is stored as a single-match payload ({'data': match, 'included': [...]}),
+the same format as an API match ID lookup. Matches are written in batches to compressed blocks
+that are appended to numbered segment files, and an index file maps each match ID to its block.
+
+store_dir/
+    segment-000000.seg   # blocks of: 8 byte header (compressed length, number of records) + zlib compressed JSON lines
+    segment-000001.seg
+    index.tsv            # match_id, segment number, block offset, block length, record number in the block
+    players.log          # player registry (see players.py); each player is stored once, and matches refer to their players by handle
+
+Convert an existing 'saved_matches' directory with:
+./store.py saved_matches match_store
+'''
+from __future__ import print_function
+import os
+import json
+import zlib
+import struct
+import argparse
+import threading
+
+from payload import PayloadIndex
+from players import PlayerRegistry
+
+block_header = struct.Struct('>II')
+
+
+def mkdirs(path):
+    '''
+    Make a directory, and all parent dir's in the path
+    '''
+    import errno
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+    return(path)
+
+def split_payload(payload):
+    '''
+    Yield a single-match payload for each match in an API payload
+    '''
+    index = PayloadIndex(payload)
+    for match_id in index.match_ids:
+        yield(index.match_payload(match_id))
+
+
+class MatchStore(object):
+    '''
+    Append-only store of match payloads, with random reads by match ID and full scans
+
+    >>> store = MatchStore('match_store')
+    >>> store.put_payload(api_payload)
+    >>> store.get(match_id)['data']['attributes']['gameMode']
+    >>> for match_payload in store.iter_matches(): ...
+    '''
+    def __init__(self, path, segment_size = 64 * 1024 * 1024, block_records = 256, compress_level = 6):
+        self.path = mkdirs(path)
+        self.segment_size = segment_size
+        self.block_records = block_records
+        self.compress_level = compress_level
+        self.index_file = os.path.join(path, 'index.tsv')
+        self.index = {}
+        self.lock = threading.Lock()
+        self.last_block = (None, None)
+        self.players = PlayerRegistry(os.path.join(path, 'players.log'))
+        # bytes of complete index lines, and whether a torn tail was cut off the current segment and the index
+        self.index_end = None
+        self.tail_checked = False
+        self.load_index()
+        self.segment = max([0] + [int(name[8:14]) for name in os.listdir(path) if name.startswith('segment-') and name.endswith('.seg')])
+
+    def __len__(self):
+        return(len(self.index))
+
+    def __contains__(self, match_id):
+        return(match_id in self.index)
+
+    def segment_path(self, segment):
+        return(os.path.join(self.path, 'segment-{0:06d}.seg'.format(segment)))
+
+    def load_index(self):
+        '''
+        Read the match ID -> block index from disk
+        '''
+        if not os.path.exists(self.index_file):
+            return
+        self.index_end = 0
+        with open(self.index_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # partial last line from an interrupted write
+                    break
+                self.index_end += len(line)
+                parts = line.decode('utf-8').rstrip('\n').split('\t')
+                if len(parts) != 5:
+                    # partial line from an interrupted write
+                    continue
+                match_id, segment, offset, length, slot = parts
+                self.index[match_id] = (int(segment), int(offset), int(length), int(slot))
+
+    def ids(self):
+        '''
+        Return the stored match IDs
+        '''
+        return(list(self.index.keys()))
+
+    def put_payload(self, payload):
+        '''
+        Store every match in an API payload; returns the number of new matches stored
+        '''
+        return(self.put_many(split_payload(payload)))
+
+    def put_many(self, match_payloads):
+        '''
+        Store single-match payloads in compressed blocks; matches that are already stored are skipped
+        Returns the number of new matches stored
+        '''
+        num_stored = 0
+        batch = []
+        for match_payload in match_payloads:
+            batch.append(match_payload)
+            if len(batch) >= self.block_records:
+                num_stored += self.write_block(batch)
+                batch = []
+        if len(batch) > 0:
+            num_stored += self.write_block(batch)
+        return(num_stored)
+
+    def segment_end(self, segment_path):
+        '''
+        Return the length of the complete blocks at the start of a segment file
+        '''
+        end = 0
+        size = os.path.getsize(segment_path)
+        with open(segment_path, 'rb') as f:
+            while True:
+                header = f.read(block_header.size)
+                if len(header) < block_header.size:
+                    break
+                length, num_records = block_header.unpack(header)
+                if end + block_header.size + length > size:
+                    break
+                end += block_header.size + length
+                f.seek(end)
+        return(end)
+
+    def drop_torn_tail(self):
+        '''
+        Cut the partial block and index line of an interrupted write off the end of the current segment and the index,
+        so the blocks appended after them can still be read by iter_blocks
+        Only done before the first write, so opening a store to read it never changes its files
+        '''
+        if self.tail_checked == True:
+            return
+        self.tail_checked = True
+        segment_path = self.segment_path(self.segment)
+        if os.path.exists(segment_path):
+            end = self.segment_end(segment_path)
+            if os.path.getsize(segment_path) > end:
+                with open(segment_path, 'r+b') as f:
+                    f.truncate(end)
+        if self.index_end != None and os.path.exists(self.index_file) and os.path.getsize(self.index_file) > self.index_end:
+            with open(self.index_file, 'r+b') as f:
+                f.truncate(self.index_end)
+
+    def write_block(self, match_payloads):
+        '''
+        Append one block of matches to the current segment and record them in the index
+        '''
+        with self.lock:
+            self.drop_torn_tail()
+            self.players.open_log()
+            records = []
+            match_ids = []
+            for match_payload in match_payloads:
+                match_id = match_payload['data']['id']
+                if match_id in self.index or match_id in match_ids:
+                    continue
+                match_ids.append(match_id)
+                match_payload, handles = self.players.split_payload(match_payload)
+                record = dict(match_payload, players = handles)
+                records.append(json.dumps(record, separators = (',', ':')).encode('utf-8'))
+            if len(records) < 1:
+                return(0)
+            # the players have to be saved before the index can refer to matches that use them
+            self.players.flush()
+            block = zlib.compress(b'\n'.join(records), self.compress_level)
+            segment_path = self.segment_path(self.segment)
+            if os.path.exists(segment_path) and os.path.getsize(segment_path) >= self.segment_size:
+                self.segment += 1
+                segment_path = self.segment_path(self.segment)
+            with open(segment_path, 'ab') as f:
+                offset = f.tell()
+                f.write(block_header.pack(len(block), len(records)))
+                f.write(block)
+            length = block_header.size + len(block)
+            index_lines = []
+            for slot, match_id in enumerate(match_ids):
+                self.index[match_id] = (self.segment, offset, length, slot)
+                index_lines.append('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(match_id, self.segment, offset, length, slot))
+            with open(self.index_file, 'a') as f:
+                f.write(''.join(index_lines))
+            return(len(records))
+
+    def read_block(self, segment, offset, length):
+        '''
+        Read and decompress one block, returning its JSON lines
+        '''
+        key = (segment, offset)
+        if self.last_block[0] == key:
+            return(self.last_block[1])
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        lines = zlib.decompress(data[block_header.size:]).split(b'\n')
+        self.last_block = (key, lines)
+        return(lines)
+
+    def load_record(self, line):
+        '''
+        Return the match payload for a stored record, with its players from the registry
+        Records written before the registry was added have their players in 'included'
+        '''
+        record = json.loads(line.decode('utf-8'))
+        if 'players' not in record:
+            return(record)
+        handles = record.pop('players')
+        return(self.players.join_payload(record, handles))
+
+    def get(self, match_id):
+        '''
+        Return the stored payload for a match ID, or None
+        '''
+        if match_id not in self.index:
+            return(None)
+        segment, offset, length, slot = self.index[match_id]
+        return(self.load_record(self.read_block(segment, offset, length)[slot]))
+
+    def iter_blocks(self):
+        '''
+        Yield the JSON lines of each block in every segment, in the order they were written
+        '''
+        segment = 0
+        while segment <= self.segment:
+            segment_path = self.segment_path(segment)
+            if os.path.exists(segment_path):
+                with open(segment_path, 'rb') as f:
+                    while True:
+                        header = f.read(block_header.size)
+                        if len(header) < block_header.size:
+                            break
+                        length, num_records = block_header.unpack(header)
+                        data = f.read(length)
+                        if len(data) < length:
+                            # partial block from an interrupted write
+                            break
+                        yield(zlib.decompress(data).split(b'\n'))
+            segment += 1
+
+    def iter_matches(self):
+        '''
+        Yield every stored match payload, reading each segment sequentially
+        '''
+        for lines in self.iter_blocks():
+            for line in lines:
+                yield(self.load_record(line))
+
+    def blocks(self):
+        '''
+        Return the (segment, offset, length) of every indexed block, in the order they were written
+        '''
+        return(sorted(set((segment, offset, length) for segment, offset, length, slot in self.index.values())))
+
+    def iter_block_matches(self, blocks):
+        '''
+        Yield the match payloads in a list of blocks from blocks(), e.g. one worker's share of the store
+        '''
+        for segment, offset, length in blocks:
+            for line in self.read_block(segment, offset, length):
+                yield(self.load_record(line))
+
+
+# ~~~~~ CONVERT SAVED MATCHES ~~~~~ #
+def load_saved_item(input_dir, item_type, item_id):
+    '''
+    Load an 'included' item saved by vainstats.py in harvest mode, or None if it was not saved
+    '''
+    item_file = os.path.join(input_dir, '{0}_{1}.json'.format(item_id, item_type))
+    if not os.path.exists(item_file):
+        return(None)
+    with open(item_file) as f:
+        return(json.load(f))
+
+def load_saved_match(input_dir, match_file):
+    '''
+    Rebuild a single-match payload from the per-item files saved by vainstats.py in harvest mode
+    '''
+    from payload import relationship_ids
+    with open(os.path.join(input_dir, match_file)) as f:
+        match = json.load(f)
+    included = []
+    keys = relationship_ids(match, 'rosters') + relationship_ids(match, 'assets')
+    while len(keys) > 0:
+        item_type, item_id = keys.pop(0)
+        item = load_saved_item(input_dir, item_type, item_id)
+        if item == None:
+            continue
+        included.append(item)
+        keys.extend(relationship_ids(item, 'participants') + relationship_ids(item, 'player'))
+    return({'data': match, 'included': included})
+
+def convert_saved_matches(input_dir, store):
+    '''
+    Copy every match in a 'saved_matches' directory into a MatchStore, one match at a time
+    Returns the number of new matches stored
+    '''
+    match_files = sorted(name for name in os.listdir(input_dir) if name.endswith('_data.json'))
+    return(store.put_many(load_saved_match(input_dir, match_file) for match_file in match_files))
+
+def run():
+    '''
+    Arg parsing for the script when run from command line
+    '''
+    parser = argparse.ArgumentParser(description='Convert a vainstats.py saved_matches directory to a match store')
+    parser.add_argument("input_dir", help="Directory of JSON files saved by vainstats.py --harvest")
+    parser.add_argument("store_dir", help="Match store directory to write to")
+    args = parser.parse_args()
+    store = MatchStore(args.store_dir)
+    num_stored = convert_saved_matches(input_dir = args.input_dir, store = store)
+    print('Stored {0} new matches in {1} ({2} total)'.format(num_stored, args.store_dir, len(store)))
+    store.players.print_stats()
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Synthetic Gamelocker match payloads, for scale and load testing
+
+Generates JSON:API payloads with the same 'data', 'included' and 'relationships' structure as demo-data.txt:
+matches with 2 rosters of 3 participants, a player for each participant, and a telemetry asset.
+Players are drawn from a shared pool, so the same players show up in many matches, with the same stats each time.
+Every match and player is made from its own random generator, seeded from the corpus seed and its number,
+so the same seed always gives the same corpus, and matches are written one at a time without holding the corpus in memory.
+
+./synthetic.py 1000 -o synthetic.json
+./synthetic.py 1000000 --per-file 10000 -o synthetic_matches --seed 42
+./synthetic.py 100 -o synthetic.json --telemetry-dir telemetry_files
+'''
+from __future__ import print_function
+import os
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+from datetime import datetime, timedelta
+try:
+    from urllib.parse import urlparse
+except ImportError: # Python 2
+    from urlparse import urlparse
+
+heroes = ['Adagio', 'Alpha', 'Ardan', 'Baptiste', 'Baron', 'Blackfeather', 'Catherine', 'Celeste', 'Flicker', 'Fortress',
+'Glaive', 'Grace', 'Grumpjaw', 'Gwen', 'Idris', 'Joule', 'Kestrel', 'Koshka', 'Krul', 'Lance', 'Lyra', 'Ozo', 'Petal',
+'Phinn', 'Reim', 'Ringo', 'Rona', 'SAW', 'Samuel', 'Skaarf', 'Skye', 'Taka', 'Vox']
+
+skins = ['DefaultSkin', 'Skin_T1', 'Skin_T2', 'Skin_T3', 'Skin_Special']
+
+# item ID, display name
+items = [('Aftershock', 'Aftershock'), ('BlazingSalvo', 'Blazing Salvo'), ('Bonesaw', 'Bonesaw'), ('BreakingPoint', 'Breaking Point'),
+('Chronograph', 'Chronograph'), ('Clockwork', 'Clockwork'), ('CrystalBit', 'Crystal Bit'), ('Dragonheart', 'Dragonheart'),
+('EclipsePrism', 'Eclipse Prism'), ('FountainOfRenewal', 'Fountain of Renewal'), ('HeavyPrism', 'Heavy Prism'),
+('HeavySteel', 'Heavy Steel'), ('Hourglass', 'Hourglass'), ('KineticShield', 'Kinetic Shield'), ('LuckyStrike', 'Lucky Strike'),
+('MinionsFoot', "Minion's Foot"), ('Oakheart', 'Oakheart'), ('PiercingShard', 'Piercing Shard'), ('PiercingSpear', 'Piercing Spear'),
+('ReflexBlock', 'Reflex Block'), ('Shatterglass', 'Shatterglass'), ('SixSins', 'Six Sins'), ('Sorrowblade', 'Sorrowblade'),
+('Stormcrown', 'Stormcrown'), ('SwiftShooter', 'Swift Shooter'), ('TensionBow', 'Tension Bow'), ('TornadoTrigger', 'Tornado Trigger'),
+('TravelBoots', 'Travel Boots'), ('WarTreads', 'War Treads'), ('WeaponBlade', 'Weapon Blade')]
+
+consumables = ['Flare', 'ScoutTrap', 'CrystalInfusion', 'WeaponInfusion']
+
+# game mode, relative frequency, (shortest, longest) duration in seconds
+game_modes = [
+('ranked', 40, (900, 2400)),
+('casual', 25, (900, 2400)),
+('blitz_pvp_ranked', 25, (120, 300)),
+('casual_aral', 10, (600, 1200)),
+]
+
+name_parts = ['Shadow', 'Legend', 'Vain', 'Kraken', 'Gold', 'Crystal', 'Jungle', 'Lane', 'Turret', 'Minion', 'Ace', 'Storm',
+'Night', 'Blade', 'Frost', 'Fire', 'Killa', 'Kitty', 'Goat', 'Sirius', 'Phuck', 'Tiger', 'Wolf', 'Panda']
+
+
+def make_id(rng):
+    '''
+    Return a random UUID string, like the Gamelocker IDs
+    '''
+    return(str(uuid.UUID(int = rng.getrandbits(128), version = 1)))
+
+def ref(item_type, item_id):
+    return({'type': item_type, 'id': item_id})
+
+
+class PayloadGenerator(object):
+    '''
+    Makes synthetic single-match payloads ({'data': match, 'included': [...]})
+
+    >>> generator = PayloadGenerator(seed = 0, num_players = 1000)
+    >>> match_payload = generator.match(0)
+    >>> for match_payload in generator.iter_matches(1000): ...
+    '''
+    def __init__(self, seed = 0, num_players = 10000, region = 'na', start_time = datetime(2017, 7, 1), match_interval = 30):
+        self.seed = seed
+        self.num_players = num_players
+        self.region = region
+        self.start_time = start_time
+        # seconds between matches; matches are made newest first, the same order as the API
+        self.match_interval = match_interval
+        self.mode_weights = [weight for mode, weight, durations in game_modes]
+
+    def rng(self, kind, number):
+        '''
+        Return the random generator for one match or player
+        '''
+        return(random.Random('{0}:{1}:{2}'.format(self.seed, kind, number)))
+
+    def player(self, number):
+        '''
+        Return the player item for a player in the pool; always the same for the same seed and number
+        '''
+        rng = self.rng('player', number)
+        played = int(rng.lognormvariate(6, 1.2)) + 1
+        played_ranked = int(played * rng.uniform(0, 0.6))
+        level = min(30, 1 + int(played ** 0.5))
+        elo = [round(rng.uniform(0, 2000), 10) if rng.random() < 0.7 else 0 for i in range(4)]
+        return({
+        'type': 'player',
+        'id': make_id(rng),
+        'attributes': {
+            'name': '{0}{1}{2}'.format(rng.choice(name_parts), rng.choice(name_parts), rng.randint(1, 99)),
+            'shardId': self.region,
+            'stats': {
+                'elo_earned_season_4': elo[0],
+                'elo_earned_season_5': elo[1],
+                'elo_earned_season_6': elo[2],
+                'elo_earned_season_7': elo[3],
+                'karmaLevel': rng.choice([0, 1, 1, 2, 2, 2]),
+                'level': level,
+                'lifetimeGold': round(rng.uniform(0, 12000), 4),
+                'lossStreak': rng.choice([0, 0, 0, 1, 2, 3]),
+                'played': played,
+                'played_ranked': played_ranked,
+                'skillTier': min(29, max(-1, int(rng.gauss(10, 5)))),
+                'winStreak': rng.choice([0, 0, 0, 1, 2, 3]),
+                'wins': int(played * rng.uniform(0.35, 0.65)),
+                'xp': min(175450, level * 5848 + rng.randint(0, 5848))
+                },
+            'titleId': 'semc-vainglory'
+            },
+        'relationships': {'assets': {'data': []}}
+        })
+
+    def pick_players(self, rng):
+        '''
+        Return 6 different player numbers; a few players play many more matches than the rest
+        '''
+        numbers = []
+        while len(numbers) < 6:
+            number = int(self.num_players * rng.random() ** 1.5)
+            if number not in numbers:
+                numbers.append(number)
+        return(numbers)
+
+    def participant(self, rng, player, duration, winner):
+        '''
+        Return a participant item for a player in a match
+        '''
+        minutes = duration / 60.0
+        hero = rng.choice(heroes)
+        build = rng.sample(items, rng.randint(3, 6))
+        item_grants = {'*Item_{0}*'.format(item_id): 1 for item_id, name in build}
+        item_grants['*Item_TravelBoots*'] = 1
+        item_uses = {'*Item_TravelBoots*': 1}
+        item_sells = {}
+        for consumable in rng.sample(consumables, rng.randint(0, 2)):
+            count = rng.randint(1, 4)
+            item_grants['*Item_{0}*'.format(consumable)] = count
+            item_uses['*Item_{0}*'.format(consumable)] = rng.randint(1, count)
+            if rng.random() < 0.3:
+                item_sells['*Item_{0}*'.format(consumable)] = rng.randint(1, count)
+        went_afk = rng.random() < 0.01
+        minion_kills = int(rng.expovariate(1.0) * minutes * 3)
+        return({
+        'type': 'participant',
+        'id': make_id(rng),
+        'attributes': {
+            'actor': '*{0}*'.format(hero),
+            'shardId': self.region,
+            'stats': {
+                'assists': int(rng.expovariate(1.0) * minutes / 4),
+                'crystalMineCaptures': int(rng.random() < minutes / 60),
+                'deaths': int(rng.expovariate(1.0) * minutes / 5),
+                'farm': round(minion_kills * rng.uniform(1, 3), 3),
+                'firstAfkTime': round(rng.uniform(0, duration), 3) if went_afk else -1,
+                'gold': round(minutes * rng.uniform(400, 700), 4),
+                'goldMineCaptures': int(rng.random() < minutes / 40),
+                'itemGrants': item_grants,
+                'itemSells': item_sells,
+                'itemUses': item_uses,
+                'items': [name for item_id, name in build],
+                'jungleKills': int(rng.expovariate(1.0) * minutes),
+                'karmaLevel': player['attributes']['stats']['karmaLevel'],
+                'kills': int(rng.expovariate(1.0) * minutes / (4 if winner else 6)),
+                'krakenCaptures': int(rng.random() < minutes / 80),
+                'level': min(12, 1 + int(minutes * rng.uniform(0.4, 0.7))),
+                'minionKills': minion_kills,
+                'nonJungleMinionKills': minion_kills,
+                'skillTier': player['attributes']['stats']['skillTier'],
+                'skinKey': '{0}_{1}'.format(hero, rng.choice(skins)),
+                'turretCaptures': int(rng.expovariate(1.0) * (1.5 if winner else 0.5)),
+                'wentAfk': went_afk,
+                'winner': winner
+                }
+            },
+        'relationships': {'player': {'data': ref('player', player['id'])}}
+        })
+
+    def match(self, number):
+        '''
+        Return the single-match payload for match number; always the same for the same seed and number
+        '''
+        rng = self.rng('match', number)
+        mode = rng.choices([mode for mode, weight, durations in game_modes], weights = self.mode_weights)[0]
+        durations = dict((mode, durations) for mode, weight, durations in game_modes)[mode]
+        duration = rng.randint(*durations)
+        created_at = self.start_time - timedelta(seconds = number * self.match_interval)
+        winning_side = rng.randint(0, 1)
+        match_id = make_id(rng)
+        player_numbers = self.pick_players(rng)
+        included = []
+        roster_ids = []
+        for side_number, side in enumerate(['left/blue', 'right/red']):
+            winner = side_number == winning_side
+            participants = []
+            for player_number in player_numbers[side_number * 3:side_number * 3 + 3]:
+                player = self.player(player_number)
+                participants.append(self.participant(rng, player, duration, winner))
+                included.append(player)
+            stats = [participant['attributes']['stats'] for participant in participants]
+            roster_id = make_id(rng)
+            roster_ids.append(roster_id)
+            included.append({
+            'type': 'roster',
+            'id': roster_id,
+            'attributes': {
+                'shardId': self.region,
+                'stats': {
+                    'acesEarned': rng.randint(0, 3) if winner else rng.randint(0, 1),
+                    'gold': int(sum(x['gold'] for x in stats)),
+                    'heroKills': sum(x['kills'] for x in stats),
+                    'krakenCaptures': sum(x['krakenCaptures'] for x in stats),
+                    'side': side,
+                    'turretKills': sum(x['turretCaptures'] for x in stats),
+                    'turretsRemaining': rng.randint(1, 5) if winner else rng.randint(0, 2)
+                    },
+                'won': 'true' if winner else 'false'
+                },
+            'relationships': {
+                'participants': {'data': [ref('participant', x['id']) for x in participants]},
+                'team': {'data': None}
+                }
+            })
+            included.extend(participants)
+        asset_id = make_id(rng)
+        asset_time = created_at + timedelta(seconds = duration + 30)
+        included.append({
+        'type': 'asset',
+        'id': asset_id,
+        'attributes': {
+            'URL': 'https://gl-prod-us-east-1.s3.amazonaws.com/assets/semc-vainglory/{0}/{1}/{2}-telemetry.json'.format(self.region, asset_time.strftime('%Y/%m/%d/%H/%M'), asset_id),
+            'contentType': 'application/json',
+            'createdAt': asset_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'description': '',
+            'filename': 'telemetry.json',
+            'name': 'telemetry'
+            }
+        })
+        match = {
+        'type': 'match',
+        'id': match_id,
+        'attributes': {
+            'createdAt': created_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'duration': duration,
+            'gameMode': mode,
+            'patchVersion': '2.6',
+            'shardId': self.region,
+            'stats': {'endGameReason': 'victory' if rng.random() < 0.9 else 'surrender', 'queue': mode},
+            'titleId': 'semc-vainglory'
+            },
+        'relationships': {
+            'assets': {'data': [ref('asset', asset_id)]},
+            'rosters': {'data': [ref('roster', roster_id) for roster_id in roster_ids]},
+            'rounds': {'data': []},
+            'spectators': {'data': []}
+            }
+        }
+        return({'data': match, 'included': included})
+
+    def telemetry(self, number):
+        '''
+        Return the telemetry events for match number, in the format of the Gamelocker telemetry files:
+        spawns, level ups, item purchases, damage and kills for each participant, in time order
+        '''
+        match_payload = self.match(number)
+        rng = self.rng('telemetry', number)
+        items_by_id = dict(((item['type'], item['id']), item) for item in match_payload['included'])
+        actors = []
+        for roster_ref in match_payload['data']['relationships']['rosters']['data']:
+            roster = items_by_id[('roster', roster_ref['id'])]
+            team = 'Left' if roster['attributes']['stats']['side'] == 'left/blue' else 'Right'
+            for participant_ref in roster['relationships']['participants']['data']:
+                actors.append((team, items_by_id[('participant', participant_ref['id'])]['attributes']['actor']))
+        start_time = datetime.strptime(match_payload['data']['attributes']['createdAt'], '%Y-%m-%dT%H:%M:%SZ')
+        duration = match_payload['data']['attributes']['duration']
+        def event(seconds, event_type, team, actor, **payload):
+            payload = dict(Team = team, Actor = actor, **payload)
+            return((seconds, {'time': (start_time + timedelta(seconds = seconds)).strftime('%Y-%m-%dT%H:%M:%S+0000'), 'type': event_type, 'payload': payload}))
+        def position():
+            return([round(rng.uniform(-90, 90), 2), round(rng.uniform(0, 5), 2), round(rng.uniform(-40, 40), 2)])
+        events = []
+        for team, actor in actors:
+            events.append(event(0, 'PlayerFirstSpawn', team, actor))
+            for level in range(2, 13):
+                events.append(event(int(duration * (level - 1) / 12.0), 'LevelUp', team, actor, Level = level, LifetimeGold = level * rng.randint(300, 700)))
+            for item_id, name in rng.sample(items, rng.randint(4, 10)):
+                cost = rng.choice([300, 800, 1400, 2300, 2800])
+                events.append(event(rng.randint(0, duration), 'BuyItem', team, actor, Item = name, Cost = cost, RemainingGold = rng.randint(0, 900), Position = position()))
+            enemies = [other for other in actors if other[0] != team]
+            for i in range(duration // 2):
+                target_team, target = rng.choice(enemies)
+                damage = rng.randint(10, 400)
+                events.append(event(rng.randint(0, duration), 'DealDamage', team, actor, Target = target, Source = rng.choice(['Unknown', 'Ability_A', 'Ability_B', 'Ability_C']),
+                Damage = damage, Delt = int(damage * rng.uniform(0.3, 1)), IsHero = 1, TargetIsHero = 1))
+            for i in range(rng.randint(0, 8)):
+                target_team, target = rng.choice(enemies)
+                events.append(event(rng.randint(0, duration), 'KillActor', team, actor, Killed = target, KilledTeam = target_team, Gold = rng.choice([150, 300, 450]),
+                IsHero = 1, TargetIsHero = 1, Position = position()))
+        events.sort(key = lambda x: x[0])
+        return([item for seconds, item in events])
+
+    def iter_matches(self, num_matches, first = 0):
+        '''
+        Yield the single-match payloads for matches first to first + num_matches
+        '''
+        for number in range(first, first + num_matches):
+            yield(self.match(number))
+
+
+def write_payload(output_file, match_payloads):
+    '''
+    Write single-match payloads to one JSON:API payload file, one match at a time
+    The matches go to the 'data' list, and their included items to a temporary file that is appended after it;
+    players that are in more than one match are only included once
+    Returns the number of matches written
+    '''
+    included_file = output_file + '.included'
+    num_matches = 0
+    num_included = 0
+    included_ids = set()
+    with open(output_file, 'w') as f, open(included_file, 'w') as included:
+        f.write('{"data": [')
+        for match_payload in match_payloads:
+            f.write((',\n' if num_matches > 0 else '\n') + json.dumps(match_payload['data']))
+            for item in match_payload['included']:
+                if item['type'] == 'player':
+                    if item['id'] in included_ids:
+                        continue
+                    included_ids.add(item['id'])
+                included.write((',\n' if num_included > 0 else '\n') + json.dumps(item))
+                num_included += 1
+            num_matches += 1
+    with open(output_file, 'a') as f, open(included_file) as included:
+        f.write('\n], "included": [')
+        shutil.copyfileobj(included, f)
+        f.write('\n], "links": {}, "meta": {}}\n')
+    os.remove(included_file)
+    return(num_matches)
+
+def write_corpus(output, num_matches, per_file = None, generator = None):
+    '''
+    Write num_matches synthetic matches to one payload file,
+    or to a directory of numbered payload files of per_file matches each
+    Returns the list of files written
+    '''
+    if generator == None:
+        generator = PayloadGenerator()
+    if per_file == None:
+        write_payload(output, generator.iter_matches(num_matches))
+        return([output])
+    from checkpoint import mkdirs
+    mkdirs(output)
+    output_files = []
+    for first in range(0, num_matches, per_file):
+        output_file = os.path.join(output, 'matches-{0:06d}.json'.format(first // per_file))
+        write_payload(output_file, generator.iter_matches(min(per_file, num_matches - first), first = first))
+        output_files.append(output_file)
+    return(output_files)
+
+def telemetry_file(telemetry_dir, match_payload):
+    '''
+    Return the path for a match's telemetry under telemetry_dir, the same as the path of its asset URL,
+    so telemetry_dir can be served by a local file server in place of the asset host
+    '''
+    from payload import relationship_ids
+    asset_ids = [item_id for item_type, item_id in relationship_ids(match_payload['data'], 'assets')]
+    for item in match_payload['included']:
+        if item['type'] == 'asset' and item['id'] in asset_ids:
+            url_path = urlparse(item['attributes']['URL']).path
+            return(os.path.join(telemetry_dir, *url_path.strip('/').split('/')))
+    return(None)
+
+def write_telemetry(telemetry_dir, num_matches, generator = None):
+    '''
+    Write the telemetry file of every match, one event per line inside the JSON array
+    Returns the number of events written
+    '''
+    from checkpoint import mkdirs
+    if generator == None:
+        generator = PayloadGenerator()
+    num_events = 0
+    for number in range(num_matches):
+        output_file = telemetry_file(telemetry_dir, generator.match(number))
+        mkdirs(os.path.dirname(output_file))
+        events = generator.telemetry(number)
+        with open(output_file, 'w') as f:
+            f.write('[\n' + ',\n'.join(json.dumps(event) for event in events) + '\n]\n')
+        num_events += len(events)
+    return(num_events)
+
+def run():
+    '''
+    Arg parsing for the script when run from command line
+    '''
+    parser = argparse.ArgumentParser(description='Generate synthetic Gamelocker match payloads')
+    parser.add_argument("num_matches", type = int, help="Number of matches to generate")
+    parser.add_argument("-o", default = 'synthetic.json', dest = 'output', metavar = 'output', help="Output payload file, or directory with --per-file")
+    parser.add_argument("--per-file", default = None, type = int, dest = 'per_file', help="Split the matches into a directory of payload files with this many matches each")
+    parser.add_argument("--players", default = None, type = int, dest = 'num_players', help="Number of players in the shared player pool (default: 2 per match)")
+    parser.add_argument("--seed", default = 0, type = int, dest = 'seed', help="Random seed; the same seed always gives the same matches")
+    parser.add_argument("-r", default = 'na', type = str, dest = 'region', help="Region (shard) for the matches")
+    parser.add_argument("--telemetry-dir", default = None, dest = 'telemetry_dir', metavar = 'telemetry_dir', help="Also write a telemetry file for each match under this directory, at the path of its asset URL, e.g. to serve with python -m http.server")
+    args = parser.parse_args()
+    num_players = args.num_players if args.num_players != None else max(6, 2 * args.num_matches)
+    generator = PayloadGenerator(seed = args.seed, num_players = num_players, region = args.region)
+    start_time = time.time()
+    output_files = write_corpus(args.output, args.num_matches, per_file = args.per_file, generator = generator)
+    print('Wrote {0} matches with {1} players to {2} file(s) in {3:.1f}s: {4}'.format(args.num_matches, num_players, len(output_files), time.time() - start_time, args.output))
+    if args.telemetry_dir != None:
+        start_time = time.time()
+        num_events = write_telemetry(args.telemetry_dir, args.num_matches, generator = generator)
+        print('Wrote {0} telemetry events in {1:.1f}s: {2}'.format(num_events, time.time() - start_time, args.telemetry_dir))
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Telemetry downloads for harvested matches
+
+Every match has a telemetry asset in its 'included' items, with the URL of a JSON file of the match events
+(spawns, level ups, item purchases, damage, kills, ...). The files are downloaded by a bounded pool of threads,
+and each one is parsed as it arrives into one columnar table per event type: a column for the event time,
+and one for each payload field, with lists of numbers (e.g. Position) split into a column per element.
+The tables are saved compressed next to the match, as <match ID>_telemetry.vtel:
+    magic (8 bytes) + zlib compressed (header length (8 bytes) + JSON header + one columnar.py table per event type)
+
+Download the telemetry of a harvest with:
+./telemetry.py saved_matches -w 8
+./telemetry.py match_store --base-url http://127.0.0.1:8000     # assets served by a local file server
+'''
+from __future__ import print_function, division
+import os
+import json
+import time
+import zlib
+import calendar
+import argparse
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    from urllib.parse import urlparse
+except ImportError: # Python 2
+    from urlparse import urlparse
+
+import numpy as np
+
+import jsonstream
+from columnar import ParticipantTable, column_types, header_length
+from payload import PayloadIndex, relationship_ids
+
+file_magic = b'VTEL1\n\x00\x00'
+
+
+# ~~~~~ ASSETS ~~~~~ #
+def telemetry_assets(payload):
+    '''
+    Return (match ID, telemetry URL) for every match in an API payload that has a telemetry asset
+    '''
+    index = PayloadIndex(payload)
+    assets = []
+    for match_id in index.match_ids:
+        for asset in index.resolve(relationship_ids(index.match(match_id), 'assets')):
+            attributes = asset.get('attributes') or {}
+            if attributes.get('name') == 'telemetry' and attributes.get('URL') != None:
+                assets.append((match_id, attributes['URL']))
+    return(assets)
+
+def telemetry_path(output_dir, match_id):
+    return(os.path.join(output_dir, match_id + '_telemetry.vtel'))
+
+def rebase_url(url, base_url = None):
+    '''
+    Replace the scheme and host of an asset URL, e.g. with a local file server
+    '''
+    if base_url == None:
+        return(url)
+    return(base_url.rstrip('/') + urlparse(url).path)
+
+
+# ~~~~~ EVENT TABLES ~~~~~ #
+def value_type(value):
+    '''
+    Return the column type for a payload value; strings, and lists or dicts that are not split into columns, are categories
+    '''
+    if isinstance(value, bool):
+        return('bool')
+    if isinstance(value, int):
+        return('int')
+    if isinstance(value, float):
+        return('float')
+    return('category')
+
+def merge_types(old_type, new_type):
+    '''
+    Return the column type that holds the values of both types
+    '''
+    if old_type == new_type:
+        return(old_type)
+    numbers = set([old_type, new_type])
+    if numbers <= set(['bool', 'int']):
+        return('int')
+    if numbers <= set(['bool', 'int', 'float']):
+        return('float')
+    return('category')
+
+def flatten_payload(payload, row, prefix = ''):
+    '''
+    Add the fields of an event payload to a row; nested dicts become prefix_key, and lists of numbers prefix_0, prefix_1, ...
+    '''
+    for key, value in payload.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flatten_payload(value, row, prefix = name + '_')
+        elif isinstance(value, list) and len(value) > 0 and all(value_type(x) in ('int', 'float') for x in value):
+            for i, x in enumerate(value):
+                row['{0}_{1}'.format(name, i)] = x
+        else:
+            row[name] = value
+    return(row)
+
+
+class EventColumns(object):
+    '''
+    Typed column buffers for the events of one type
+    Columns are added as new payload fields show up, and a column's type is widened if a later value needs it
+    (int to float, anything to category); events without a field get the column type's missing value
+    '''
+    def __init__(self):
+        self.num_rows = 0
+        self.types = OrderedDict()
+        self.buffers = {}
+        self.category_codes = {}
+        # the rows without a value in each column: every row before the column was added, and the set of later ones,
+        # so widening a column can give them the missing value of the new type, not e.g. the int 0 as the category '0'
+        self.first_rows = {}
+        self.missing_rows = {}
+
+    def add_column(self, name, column_type):
+        self.types[name] = column_type
+        self.first_rows[name] = self.num_rows
+        self.missing_rows[name] = set()
+        self.buffers[name] = array(column_types[column_type][0])
+        if column_type == 'category':
+            self.category_codes[name] = OrderedDict()
+            self.buffers[name].extend([self.code(name, '')] * self.num_rows)
+        else:
+            self.buffers[name].extend([self.missing(column_type)] * self.num_rows)
+
+    def missing(self, column_type):
+        value = column_types[column_type][2]
+        return(value if value != None else 0)
+
+    def code(self, name, value):
+        '''
+        Return the category code for a value, adding it to the column's categories if it is new
+        '''
+        if not isinstance(value, str):
+            value = json.dumps(value, sort_keys = True) if isinstance(value, (list, dict)) else str(value)
+        codes = self.category_codes[name]
+        code = codes.get(value)
+        if code == None:
+            code = len(codes)
+            codes[value] = code
+        return(code)
+
+    def widen(self, name, column_type):
+        '''
+        Change the type of a column, converting the values added so far; rows without a value get the new type's missing value
+        '''
+        first_row = self.first_rows[name]
+        missing_rows = self.missing_rows[name]
+        values = list(self.buffers[name])
+        if column_type == 'category':
+            self.category_codes[name] = OrderedDict()
+            missing = self.code(name, '')
+            values = [missing if i < first_row or i in missing_rows else self.code(name, value) for i, value in enumerate(values)]
+        else:
+            missing = column_types[column_type][2]
+            values = [missing if i < first_row or i in missing_rows else value for i, value in enumerate(values)]
+        self.buffers[name] = array(column_types[column_type][0], values)
+        self.types[name] = column_type
+
+    def add_row(self, row):
+        for name, value in row.items():
+            if value == None:
+                continue
+            column_type = value_type(value)
+            if name not in self.types:
+                self.add_column(name, column_type)
+            elif self.types[name] != column_type:
+                column_type = merge_types(self.types[name], column_type)
+                if column_type != self.types[name]:
+                    self.widen(name, column_type)
+            column_type = self.types[name]
+            if column_type == 'category':
+                self.buffers[name].append(self.code(name, value))
+            elif column_type == 'float':
+                self.buffers[name].append(float(value))
+            else:
+                self.buffers[name].append(int(value))
+        self.num_rows += 1
+        for name, column_type in self.types.items():
+            if len(self.buffers[name]) < self.num_rows:
+                self.missing_rows[name].add(self.num_rows - 1)
+                self.buffers[name].append(self.code(name, '') if column_type == 'category' else self.missing(column_type))
+
+    def build(self):
+        '''
+        Return a columnar.ParticipantTable of the events collected so far
+        '''
+        columns = OrderedDict()
+        categories = {}
+        schema = []
+        for name, column_type in self.types.items():
+            columns[name] = np.frombuffer(self.buffers[name], dtype = np.dtype(self.buffers[name].typecode)).astype(column_types[column_type][1])
+            if column_type == 'category':
+                categories[name] = list(self.category_codes[name].keys())
+            schema.append((name, None, None, column_type))
+        return(ParticipantTable(columns = columns, categories = categories, schema = schema))
+
+
+class EventTableBuilder(object):
+    '''
+    Collects telemetry events into one set of columns per event type
+
+    >>> builder = EventTableBuilder()
+    >>> for event in jsonstream.iter_array_items('telemetry.json'): builder.add_event(event)
+    >>> tables = builder.build()
+    '''
+    def __init__(self):
+        self.columns = OrderedDict()
+        self.num_events = 0
+        # event times repeat a lot, so each time string is parsed once
+        self.times = {}
+
+    def event_time(self, value):
+        '''
+        Return the seconds since the epoch for an event time, e.g. '2017-03-17T00:38:32+0000'
+        '''
+        seconds = self.times.get(value)
+        if seconds == None:
+            seconds = float(calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')))
+            zone = value[19:].replace(':', '')
+            if len(zone) == 5 and zone[0] in '+-':
+                offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+                seconds -= offset if zone[0] == '+' else -offset
+            self.times[value] = seconds
+        return(seconds)
+
+    def add_event(self, event):
+        event_type = event.get('type', '')
+        if event_type not in self.columns:
+            self.columns[event_type] = EventColumns()
+        row = OrderedDict()
+        row['time'] = self.event_time(event['time']) if event.get('time') != None else None
+        self.columns[event_type].add_row(flatten_payload(event.get('payload') or {}, row))
+        self.num_events += 1
+
+    def build(self):
+        return(EventTables(OrderedDict((event_type, columns.build()) for event_type, columns in self.columns.items())))
+
+
+class EventTables(object):
+    '''
+    The telemetry of a match, as a columnar table per event type
+
+    >>> tables = EventTables.load('saved_matches/<match ID>_telemetry.vtel')
+    >>> tables.event_types()
+    >>> tables['DealDamage']['Damage'].sum()
+    >>> tables.to_dataframe('KillActor')
+    '''
+    def __init__(self, tables):
+        self.tables = tables
+
+    def __len__(self):
+        return(sum(len(table) for table in self.tables.values()))
+
+    def __getitem__(self, event_type):
+        return(self.tables[event_type])
+
+    def event_types(self):
+        return(list(self.tables.keys()))
+
+    def to_dataframe(self, event_type, columns = None):
+        return(self.tables[event_type].to_dataframe(columns = columns))
+
+    def save(self, output_file, compress_level = 6):
+        '''
+        Save the tables to a compressed file; written to a temporary file first, so a file is never left half written
+        '''
+        parts = [table.to_bytes() for table in self.tables.values()]
+        header = json.dumps([[event_type, len(part)] for event_type, part in zip(self.tables.keys(), parts)], separators = (',', ':')).encode('utf-8')
+        data = zlib.compress(header_length.pack(len(header)) + header + b''.join(parts), compress_level)
+        temp_file = output_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(file_magic)
+            f.write(data)
+        os.replace(temp_file, output_file)
+        return(len(file_magic) + len(data))
+
+    @classmethod
+    def load(cls, input_file):
+        with open(input_file, 'rb') as f:
+            data = f.read()
+        if data[:len(file_magic)] != file_magic:
+            raise ValueError('Not a telemetry file: {0}'.format(input_file))
+        data = zlib.decompress(data[len(file_magic):])
+        num_header_bytes = header_length.unpack(data[:header_length.size])[0]
+        start = header_length.size + num_header_bytes
+        tables = OrderedDict()
+        for event_type, nbytes in json.loads(data[header_length.size:start].decode('utf-8')):
+            tables[event_type] = ParticipantTable.from_bytes(data[start:start + nbytes])
+            start += nbytes
+        return(cls(tables))
+
+
+# ~~~~~ DOWNLOADS ~~~~~ #
+def count_bytes(chunks, counter):
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield(chunk)
+
+def download_telemetry(client, url, output_file, chunk_size = 65536):
+    '''
+    Download a telemetry file, parsing its events into columns as the response arrives, and save the tables
+    client is anything with a requests-style get(), e.g. a requests.Session or vainstats.APIClient
+    Returns the number of events, and the bytes downloaded and saved
+    '''
+    response = client.get(url, stream = True)
+    response.raise_for_status()
+    num_bytes = [0]
+    builder = EventTableBuilder()
+    stream = jsonstream.PayloadStream(count_bytes(response.iter_content(chunk_size = chunk_size), num_bytes))
+    for event in stream.array_items():
+        builder.add_event(event)
+    saved_bytes = builder.build().save(output_file)
+    return(builder.num_events, num_bytes[0], saved_bytes)
+
+def download_match_telemetry(assets, output_dir, client = None, workers = 8, base_url = None, overwrite = False, quiet = False):
+    '''
+    Download the telemetry for a list of (match ID, URL) to output_dir, with at most 'workers' downloads at once
+    Matches that already have telemetry in output_dir are skipped, unless overwrite is True
+    Returns the number of matches, events, bytes downloaded and saved, failed downloads, and the time taken
+    '''
+    if client == None:
+        import requests
+        client = requests.Session()
+    stats = OrderedDict([('matches', 0), ('skipped', 0), ('failed', 0), ('events', 0), ('bytes', 0), ('saved_bytes', 0), ('seconds', 0.0)])
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as pool:
+        futures = {}
+        for match_id, url in assets:
+            output_file = telemetry_path(output_dir, match_id)
+            if overwrite == False and os.path.exists(output_file):
+                stats['skipped'] += 1
+                continue
+            futures[pool.submit(download_telemetry, client, rebase_url(url, base_url), output_file)] = match_id
+        for future in as_completed(futures):
+            try:
+                num_events, num_bytes, saved_bytes = future.result()
+            except (IOError, ValueError) as e:
+                stats['failed'] += 1
+                print('Telemetry download failed for match {0}: {1}'.format(futures[future], e))
+                continue
+            stats['matches'] += 1
+            stats['events'] += num_events
+            stats['bytes'] += num_bytes
+            stats['saved_bytes'] += saved_bytes
+            if quiet == False:
+                print('Saved telemetry: {0}, {1} events'.format(telemetry_path(output_dir, futures[future]), num_events))
+    stats['seconds'] = time.time() - start_time
+    return(stats)
+
+def print_telemetry_rate(stats):
+    elapsed = max(stats['seconds'], 1e-9)
+    print('Telemetry: {0} matches, {1} events, {2:.1f} MB downloaded, {3:.1f} MB saved in {4:.2f}s ({5:.0f} events/s, {6:.1f} MB/s); {7} already saved, {8} failed'.format(
+    stats['matches'], stats['events'], stats['bytes'] / 1e6, stats['saved_bytes'] / 1e6, elapsed,
+    stats['events'] / elapsed, stats['bytes'] / 1e6 / elapsed, stats['skipped'], stats['failed']))
+
+def run():
+    '''
+    Arg parsing for the script when run from command line
+    '''
+    import columnar
+    parser = argparse.ArgumentParser(description='Download and parse the telemetry of harvested matches')
+    parser.add_argument("input_paths", nargs = '+', help="Match store directories, saved_matches directories, or API payload JSON files")
+    parser.add_argument("-o", default = None, dest = 'output_dir', metavar = 'output_dir', help="Directory to save the telemetry to (default: next to the matches)")
+    parser.add_argument("-w", "--workers", default = 8, type = int, dest = 'workers', metavar = 'workers', help="Number of telemetry files to download at once")
+    parser.add_argument("--base-url", default = None, dest = 'base_url', metavar = 'base_url', help="Download the assets from this server instead of the asset URL's host, e.g. a local file server")
+    parser.add_argument("--overwrite", default = False, action = 'store_true', dest = 'overwrite', help="Download telemetry again for matches that already have it")
+    parser.add_argument("-q", "--quiet", default = False, action = 'store_true', dest = 'quiet', help="Only print the totals")
+    args = parser.parse_args()
+    for input_path in args.input_paths:
+        output_dir = args.output_dir
+        if output_dir == None:
+            output_dir = input_path if os.path.isdir(input_path) else os.path.dirname(os.path.abspath(input_path))
+        assets = []
+        for payload in columnar.iter_payloads(input_path):
+            assets.extend(telemetry_assets(payload))
+        stats = download_match_telemetry(assets, output_dir, workers = args.workers, base_url = args.base_url, overwrite = args.overwrite, quiet = args.quiet)
+        print_telemetry_rate(stats)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Tests for the regression check of benchmarks.py
+
+python -m unittest test_benchmarks
+'''
+import unittest
+
+from benchmarks import compare_results
+
+
+def make_result(name, seconds, items = 100, suite = 'match', corpus = 'demo', bytes_per_item = None):
+    result = {'suite': suite, 'name': name, 'corpus': corpus, 'items': items, 'seconds': seconds, 'per_item': seconds / items}
+    if bytes_per_item != None:
+        result['bytes_per_item'] = bytes_per_item
+    return(result)
+
+def compare(baseline, results, **kwargs):
+    return({key[1]: (change, regressed) for key, old, new, change, regressed in compare_results({'results': baseline}, {'results': results}, **kwargs)})
+
+
+class CompareResultsTest(unittest.TestCase):
+    def test_slower_past_threshold_regressed(self):
+        comparison = compare([make_result('fail_finder', 1.0)], [make_result('fail_finder', 1.5)])
+        change, regressed = comparison['fail_finder']
+        self.assertAlmostEqual(change, 0.5)
+        self.assertTrue(regressed)
+
+    def test_slower_within_threshold_not_regressed(self):
+        comparison = compare([make_result('fail_finder', 1.0)], [make_result('fail_finder', 1.05)])
+        self.assertFalse(comparison['fail_finder'][1])
+        comparison = compare([make_result('fail_finder', 1.0)], [make_result('fail_finder', 1.05)], threshold = 0.01)
+        self.assertTrue(comparison['fail_finder'][1])
+
+    def test_faster_not_regressed(self):
+        comparison = compare([make_result('fail_finder', 1.0)], [make_result('fail_finder', 0.5)])
+        change, regressed = comparison['fail_finder']
+        self.assertAlmostEqual(change, -0.5)
+        self.assertFalse(regressed)
+
+    def test_small_total_change_not_regressed(self):
+        # twice as slow, but only 0.0005s more in total
+        comparison = compare([make_result('html_df_table', 0.0005)], [make_result('html_df_table', 0.001)])
+        self.assertFalse(comparison['html_df_table'][1])
+        comparison = compare([make_result('html_df_table', 0.0005)], [make_result('html_df_table', 0.001)], min_seconds = 0.0001)
+        self.assertTrue(comparison['html_df_table'][1])
+
+    def test_per_item_time_compared(self):
+        # more time in total, but over twice the items
+        comparison = compare([make_result('fail_finder', 1.0, items = 100)], [make_result('fail_finder', 1.5, items = 200)])
+        change, regressed = comparison['fail_finder']
+        self.assertAlmostEqual(change, -0.25)
+        self.assertFalse(regressed)
+
+    def test_memory_compared_by_bytes_per_item(self):
+        baseline = [make_result('match_records', 1.0, suite = 'memory', bytes_per_item = 4000)]
+        comparison = compare(baseline, [make_result('match_records', 2.0, suite = 'memory', bytes_per_item = 4100)])
+        self.assertFalse(comparison['match_records'][1])
+        comparison = compare(baseline, [make_result('match_records', 1.0, suite = 'memory', bytes_per_item = 5000)])
+        change, regressed = comparison['match_records']
+        self.assertAlmostEqual(change, 0.25)
+        self.assertTrue(regressed)
+
+    def test_only_benchmarks_in_both_runs(self):
+        comparison = compare([make_result('fail_finder', 1.0), make_result('old', 1.0)], [make_result('fail_finder', 1.0), make_result('new', 1.0)])
+        self.assertEqual(list(comparison.keys()), ['fail_finder'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,6 +15,12 @@ from dash.dependencies import Input, Output
 import plotly.graph_objs as go
 import plotly.plotly as py
 import pandas as pd
+import numpy as np
+import threading
+from collections import OrderedDict
+
+# app modules
+from payload import PayloadIndex
 
 
 
@@ -66,6 +72,96 @@ def load_json(input_file):
         my_item = json.load(f)
     return(my_item)
 
+class LRUCache(object):
+    '''
+    Bounded least-recently-used cache, with hit and miss counters
+    Values are built outside the lock, at most once per key while they stay in the cache;
+    concurrent callbacks for a key that is being built wait for that build instead of starting their own
+
+    >>> cache = LRUCache(max_size = 2)
+    >>> cache.get('a', builder = lambda key: key.upper())
+    'A'
+    '''
+    def __init__(self, max_size = 32):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.building = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return(len(self.items))
+
+    def get(self, key, builder):
+        '''
+        Return the cached value for the key, calling builder(key) to make it on a miss
+        '''
+        from concurrent.futures import Future
+        with self.lock:
+            if key in self.items:
+                self.hits += 1
+                self.items.move_to_end(key)
+                return(self.items[key])
+            self.misses += 1
+            future = self.building.get(key)
+            if future != None:
+                waiting = True
+            else:
+                waiting = False
+                future = Future()
+                self.building[key] = future
+                generation = self.generation
+        if waiting == True:
+            return(future.result())
+        try:
+            value = builder(key)
+        except Exception as error:
+            with self.lock:
+                if self.building.get(key) is future:
+                    del self.building[key]
+            future.set_exception(error)
+            raise
+        with self.lock:
+            if self.building.get(key) is future:
+                del self.building[key]
+            # a value built before clear() may be out of date, so it is returned but not kept
+            if generation == self.generation:
+                self.items[key] = value
+                while len(self.items) > self.max_size:
+                    self.items.popitem(last = False)
+        future.set_result(value)
+        return(value)
+
+    def clear(self):
+        '''
+        Drop all cached values, and do not keep the values being built; the counters are kept
+        '''
+        with self.lock:
+            self.items.clear()
+            self.building.clear()
+            self.generation += 1
+
+    def stats(self):
+        '''
+        Return the cache counters
+        '''
+        with self.lock:
+            return({'size': len(self.items), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses})
+
+def load_json_index(input_file):
+    '''
+    Load a JSON:API payload file into a PayloadIndex one match at a time,
+    without holding the whole parsed document in memory
+    '''
+    import jsonstream
+    logger.debug("Streaming data from JSON")
+    index = PayloadIndex()
+    for match_payload in jsonstream.iter_match_payloads(input_file, in_order = True):
+        index.add(match_payload)
+    return(index)
+
 def get_api_key(keyfile = "api_keys/key.txt"):
     '''
     Extract the API key string from the first line of the give text file
@@ -91,7 +187,10 @@ def find_coltypes(df, coltype):
 def get_match(data, match_id):
     '''
     Search a payload for a specific match
+    data can be a raw payload or a PayloadIndex built from it
     '''
+    if isinstance(data, PayloadIndex):
+        return(data.match(match_id))
     logger.debug('Searching for match_id in data')
     for item in data['data']:
         if item['id'] == match_id:
@@ -111,73 +210,282 @@ def get_roster_ids(match):
 def get_rosters(roster_ids, data):
     '''
     Get the team rosters for a match
+    data can be a raw payload or a PayloadIndex built from it
     '''
+    if isinstance(data, PayloadIndex):
+        return(data.resolve([('roster', id) for id in roster_ids]))
     logger.debug('Searching for rosters in data')
-    rosters = []
-    # for item in match['relationships']['rosters']['data']:
+    rosters = {}
+    wanted_ids = set(roster_ids)
     for item in data['included']:
-        for id in roster_ids:
-            if item['type'] == 'roster':
-                if item['id'] == id:
-                    rosters.append(item)
-    return(rosters)
+        if item['type'] == 'roster' and item['id'] in wanted_ids:
+            rosters[item['id']] = item
+    return([rosters[id] for id in roster_ids if id in rosters])
 
 
 # ~~~~~ API PAYLOAD DATA ~~~~~ #
+def index_glmatches(matches):
+    '''
+    Map each match ID to its gamelocker match object, so that callbacks don't need to search the list
+    '''
+    return({match.id: match for match in matches})
+
 def get_glmatch(data, match_id):
     '''
     Find the matching gamelocker match
+    data can be a list of matches or an index from index_glmatches
     '''
+    if isinstance(data, dict):
+        return(data.get(match_id))
     logger.debug('Searching for match_id in data')
     for item in data:
         if item.id == match_id:
             return(item)
 
-def glparticipant_dict(participant, roster_id):
+# (column name, source, key, column type) for each column of make_glparticipant_stats_df
+# the level, karmaLevel and skillTier columns are the player's, not the participant's
+# the columns are read from the gamelocker objects the app gets from the API, not from records.Participant:
+# the records only keep the fields they know, and drop the itemGrants, itemSells and itemUses stats this df shows
+glparticipant_schema = [
+('id', 'participant', 'id', 'str'),
+('hero', 'participant', 'actor', 'str'),
+('skinKey', 'participant_stats', 'skinKey', 'str'),
+('assists', 'participant_stats', 'assists', 'int'),
+('crystalMineCaptures', 'participant_stats', 'crystalMineCaptures', 'int'),
+('deaths', 'participant_stats', 'deaths', 'int'),
+('farm', 'participant_stats', 'farm', 'int'),
+('firstAfkTime', 'participant_stats', 'firstAfkTime', 'int'),
+('gold', 'participant_stats', 'gold', 'int'),
+('goldMineCaptures', 'participant_stats', 'goldMineCaptures', 'int'),
+('itemGrants', 'participant_stats', 'itemGrants', 'object'),
+('itemSells', 'participant_stats', 'itemSells', 'object'),
+('itemUses', 'participant_stats', 'itemUses', 'object'),
+('items', 'participant_stats', 'items', 'object'),
+('jungleKills', 'participant_stats', 'jungleKills', 'int'),
+('kills', 'participant_stats', 'kills', 'int'),
+('krakenCaptures', 'participant_stats', 'krakenCaptures', 'int'),
+('minionKills', 'participant_stats', 'minionKills', 'int'),
+('nonJungleMinionKills', 'participant_stats', 'nonJungleMinionKills', 'int'),
+('turretCaptures', 'participant_stats', 'turretCaptures', 'int'),
+('wentAfk', 'participant_stats', 'wentAfk', 'bool'),
+('winner', 'participant_stats', 'winner', 'bool'),
+('name', 'player', 'name', 'str'),
+('elo_earned_season_4', 'player_stats', 'elo_earned_season_4', 'int'),
+('elo_earned_season_5', 'player_stats', 'elo_earned_season_5', 'int'),
+('elo_earned_season_6', 'player_stats', 'elo_earned_season_6', 'int'),
+('elo_earned_season_7', 'player_stats', 'elo_earned_season_7', 'int'),
+('karmaLevel', 'player_stats', 'karmaLevel', 'int'),
+('level', 'player_stats', 'level', 'int'),
+('lifetimeGold', 'player_stats', 'lifetimeGold', 'int'),
+('lossStreak', 'player_stats', 'lossStreak', 'int'),
+('played', 'player_stats', 'played', 'int'),
+('played_ranked', 'player_stats', 'played_ranked', 'int'),
+('skillTier', 'player_stats', 'skillTier', 'int'),
+('winStreak', 'player_stats', 'winStreak', 'int'),
+('wins', 'player_stats', 'wins', 'int'),
+('xp', 'player_stats', 'xp', 'int'),
+('roster_id', 'roster', 'id', 'str'),
+('side', 'roster_stats', 'side', 'str'),
+]
+
+# value converter, missing value, and numpy dtype for each column type
+glparticipant_types = {
+'int': (int, 0, np.int64),
+'bool': (bool, False, np.bool_),
+'str': (str, '', object),
+'object': (lambda value: value, None, object)
+}
+
+# the stats found without a column in glparticipant_schema, each logged once
+glparticipant_extra_stats = set()
+
+
+class GLParticipantRecords(object):
     '''
-    Make a big dict out of the participant entry from a match
+    Collects one flat, typed record per participant of gamelocker matches, and builds a df with all of them at once
+
+    >>> records = GLParticipantRecords()
+    >>> records.add_match(match)
+    >>> stats_df = records.build()
     '''
-    d = {**participant.stats,
-    **{'id': participant.id},
-    **{'hero': participant.actor},
-    **participant.player.stats,
-    **{'roster_id': roster_id},
-    **{'name': participant.player.name}}
-    return(d)
+    def __init__(self, schema = glparticipant_schema):
+        self.schema = schema
+        self.columns = OrderedDict((name, []) for name, source, key, column_type in schema)
+        # stats the schema has no column for, e.g. new API fields, kept as they are in object columns
+        self.extra_columns = OrderedDict()
+
+    def __len__(self):
+        return(len(next(iter(self.columns.values()))))
+
+    def add_match(self, match):
+        for roster in match.rosters:
+            for participant in roster.participants:
+                self.add_participant(roster = roster, participant = participant)
+
+    def add_participant(self, roster, participant):
+        sources = {
+        'participant': {'id': participant.id, 'actor': participant.actor},
+        'participant_stats': participant.stats,
+        'player': {'id': participant.player.id, 'name': participant.player.name},
+        'player_stats': participant.player.stats,
+        'roster': {'id': roster.id},
+        'roster_stats': roster.stats
+        }
+        num_rows = len(self)
+        for name, source, key, column_type in self.schema:
+            convert, missing, dtype = glparticipant_types[column_type]
+            value = sources[source].get(key)
+            self.columns[name].append(missing if value == None else convert(value))
+        # the player's stats win over the participant's for the same key, as in the schema
+        extra_stats = OrderedDict()
+        for source in ['participant_stats', 'player_stats']:
+            for key, value in sources[source].items():
+                if key not in self.columns:
+                    extra_stats[key] = value
+        for key, value in extra_stats.items():
+            if key not in self.extra_columns:
+                if key not in glparticipant_extra_stats:
+                    glparticipant_extra_stats.add(key)
+                    logger.info("Adding an object column for a stat that is not in glparticipant_schema: {0}".format(key))
+                self.extra_columns[key] = [None] * num_rows
+            self.extra_columns[key].append(value)
+        for key, column in self.extra_columns.items():
+            if len(column) == num_rows:
+                column.append(None)
 
-def make_glparticipant_stats_df(match):
+    def build(self):
+        '''
+        Return a df of the records, with the dtypes from the schema, followed by the object columns of any other stats
+        '''
+        data = OrderedDict()
+        for name, source, key, column_type in self.schema:
+            # a Series, since np.array would turn a column of equal length lists (e.g. items) into a 2D array
+            data[name] = pd.Series(self.columns[name], dtype = glparticipant_types[column_type][2])
+        for name, column in self.extra_columns.items():
+            data[name] = pd.Series(column, dtype = object)
+        return(pd.DataFrame(data))
+
+def make_glparticipant_stats_df(match = None, matches = None):
     '''
-    Make a df with the player and participant stats
+    Make a df with the player and participant stats for a match, or for every participant of a list of matches
     '''
-    # [participant.player.name for participant in match.rosters[0].participants]
-    roster_df_list = [pd.DataFrame.from_dict({**roster.stats, **{'roster_id': roster.id}}, orient='index') for roster in match.rosters]
-    roster_df = pd.concat(roster_df_list, axis=1).transpose()
-    #
-    participant_stats_df_list = [[pd.DataFrame.from_dict(glparticipant_dict(participant = participant, roster_id = roster.id), orient='index') for participant in roster.participants] for roster in match.rosters]
-    participant_stats_df = pd.concat([pd.concat(df_list, axis=1).transpose() for df_list in participant_stats_df_list])
-    #
-    participant_stats_df_merge = pd.merge(participant_stats_df, roster_df[['roster_id', 'side']], on='roster_id')
-    return(participant_stats_df_merge)
+    records = GLParticipantRecords()
+    for item in (matches if matches != None else [match]):
+        records.add_match(item)
+    return(records.build())
+
+
+
+# ~~~~~ APP CALLBACKS ~~~~~ #
+class PreventUpdate(Exception):
+    '''
+    Raised by a callback to leave its output, and every callback that depends on it, as it is
+    '''
+    timed_error = False
+
+def allow_prevent_update(app):
+    '''
+    Make the callbacks registered after this answer with no new props when they raise PreventUpdate
+    Dash sends a callback's return value as the new value of its output, which runs every callback that depends on it,
+    even when the value has not changed; with no props the page is left as it is
+    '''
+    import json
+    import flask
+    register_callback = app.callback
+    def callback(output, *args, **kwargs):
+        register = register_callback(output, *args, **kwargs)
+        def decorator(function):
+            dash_callback = register(function)
+            callback_id = '{0}.{1}'.format(output.component_id, output.component_property)
+            def dispatch(*args):
+                try:
+                    return(dash_callback(*args))
+                except PreventUpdate:
+                    return(flask.Response(json.dumps({'response': {'props': {}}}), mimetype = 'application/json'))
+            app.callback_map[callback_id]['callback'] = dispatch
+            return(dash_callback)
+        return(decorator)
+    app.callback = callback
 
 
 
 # ~~~~~ APP COMPONENTS ~~~~~ #
-def html_df_table(df, max_rows = 10):
+def sort_order(values, ascending = True):
+    '''
+    Return the row positions that sort a column, keeping ties in their original order; missing values go last
+    Categoricals are sorted by their labels
+    '''
+    if hasattr(values, 'cat'):
+        # rank of each category label, looked up by code
+        label_ranks = np.argsort(np.argsort(np.asarray(values.cat.categories, dtype = object).astype(str)))
+        codes = values.cat.codes.values
+        values = pd.Series(np.where(codes < 0, np.nan, label_ranks[codes]))
+    values = pd.Series(np.asarray(values)).reset_index(drop = True)
+    try:
+        order = values.sort_values(ascending = ascending, kind = 'mergesort', na_position = 'last').index.values
+    except TypeError:
+        # mixed types in an object column
+        order = values.astype(str).sort_values(ascending = ascending, kind = 'mergesort').index.values
+    return(order)
+
+def count_pages(num_rows, page_size):
+    '''
+    Return the number of pages needed to show num_rows rows; an empty table still has one page
+    '''
+    return(max(1, -(-num_rows // page_size)))
+
+def df_page(df, page = 0, page_size = 10, sort_by = None, ascending = True):
+    '''
+    Return the rows of a df for one page, optionally sorted by a column, and the number of pages
+    Only the rows of the page are copied out of the df
+    '''
+    num_pages = count_pages(len(df), page_size)
+    page = min(max(int(page or 0), 0), num_pages - 1)
+    start = page * page_size
+    stop = start + page_size
+    if sort_by != None and sort_by in df.columns:
+        rows = sort_order(df[sort_by], ascending = ascending)[start:stop]
+        return(df.iloc[rows], num_pages)
+    return(df.iloc[start:stop], num_pages)
+
+def html_df_table(df, max_rows = 10, page = 0, sort_by = None, ascending = True):
     '''
     Return HTML table to display on the app webpage
+    Shows one page of max_rows rows, optionally sorted by a column
     '''
+    page_df, num_pages = df_page(df, page = page, page_size = max_rows, sort_by = sort_by, ascending = ascending)
+    # read each column's values once instead of looking up every cell; booleans are shown as text
+    columns = [page_df.iloc[:, i] for i in range(len(page_df.columns))]
+    columns = [(values.astype(str) if values.dtype == bool else values).tolist() for values in columns]
     return(
     html.Table(
     # Header
     [html.Tr([html.Th(col) for col in df.columns])] +
 
     # Body
-    [html.Tr([
-        html.Td(df.iloc[i][col]) for col in df.columns
-    ]) for i in range(min(len(df), max_rows))]
+    [html.Tr([html.Td(value) for value in row]) for row in zip(*columns)]
     )
     )
 
+def table_controls(id, columns, sort_by = None):
+    '''
+    Return the paging and sorting controls for a table rendered with html_df_table
+    The controls have the IDs: <id>-sort-by, <id>-sort-order, <id>-page
+    '''
+    return(html.Div(children = [
+        html.Label('Sort by:'),
+        dcc.Dropdown(
+            id = '{0}-sort-by'.format(id),
+            options = [{'label': col, 'value': col} for col in columns],
+            value = sort_by),
+        dcc.RadioItems(
+            id = '{0}-sort-order'.format(id),
+            options = [{'label': 'Ascending', 'value': 'ascending'}, {'label': 'Descending', 'value': 'descending'}],
+            value = 'descending'),
+        html.Label('Page:'),
+        dcc.Input(id = '{0}-page'.format(id), type = 'number', value = 1, min = 1)
+        ], id = '{0}-controls'.format(id)))
+
 def roster_df_plot(roster_df, plot_type):
     '''
     Returns a plot for a provided roster_df, where plot_type is a column names in the df that isn't 'side';
@@ -8,7 +8,33 @@ import requests
 import json
 import argparse
 import sys
+import time
+import random
+import threading
+import heapq
+import calendar
+from email.utils import parsedate_tz, mktime_tz
+from store import MatchStore, split_payload
+from players import PlayerRegistry
+from payload import iter_payload_matches
+from checkpoint import HarvestState
+import jsonstream
+import records
+import aggregate
+import telemetry
+from matchindex import MatchIndex
+from httpcache import ResponseCache, CachedResponse, record_stream
 from datetime import datetime, timedelta
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError: # Python 2
+    from urlparse import urlparse, parse_qs
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
 
 
 # ~~~~ CUSTOM FUNCTIONS ~~~~~~ #
@@ -72,17 +98,19 @@ def get_api_key(keyfile = "api_keys/key.txt"):
             keys.append(line.strip())
     return(keys[0])
 
+# the API shards, in the order they are searched with -r all
+region_dict = OrderedDict([
+    ('na', 'North America'),
+    ('eu', 'Europe'),
+    ('sa', 'South America'),
+    ('ea', 'East Asia'),
+    ('sg', 'Southeast Asia (SEA)')
+])
+
 def get_region_name(region):
     '''
     Return the full region name from the given abbreviation
     '''
-    region_dict = {
-    'na': 'North America',
-    'eu': 'Europe',
-    'sa': 'South America',
-    'ea': 'East Asia',
-    'sg': 'Southeast Asia (SEA)'
-    }
     if region in region_dict.keys():
         return(region_dict[region])
     else:
@@ -92,25 +120,33 @@ def get_region_name(region):
         print("Exiting...")
         sys.exit()
 
-def print_match(match):
+def get_regions(region):
+    '''
+    Return the list of regions for a -r argument: one region, a comma separated list of regions, or 'all'
+    '''
+    if region == 'all':
+        return(list(region_dict.keys()))
+    regions = list(OrderedDict.fromkeys(name.strip() for name in region.split(',') if name.strip() != ''))
+    for name in regions:
+        get_region_name(name)
+    return(regions)
+
+def print_match(match, region = None):
     '''
-    Print out information from a match item
+    Print out information from a match record, or a match item
     '''
     import time
     # my_debugger(locals().copy())
-    # if match['type'] != 'match':
-        # sys.exit()
-    match_gameMode = match['attributes']['gameMode']
-    match_id = match['id']
-    match_createdAt = match['attributes']['createdAt']
-    match_endGameReason = match['attributes']['stats']['endGameReason']
-    match_duration = match['attributes']['duration']
-    match_duration = time.strftime("%M:%S", time.gmtime(match_duration))
+    if isinstance(match, dict):
+        match = records.Match.from_item(match)
+    match_duration = time.strftime("%M:%S", time.gmtime(match.duration))
     print_div(message = "Found match")
-    print('id: {0}'.format(match_id))
-    print('outcome: {0}'.format(match_endGameReason))
-    print('type: {0}'.format(match_gameMode))
-    print('date: {0}'.format(match_createdAt))
+    print('id: {0}'.format(match.id))
+    print('outcome: {0}'.format(match.endGameReason))
+    print('type: {0}'.format(match.gameMode))
+    print('date: {0}'.format(match.createdAt))
+    if region != None:
+        print('region: {0}'.format(region))
     print('duration: {0}'.format(match_duration))
     print("")
 
@@ -143,19 +179,21 @@ def print_debug_query(header, query, match_url):
     print_str_source("dat", "json.loads(match.content)", quote = False)
     print_div()
 
-def get_match_data(username, key, match_url, match_ID, days_to_subtract, page_limit, debug_mode, i_mode, harvest_mode, fail_mode):
+def build_header(key):
     '''
-    Get data from a game match
+    Build the HTTP header for API queries
     '''
-    search_time = (datetime.today() - timedelta(days=days_to_subtract)).replace(microsecond=0).isoformat()
-    search_time = str(search_time + "Z")
-    print("Match ID is: {0}".format(match_ID))
-    print("search time is: {0}".format(search_time))
     header = {
         "Authorization": key,
         "X-TITLE-ID": "semc-vainglory",
         "Accept": "application/vnd.api+json"
     }
+    return(header)
+
+def build_query(username, search_time, page_limit):
+    '''
+    Build the query parameters for an API match search
+    '''
     query = {
         "sort": "-createdAt", # sort most -> lease recent
         "filter[createdAt-start]": search_time, # "2017-02-28T13:25:30Z",
@@ -163,11 +201,156 @@ def get_match_data(username, key, match_url, match_ID, days_to_subtract, page_li
     }
     if username != None:
         query["filter[playerNames]"] = username
+    return(query)
+
+def get_search_time(days_to_subtract):
+    '''
+    Get the API formatted timestamp for the start of the search window
+    '''
+    search_time = (datetime.today() - timedelta(days=days_to_subtract)).replace(microsecond=0).isoformat()
+    return(str(search_time + "Z"))
+
+class APIClient(object):
+    '''
+    Shared HTTP client for all API queries
+    Keeps a pool of open connections, sets a timeout on every request,
+    and retries rate limited (429) and server error (5xx) responses with jittered exponential backoff,
+    waiting for the 'Retry-After' time when the API sends one
+    With a httpcache.ResponseCache, successful responses are cached and repeated requests are answered from the cache
+    '''
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout = (5, 30), max_retries = 5, backoff_base = 0.5, backoff_max = 60, pool_size = 10, cache = None):
+        self.timeout = timeout
+        self.cache = cache
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.adapter = adapter
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_errors = 0
+
+    def get(self, url, headers = None, params = None, stream = False):
+        '''
+        Send a GET request, retrying until it succeeds or the retries run out
+        Returns the last response; connection errors and timeouts are raised once the retries run out
+        With stream = True the response body is read as it is used, e.g. by jsonstream
+        '''
+        if self.cache != None:
+            body = self.cache.get(url, params)
+            if body != None:
+                return(CachedResponse(url, body))
+        attempt = 0
+        while True:
+            with self.lock:
+                self.num_requests += 1
+            try:
+                response = self.session.get(url, headers = headers, params = params, timeout = self.timeout, stream = stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                with self.lock:
+                    self.num_errors += 1
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            if response != None and (response.status_code not in self.retry_status or attempt >= self.max_retries):
+                if self.cache != None and response.status_code == 200:
+                    self.cache_response(url, params, response, stream)
+                return(response)
+            delay = self.retry_delay(attempt, response)
+            with self.lock:
+                self.num_retries += 1
+            time.sleep(delay)
+            attempt += 1
+
+    def cache_response(self, url, params, response, stream = False):
+        '''
+        Add a response to the cache; a streamed response is added once it has been read to the end
+        '''
+        if stream == True:
+            record_stream(response, lambda body: self.cache.put(url, params, body))
+        else:
+            self.cache.put(url, params, response.content)
+
+    def retry_delay(self, attempt, response = None):
+        '''
+        Seconds to wait before the next try; the 'Retry-After' header if present, otherwise exponential backoff with full jitter
+        '''
+        if response != None and response.headers.get('Retry-After') != None:
+            retry_after = response.headers['Retry-After']
+            try:
+                return(min(self.backoff_max, max(0, float(retry_after))))
+            except ValueError:
+                retry_date = parsedate_tz(retry_after)
+                if retry_date != None:
+                    return(min(self.backoff_max, max(0, mktime_tz(retry_date) - time.time())))
+        return(random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt))))
+
+    def num_connections(self):
+        '''
+        Number of new connections opened by the connection pools
+        '''
+        pools = self.adapter.poolmanager.pools
+        return(sum(pools[key].num_connections for key in pools.keys()))
+
+    def stats(self):
+        '''
+        Return the request, retry and connection reuse counters
+        '''
+        num_connections = self.num_connections()
+        return({
+        'requests': self.num_requests,
+        'retries': self.num_retries,
+        'errors': self.num_errors,
+        'connections': num_connections,
+        'reused': max(0, self.num_requests - self.num_errors - num_connections)
+        })
+
+def print_client_stats(client):
+    '''
+    Print the HTTP client counters
+    '''
+    stats = client.stats()
+    print('HTTP requests: {0}, retries: {1}, connection errors: {2}, new connections: {3}, reused connections: {4}'.format(
+    stats['requests'], stats['retries'], stats['errors'], stats['connections'], stats['reused']))
+
+def get_match_data(username, key, match_url, match_ID, days_to_subtract, page_limit, debug_mode, i_mode, harvest_mode, fail_mode, client = None, store = None, index = None, telemetry_workers = None, players = None):
+    '''
+    Get data from a game match
+    index is an optional MatchIndex to add the matches to in harvest mode
+    players is an optional PlayerRegistry to keep the players of a looked up match in
+    With telemetry_workers, the telemetry of the matches is also downloaded in harvest mode, that many files at once
+    '''
+    search_time = get_search_time(days_to_subtract)
+    print("Match ID is: {0}".format(match_ID))
+    print("search time is: {0}".format(search_time))
+    header = build_header(key)
+    query = build_query(username = username, search_time = search_time, page_limit = page_limit)
     if debug_mode == True:
         print_debug_query(header, query, match_url)
-    match = requests.get(match_url, headers=header, params=query)
+    if client == None:
+        client = APIClient()
+    # match searches are parsed as they are read, unless the whole payload is needed for interactive mode
+    stream_mode = (match_ID == None and i_mode == False)
+    match = client.get(match_url, headers=header, params=query, stream = stream_mode)
     # check for error code in API payload return
     match.raise_for_status()
+    if stream_mode == True:
+        # harvests of match searches go through harvest_matches, so a streamed search is only printed
+        for section, item in jsonstream.iter_payload_items(match):
+            if section == 'data':
+                print_match(item)
+        return
+    aggregates = None
+    if harvest_mode == True:
+        # meta tables, updated with each new match
+        aggregates = open_meta_aggregates(store)
+    source = store.path if store != None else "saved_matches"
     dat = json.loads(match.content)
     if i_mode == True:
         print_div()
@@ -190,24 +373,528 @@ def get_match_data(username, key, match_url, match_ID, days_to_subtract, page_li
         # dat['included'][10]['attributes']['name']
         # dat['included'][9]['type']
         my_debugger(locals().copy())
+    if index != None:
+        index.add_payload(dat, source = source)
+    if harvest_mode == True and store != None:
+        aggregates.add_payload(dat, skip = store)
+        num_stored = store.put_payload(dat)
+        print('Saved {0} new matches to store: {1}\n'.format(num_stored, store.path))
+        harvest_mode = False
     if match_ID == None:
         # my_debugger(locals().copy())
         for item in dat['data']:
             print_match(item)
-            save_match_data(item, harvest_mode = harvest_mode)
+            save_match_data(item, harvest_mode = harvest_mode, aggregates = aggregates)
         for item in dat['included']:
-            save_match_included(item, harvest_mode = harvest_mode)
+            save_match_included(item, harvest_mode = harvest_mode, aggregates = aggregates)
     elif match_ID != None:
         print_match(dat['data'])
-        save_match_data(dat['data'], harvest_mode = harvest_mode)
-        save_match_included(dat['included'], harvest_mode = harvest_mode)
-        user_data = refactor_included_assets(dat['included'])
+        save_match_data(dat['data'], harvest_mode = harvest_mode, aggregates = aggregates)
+        for item in dat['included']:
+            save_match_included(item, harvest_mode = harvest_mode, aggregates = aggregates)
+        user_data = refactor_included_assets(dat['included'], players = players, seen = dat['data']['attributes']['createdAt'])
+        if fail_mode == True: fail_finder(user_data)
+    if aggregates != None:
+        aggregates.save()
+        if telemetry_workers != None:
+            telemetry.print_telemetry_rate(telemetry.download_match_telemetry(telemetry.telemetry_assets(dat), source, client = client, workers = telemetry_workers))
+
+
+def lookup_match_index(index, username, match_ID, days_to_subtract, page_limit, region, fail_mode, players = None):
+    '''
+    Answer a match search or match lookup from the local match index, without the API
+    players is an optional PlayerRegistry to keep the players of a looked up match in
+    Returns False if the index has no matches for it
+    '''
+    start_time = time.time()
+    if match_ID != None:
+        payload = index.load_payload(match_ID)
+        if payload == None:
+            print('Match {0} is not in the match index: {1}'.format(match_ID, index.path))
+            return(False)
+        print('Found match in the match index in {0:.1f}ms'.format((time.time() - start_time) * 1000))
+        print_match(payload['data'])
+        user_data = refactor_included_assets(payload['included'], players = players, seen = payload['data']['attributes']['createdAt'])
         if fail_mode == True: fail_finder(user_data)
+        return(True)
+    search_time = get_search_time(days_to_subtract)
+    print("search time is: {0}".format(search_time))
+    matches = index.player_matches(username, search_time = search_time, limit = page_limit, region = region)
+    if len(matches) < 1:
+        print('No matches in the match index: {0}'.format(index.path))
+        return(False)
+    print('Found {0} matches in the match index in {1:.1f}ms'.format(len(matches), (time.time() - start_time) * 1000))
+    for match in matches:
+        print_match(match)
+    return(True)
+
+def open_meta_aggregates(store = None, output_dir = "saved_matches"):
+    '''
+    Open the meta tables of a harvest, kept in the match store if one is given, otherwise in the saved_matches directory
+    '''
+    return(aggregate.MetaAggregates(aggregate.meta_path(store.path if store != None else mkdirs(output_dir, return_path = True))))
+
+def save_harvest_payload(payload, aggregates, store = None, output_dir = "saved_matches", index = None, telemetry_assets = None):
+    '''
+    Save the matches of an API payload (a page of matches, or a single match) to the store if one is given,
+    otherwise to one JSON file per item, and add them to the meta tables
+    index is an optional MatchIndex to add the matches to (committed by the caller),
+    and telemetry_assets an optional list to add the (match ID, telemetry URL) pairs of the matches to
+    '''
+    if store != None:
+        aggregates.add_payload(payload, skip = store)
+        store.put_payload(payload)
+    else:
+        for item in iter_payload_matches(payload):
+            save_match_data(item, harvest_mode = True, output_dir = output_dir, quiet = True, aggregates = aggregates)
+        for item in payload.get('included', []):
+            save_match_included(item, harvest_mode = True, output_dir = output_dir, quiet = True, aggregates = aggregates)
+    if index != None:
+        index.add_payload(payload, source = store.path if store != None else output_dir, commit = False)
+    if telemetry_assets != None:
+        telemetry_assets.extend(telemetry.telemetry_assets(payload))
+
+def fetch_page(client, url, header, query = None):
+    '''
+    Get one page of results from the API
+    Returns the parsed payload and its size in bytes, or None if the API has no matches for the query (404)
+    '''
+    page = client.get(url, headers=header, params=query)
+    if page.status_code == 404:
+        return(None, len(page.content))
+    page.raise_for_status()
+    return(json.loads(page.content), len(page.content))
+
+def get_next_offset(next_url):
+    '''
+    Get the page[limit] and page[offset] values from a 'links.next' URL, or None if it does not use them
+    '''
+    params = parse_qs(urlparse(next_url).query)
+    if 'page[offset]' not in params or 'page[limit]' not in params:
+        return(None)
+    return(int(params['page[limit]'][0]), int(params['page[offset]'][0]))
+
+def set_page_offset(next_url, offset):
+    '''
+    Return the 'links.next' URL base and query for a different page offset
+    '''
+    url_parts = urlparse(next_url)
+    query = dict((key, values[0]) for key, values in parse_qs(url_parts.query).items())
+    query['page[offset]'] = offset
+    return(url_parts._replace(query = '').geturl(), query)
+
+def iter_match_pages(client, match_url, header, query, workers = 4, max_pages = None):
+    '''
+    Yield (payload, bytes) for each page of a match query, in order, following the API's 'links.next' pagination
+    Pages are fetched in a thread pool while the caller handles the current page;
+    when the next link uses page[offset], up to 'workers' of the following pages are requested at once
+    '''
+    payload, num_bytes = fetch_page(client, match_url, header, query)
+    if payload == None:
+        return
+    num_pages = 1
+    next_url = payload.get('links', {}).get('next')
+    offsets = None
+    if next_url != None:
+        offsets = get_next_offset(next_url)
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as pool:
+        pending = deque()
+        def queue_next(next_url):
+            # queue the following page; by offset if the API paginates that way, otherwise by following the link
+            if max_pages != None and num_pages + len(pending) >= max_pages:
+                return(False)
+            if offsets == None:
+                pending.append(pool.submit(fetch_page, client, next_url, header))
+            else:
+                page_limit, first_offset = offsets
+                page_url, page_query = set_page_offset(next_url, first_offset + page_limit * num_queued[0])
+                pending.append(pool.submit(fetch_page, client, page_url, header, page_query))
+            num_queued[0] += 1
+            return(True)
+        num_queued = [0]
+        try:
+            if next_url != None:
+                queue_next(next_url)
+                # with offsets the following pages can be requested before their links are known
+                while offsets != None and len(pending) < workers and queue_next(next_url):
+                    pass
+            yield(payload, num_bytes)
+            while pending:
+                payload, num_bytes = pending.popleft().result()
+                if payload == None or len(payload.get('data', [])) < 1:
+                    break
+                num_pages += 1
+                next_url = payload.get('links', {}).get('next')
+                if next_url != None:
+                    queue_next(next_url)
+                yield(payload, num_bytes)
+                if next_url == None:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+
+def print_harvest_rate(num_pages, num_matches, num_bytes, start_time, message = 'Harvested'):
+    '''
+    Print the harvest progress and throughput
+    '''
+    elapsed = max(time.time() - start_time, 1e-9)
+    print('{0} {1} pages, {2} matches, {3} bytes in {4:.2f}s ({5:.1f} matches/s, {6:.1f} bytes/s)'.format(
+    message, num_pages, num_matches, num_bytes, elapsed, num_matches / elapsed, num_bytes / elapsed))
+
+def harvest_matches(username, key, match_url, days_to_subtract, page_limit, debug_mode, workers = 4, max_pages = None, output_dir = "saved_matches", client = None, store = None, state = None, region = 'na', index = None, telemetry_workers = None):
+    '''
+    Harvest every match for a query, following the API pagination, and save each match to file,
+    or to a MatchStore if one is given
+    With a HarvestState, only matches newer than the last harvest of the same query are requested,
+    and matches that were already harvested are skipped before they are saved
+    With a MatchIndex, each page of matches is added to the index once it is saved
+    With telemetry_workers, the telemetry of each page of matches is downloaded next to the matches, that many files at once,
+    in the background while the next pages are fetched; the harvest waits for the downloads at the end
+    '''
+    search_time = get_search_time(days_to_subtract)
+    if state != None:
+        search_time = state.search_start(region, username, default = search_time)
+    print("search time is: {0}".format(search_time))
+    header = build_header(key)
+    query = build_query(username = username, search_time = search_time, page_limit = page_limit)
+    if debug_mode == True:
+        print_debug_query(header, query, match_url)
+    if client == None:
+        client = APIClient(pool_size = max(10, workers))
+    # meta tables, updated with each new match
+    aggregates = open_meta_aggregates(store, output_dir)
+    start_time = time.time()
+    num_pages = 0
+    num_matches = 0
+    num_bytes = 0
+    telemetry_pool = None
+    telemetry_futures = []
+    if telemetry_workers != None:
+        # the telemetry of each page is downloaded in the background, a page at a time, while the next pages are fetched
+        telemetry_pool = ThreadPoolExecutor(max_workers = 1)
+    try:
+        for payload, page_bytes in iter_match_pages(client, match_url, header, query, workers = workers, max_pages = max_pages):
+            num_pages += 1
+            num_bytes += page_bytes
+            if state != None:
+                payload = state.filter_payload(payload)
+            telemetry_assets = []
+            save_harvest_payload(payload, aggregates, store = store, output_dir = output_dir, index = index, telemetry_assets = telemetry_assets)
+            aggregates.save()
+            if index != None:
+                index.connection.commit()
+            if telemetry_pool != None:
+                telemetry_futures.append(telemetry_pool.submit(telemetry.download_match_telemetry, telemetry_assets, store.path if store != None else output_dir, client = client, workers = telemetry_workers, quiet = True))
+            if state != None:
+                state.mark_harvested(payload)
+            num_matches += len(payload['data'])
+            print_harvest_rate(num_pages, num_matches, num_bytes, start_time)
+    except:
+        aggregates.save()
+        if telemetry_pool != None:
+            for future in telemetry_futures:
+                future.cancel()
+            telemetry_pool.shutdown(wait = False)
+        if state != None:
+            # keep the matches saved so far, but not the watermark, so the next run fills in the gap
+            state.save()
+        raise
+    print_div()
+    print_harvest_rate(num_pages, num_matches, num_bytes, start_time, message = 'Harvest complete:')
+    telemetry_stats = None
+    if telemetry_pool != None:
+        for future in telemetry_futures:
+            page_stats = future.result()
+            telemetry_stats = page_stats if telemetry_stats == None else OrderedDict((key, telemetry_stats[key] + value) for key, value in page_stats.items())
+        telemetry_pool.shutdown()
+    if state != None:
+        state.save(region = region, username = username)
+        print('Skipped {0} matches that were already harvested; {1} match IDs seen in total'.format(state.num_skipped, len(state.seen)))
+    if store != None:
+        store.players.print_stats()
+    print('Meta tables: {0} matches, saved to {1}'.format(len(aggregates), aggregates.path))
+    if index != None:
+        print('Match index: {0} matches, saved to {1}'.format(len(index), index.path))
+    if telemetry_stats != None:
+        telemetry.print_telemetry_rate(telemetry_stats)
+    print_client_stats(client)
+    return(num_matches)
+
+def read_match_ids(match_IDs = None, match_file = None):
+    '''
+    Return the match IDs given on the command line and in a text file (one per line, # for comments), in order, without repeats
+    '''
+    if match_IDs == None:
+        match_IDs = []
+    elif not isinstance(match_IDs, list):
+        match_IDs = [match_IDs]
+    else:
+        match_IDs = list(match_IDs)
+    if match_file != None:
+        with open(match_file) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line != '':
+                    match_IDs.append(line)
+    return(list(OrderedDict.fromkeys(match_IDs)))
+
+def get_matches(match_IDs, key, region, url_base, debug_mode, harvest_mode, fail_mode, workers = 4, output_dir = "saved_matches", client = None, store = None, index = None, telemetry_workers = None, players = None):
+    '''
+    Look up many matches by ID, up to 'workers' at once over the client's shared connection pool
+    Each match is printed, and saved in harvest mode, as soon as it arrives, so the output is in order of arrival
+    index is an optional MatchIndex to add the matches to in harvest mode
+    The players of the matches are kept once each in players, a PlayerRegistry (a new one if none is given)
+    Returns the number of matches found
+    '''
+    header = build_header(key)
+    if debug_mode == True:
+        print_debug_query(header, {}, build_match_url(region, match_IDs[0], url_base = url_base))
+    if client == None:
+        client = APIClient(pool_size = max(10, workers))
+    if players == None:
+        players = PlayerRegistry()
+    aggregates = None
+    source = store.path if store != None else output_dir
+    if harvest_mode == True:
+        # meta tables, updated with each new match
+        aggregates = open_meta_aggregates(store, output_dir)
+    start_time = time.time()
+    num_found = 0
+    missing = []
+    failed = []
+    telemetry_assets = []
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as pool:
+        futures = dict((pool.submit(fetch_page, client, build_match_url(region, match_ID, url_base = url_base), header), match_ID) for match_ID in match_IDs)
+        try:
+            for future in as_completed(futures):
+                match_ID = futures.pop(future)
+                try:
+                    payload, num_bytes = future.result()
+                except (IOError, ValueError) as e:
+                    # one bad match should not stop the rest
+                    print('Could not get match {0}: {1}'.format(match_ID, e))
+                    failed.append(match_ID)
+                    continue
+                if payload == None:
+                    print('Match {0} was not found'.format(match_ID))
+                    missing.append(match_ID)
+                    continue
+                num_found += 1
+                print_match(payload['data'])
+                if harvest_mode == True:
+                    save_harvest_payload(payload, aggregates, store = store, output_dir = output_dir, index = index, telemetry_assets = telemetry_assets if telemetry_workers != None else None)
+                if fail_mode == True:
+                    fail_finder(refactor_included_assets(payload['included'], players = players, seen = payload['data']['attributes']['createdAt']))
+        finally:
+            for future in futures:
+                future.cancel()
+            if aggregates != None:
+                aggregates.save()
+            if index != None:
+                index.connection.commit()
+    elapsed = max(time.time() - start_time, 1e-9)
+    print_div()
+    print('Looked up {0} matches in {1:.2f}s ({2:.1f} matches/s): {3} found, {4} not found, {5} failed'.format(
+    len(match_IDs), elapsed, len(match_IDs) / elapsed, num_found, len(missing), len(failed)))
+    if len(failed) > 0:
+        print('Failed match IDs: {0}'.format(' '.join(failed)))
+    if harvest_mode == True:
+        print('Saved matches to: {0}'.format(source))
+        if telemetry_workers != None:
+            telemetry.print_telemetry_rate(telemetry.download_match_telemetry(telemetry_assets, source, client = client, workers = telemetry_workers))
+    return(num_found)
+
+def match_time(match):
+    '''
+    Return the seconds since the epoch for the createdAt time of a match item, e.g. '2017-04-27T01:39:45Z'
+    '''
+    return(calendar.timegm(time.strptime(match['attributes']['createdAt'][:19], '%Y-%m-%dT%H:%M:%S')))
+
+def iter_shard_matches(client, region, url_base, header, query, stats, workers = 4, max_pages = None):
+    '''
+    Yield a single-match payload for each match of a match search in one region, newest first, following the pagination
+    The pages, matches, bytes and time to the first page and to the end are kept in stats;
+    if the region fails, the error is kept in stats and the matches stop there
+    '''
+    start_time = time.time()
+    try:
+        for payload, num_bytes in iter_match_pages(client, build_match_url(region, None, url_base = url_base), header, query, workers = workers, max_pages = max_pages):
+            if stats['pages'] == 0:
+                stats['first_page'] = time.time() - start_time
+            stats['pages'] += 1
+            stats['bytes'] += num_bytes
+            for match_payload in split_payload(payload):
+                stats['matches'] += 1
+                yield(match_payload)
+    except (IOError, ValueError) as e:
+        stats['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    finally:
+        stats['seconds'] = time.time() - start_time
+
+def prefetch(items, pool, buffer_size = 64):
+    '''
+    Read an iterator in a thread of the pool, up to buffer_size items ahead of the caller
+    Returns a generator of the items; closing it stops the thread
+    '''
+    buffer = queue.Queue(buffer_size)
+    stop = threading.Event()
+    def put(entry):
+        # wait for room in the buffer, unless the reader has stopped
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout = 0.1)
+                return(True)
+            except queue.Full:
+                pass
+        return(False)
+    def read_ahead():
+        try:
+            for item in items:
+                if put((True, item)) == False:
+                    break
+            else:
+                put((False, None))
+        except Exception as e:
+            put((False, e))
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+    def read():
+        try:
+            while True:
+                has_item, item = buffer.get()
+                if has_item == False:
+                    if item != None:
+                        raise item
+                    return
+                yield(item)
+        finally:
+            stop.set()
+    pool.submit(read_ahead)
+    return(read())
+
+def merge_by_time(streams):
+    '''
+    Merge (region, matches) streams of single-match payloads, each newest first, into one stream of (region, match payload), newest first
+    Only the newest match of each stream is held at a time, in a heap
+    '''
+    heap = []
+    for order, (region, matches) in enumerate(streams):
+        for match_payload in matches:
+            heap.append((-match_time(match_payload['data']), order, region, match_payload, matches))
+            break
+    heapq.heapify(heap)
+    while len(heap) > 0:
+        _, order, region, match_payload, matches = heap[0]
+        yield(region, match_payload)
+        for match_payload in matches:
+            heapq.heapreplace(heap, (-match_time(match_payload['data']), order, region, match_payload, matches))
+            break
+        else:
+            heapq.heappop(heap)
+
+def iter_merged_pages(matches, page_size):
+    '''
+    Group merged (region, match payload) pairs into payloads of up to page_size matches, in the same form as a page of a match search
+    Items included with more than one match, such as players, are kept once per page, from the newest match
+    '''
+    page = {'data': [], 'included': []}
+    keys = set()
+    for region, match_payload in matches:
+        page['data'].append(match_payload['data'])
+        for item in match_payload['included']:
+            if (item['type'], item['id']) not in keys:
+                keys.add((item['type'], item['id']))
+                page['included'].append(item)
+        if len(page['data']) >= page_size:
+            yield(page)
+            page = {'data': [], 'included': []}
+            keys = set()
+    if len(page['data']) > 0:
+        yield(page)
 
+def print_shard_stats(shard_stats):
+    '''
+    Print the pages, matches, latency, and error of each region of a multi-region search
+    '''
+    for region, stats in shard_stats.items():
+        first_page = '{0:.2f}s'.format(stats['first_page']) if stats['first_page'] != None else 'n/a'
+        print('{0}: {1} pages, {2} matches, {3} bytes, first page in {4}, done in {5:.2f}s, {6}'.format(
+        region, stats['pages'], stats['matches'], stats['bytes'], first_page, stats['seconds'], 'ERROR ' + stats['error'] if stats['error'] != None else 'ok'))
+    num_failed = len([stats for stats in shard_stats.values() if stats['error'] != None])
+    if num_failed > 0:
+        print('{0} of {1} regions failed; their matches are missing from the results'.format(num_failed, len(shard_stats)))
 
-def save_match_included(included, harvest_mode, output_dir = "saved_matches"):
+def search_regions(username, key, regions, url_base, days_to_subtract, page_limit, debug_mode, harvest_mode, workers = 4, max_pages = None, output_dir = "saved_matches", client = None, store = None, index = None, telemetry_workers = None):
+    '''
+    Run a match search in several regions at once, and merge the results into one stream, newest first
+    Without harvest mode, only the first page of each region is requested and the newest page_limit matches are printed;
+    in harvest mode, every page of each region is followed (up to max_pages per region), and the merged matches are saved page_limit at a time, to a MatchStore if one is given
+    A region that fails is reported at the end and the other regions carry on
+    Returns the number of matches
+    '''
+    search_time = get_search_time(days_to_subtract)
+    print("search time is: {0}".format(search_time))
+    header = build_header(key)
+    query = build_query(username = username, search_time = search_time, page_limit = page_limit)
+    if debug_mode == True:
+        print_debug_query(header, query, build_match_url(regions[0], None, url_base = url_base))
+    if client == None:
+        client = APIClient(pool_size = max(10, workers * len(regions)))
+    if harvest_mode == False:
+        workers = 1
+        max_pages = 1
+    aggregates = None
+    source = store.path if store != None else output_dir
+    if harvest_mode == True:
+        # meta tables, updated with each new match
+        aggregates = open_meta_aggregates(store, output_dir)
+    shard_stats = OrderedDict((region, {'pages': 0, 'matches': 0, 'bytes': 0, 'first_page': None, 'seconds': 0, 'error': None}) for region in regions)
+    start_time = time.time()
+    num_matches = 0
+    telemetry_assets = []
+    with ThreadPoolExecutor(max_workers = len(regions)) as pool:
+        streams = [(region, prefetch(iter_shard_matches(client, region, url_base, header, query, shard_stats[region], workers = workers, max_pages = max_pages), pool)) for region in regions]
+        try:
+            if harvest_mode == False:
+                for region, match_payload in merge_by_time(streams):
+                    print_match(match_payload['data'], region = region)
+                    num_matches += 1
+                    if num_matches >= page_limit:
+                        break
+            else:
+                for payload in iter_merged_pages(merge_by_time(streams), page_limit):
+                    save_harvest_payload(payload, aggregates, store = store, output_dir = output_dir, index = index, telemetry_assets = telemetry_assets if telemetry_workers != None else None)
+                    aggregates.save()
+                    if index != None:
+                        index.connection.commit()
+                    num_matches += len(payload['data'])
+                    print_harvest_rate(sum(stats['pages'] for stats in shard_stats.values()), num_matches, sum(stats['bytes'] for stats in shard_stats.values()), start_time)
+        finally:
+            for region, matches in streams:
+                matches.close()
+            if aggregates != None:
+                aggregates.save()
+            if index != None:
+                index.connection.commit()
+    print_div()
+    if harvest_mode == True:
+        print_harvest_rate(sum(stats['pages'] for stats in shard_stats.values()), num_matches, sum(stats['bytes'] for stats in shard_stats.values()), start_time, message = 'Harvest complete:')
+        print('Meta tables: {0} matches, saved to {1}'.format(len(aggregates), aggregates.path))
+        if index != None:
+            print('Match index: {0} matches, saved to {1}'.format(len(index), index.path))
+    print_shard_stats(shard_stats)
+    if telemetry_workers != None and len(telemetry_assets) > 0:
+        telemetry.print_telemetry_rate(telemetry.download_match_telemetry(telemetry_assets, source, client = client, workers = telemetry_workers))
+    if harvest_mode == True:
+        print_client_stats(client)
+    return(num_matches)
+
+def save_match_included(included, harvest_mode, output_dir = "saved_matches", quiet = False, aggregates = None):
     '''
     Save the 'included' assets to a JSON
+    aggregates is an optional aggregate.MetaAggregates to add the item to
     '''
     import os
     if harvest_mode == True:
@@ -216,102 +903,81 @@ def save_match_included(included, harvest_mode, output_dir = "saved_matches"):
         included_type = included['type']
         output_filename = os.path.join(output_dir, '{0}_{1}.json'.format(included_id, included_type))
         json_dump(included, output_filename)
-        print('Saved included assets data to file:\n{0}\n'.format(output_filename))
+        if aggregates != None:
+            aggregates.add_item(included)
+        if quiet == False:
+            print('Saved included assets data to file:\n{0}\n'.format(output_filename))
 
 
-def save_match_data(match, harvest_mode, output_dir = "saved_matches"):
+def save_match_data(match, harvest_mode, output_dir = "saved_matches", quiet = False, aggregates = None):
     '''
     Saves a JSON file for the match data
+    aggregates is an optional aggregate.MetaAggregates to add the match to, if it was not saved before
     '''
     import os
     if harvest_mode == True:
         mkdirs(output_dir)
         match_id = match['id']
         output_filename = os.path.join(output_dir, match_id + '_data.json')
+        new = not os.path.exists(output_filename)
         json_dump(match, output_filename)
-        print('Saved match data to file:\n{0}\n'.format(output_filename))
-
-def print_player(player_obj):
-    '''
-    Print out formatted information about the player object
-    '''
-    player_region = player_obj['attributes']['shardId']
-    player_name = player_obj['attributes']['name']
-    player_wins = player_obj['attributes']['stats']['wins']
-    player_played_rank = player_obj['attributes']['stats']['played_ranked']
-    player_winstreak = player_obj['attributes']['stats']['winStreak']
-    player_lossstreak = player_obj['attributes']['stats']['lossStreak']
-    player_played = player_obj['attributes']['stats']['played']
-    player_level = player_obj['attributes']['stats']['level']
-    player_lifetimegold = player_obj['attributes']['stats']['lifetimeGold']
-    player_xp = player_obj['attributes']['stats']['xp']
-    player_id = player_obj['id']
+        if aggregates != None:
+            aggregates.add_item(match, new = new)
+        if quiet == False:
+            print('Saved match data to file:\n{0}\n'.format(output_filename))
+
+def print_player(player):
+    '''
+    Print out formatted information about a player record, or a player item
+    '''
+    if isinstance(player, dict):
+        player = records.Player.from_item(player)
     # print_div()
-    # print(player_obj)
-    print('player name: {0}'.format(player_name))
-    print('player id: {0}'.format(player_id))
-    print('player region: {0}'.format(player_region))
-    print('player level: {0}'.format(player_level))
-    print('player wins: {0}'.format(player_wins))
-    print('player win streak: {0}'.format(player_winstreak))
-    print('player loss streak: {0}'.format(player_lossstreak))
-    print('played: {0}'.format(player_played))
-    print('played rank: {0}'.format(player_played_rank))
-    print('match xp: {0}'.format(player_xp))
-    print('match lifetimegold: {0}'.format(player_lifetimegold))
-
-def print_participant(participant_obj):
-    '''
-    Print out formatted information about a participant
-    '''
-    participant_id = participant_obj['relationships']['player']['data']['id']
-    participant_gold = participant_obj['attributes']['stats']['gold']
-    participant_deaths = participant_obj['attributes']['stats']['deaths']
-    participant_nonJungleMinionKills = participant_obj['attributes']['stats']['nonJungleMinionKills']
-    participant_skillTier = participant_obj['attributes']['stats']['skillTier']
-    participant_turretCaptures = participant_obj['attributes']['stats']['turretCaptures']
-    participant_winner = participant_obj['attributes']['stats']['winner']
-    participant_karmaLevel = participant_obj['attributes']['stats']['karmaLevel']
-    participant_jungleKills = participant_obj['attributes']['stats']['jungleKills']
-    participant_kills = participant_obj['attributes']['stats']['kills']
-    participant_farm = participant_obj['attributes']['stats']['farm']
-    participant_firstAfkTime = participant_obj['attributes']['stats']['firstAfkTime']
-    participant_assists = participant_obj['attributes']['stats']['assists']
-    participant_minionKills = participant_obj['attributes']['stats']['minionKills']
-    participant_level = participant_obj['attributes']['stats']['level']
-    participant_items_list = participant_obj['attributes']['stats']['items']
-    participant_skin = participant_obj['attributes']['stats']['skinKey']
-    participant_krakenCaptures = participant_obj['attributes']['stats']['krakenCaptures']
-    participant_goldMineCaptures = participant_obj['attributes']['stats']['goldMineCaptures']
-    participant_crystalMineCaptures = participant_obj['attributes']['stats']['crystalMineCaptures']
-    participant_wentAfk = participant_obj['attributes']['stats']['wentAfk']
-    participant_hero = participant_obj['attributes']['actor']
+    # print(player.to_dict())
+    print('player name: {0}'.format(player.name))
+    print('player id: {0}'.format(player.id))
+    print('player region: {0}'.format(player.shardId))
+    print('player level: {0}'.format(player.level))
+    print('player wins: {0}'.format(player.wins))
+    print('player win streak: {0}'.format(player.winStreak))
+    print('player loss streak: {0}'.format(player.lossStreak))
+    print('played: {0}'.format(player.played))
+    print('played rank: {0}'.format(player.played_ranked))
+    print('match xp: {0}'.format(player.xp))
+    print('match lifetimegold: {0}'.format(player.lifetimeGold))
+
+def print_participant(participant):
+    '''
+    Print out formatted information about a participant record, or a participant item
+    '''
+    if isinstance(participant, dict):
+        participant = records.Participant.from_item(participant)
     # print_div()
-    # print('participant id: {0}'.format(participant_id)) # same as player ID
-    print('player skillTier: {0}'.format(participant_skillTier))
-    print('player karmaLevel: {0}'.format(participant_karmaLevel))
-    print('match hero: {0}'.format(participant_hero))
-    print('match skin: {0}'.format(participant_skin))
-    print('match level: {0}'.format(participant_level))
-    print('match kills/deaths/assists: {0}/{1}/{2}'.format(participant_kills, participant_deaths, participant_assists))
-    print('match final gold: {0}'.format(participant_gold))
-    print('match nonJungleMinionKills: {0}'.format(participant_nonJungleMinionKills))
-    print('match turretCaptures: {0}'.format(participant_turretCaptures))
-    print('match jungleKills: {0}'.format(participant_jungleKills))
-    print('match farm: {0}'.format(participant_farm))
-    print('match wentAfk: {0}'.format(participant_wentAfk))
-    print('match firstAfkTime: {0}'.format(participant_firstAfkTime))
-    print('match minionKills: {0}'.format(participant_minionKills))
-    print('match krakenCaptures: {0}'.format(participant_krakenCaptures))
-    print('match goldMineCaptures: {0}'.format(participant_goldMineCaptures))
-    print('match crystalMineCaptures: {0}'.format(participant_crystalMineCaptures))
-    print('match winner: {0}'.format(participant_winner))
-
-    # print(participant_obj.keys())
-    # print(participant_obj['attributes'])
-
-def parse_players_participants(players_list, participants_list):
+    # print('participant id: {0}'.format(participant.id))
+    print('player skillTier: {0}'.format(participant.skillTier))
+    print('player karmaLevel: {0}'.format(participant.karmaLevel))
+    print('match hero: {0}'.format(participant.actor))
+    print('match skin: {0}'.format(participant.skinKey))
+    print('match level: {0}'.format(participant.level))
+    print('match kills/deaths/assists: {0}/{1}/{2}'.format(participant.kills, participant.deaths, participant.assists))
+    print('match final gold: {0}'.format(participant.gold))
+    print('match nonJungleMinionKills: {0}'.format(participant.nonJungleMinionKills))
+    print('match turretCaptures: {0}'.format(participant.turretCaptures))
+    print('match jungleKills: {0}'.format(participant.jungleKills))
+    print('match farm: {0}'.format(participant.farm))
+    print('match wentAfk: {0}'.format(participant.wentAfk))
+    print('match firstAfkTime: {0}'.format(participant.firstAfkTime))
+    print('match minionKills: {0}'.format(participant.minionKills))
+    print('match krakenCaptures: {0}'.format(participant.krakenCaptures))
+    print('match goldMineCaptures: {0}'.format(participant.goldMineCaptures))
+    print('match crystalMineCaptures: {0}'.format(participant.crystalMineCaptures))
+    print('match winner: {0}'.format(participant.winner))
+
+def parse_players_participants(players_list, participants_list, players = None, seen = ''):
     '''
+    Pair up each player with their participant entry, by player ID, as Player and Participant records
+    If a PlayerRegistry is given, the players are added to it and share its copy of each player,
+    with the stats they had at the time seen (the match's createdAt)
     '''
     from collections import defaultdict
     users = defaultdict(dict)
@@ -319,11 +985,15 @@ def parse_players_participants(players_list, participants_list):
     for player in players_list:
         # print_player(player)
         player_id = player['id']
-        users[player_id]['player'] = player
+        if players != None:
+            handle = players.add(player, seen = seen)
+            users[player_id]['handle'] = handle
+            player = players.item(handle, seen = seen)
+        users[player_id]['player'] = records.Player.from_item(player)
     for participant in participants_list:
         # print_participant(participant)
         participant_id = participant['relationships']['player']['data']['id']
-        users[participant_id]['participant'] = participant
+        users[participant_id]['participant'] = records.Participant.from_item(participant)
     for user_id in users.keys():
         print_div()
         print_div(message = "Player info")
@@ -333,28 +1003,28 @@ def parse_players_participants(players_list, participants_list):
     return(users)
 
 
-def refactor_included_assets(match_included):
+def refactor_included_assets(match_included, players = None, seen = ''):
     '''
     Build a new dict from the API 'included' object, one entry per item ID
+    players is an optional PlayerRegistry to keep the players in, seen the createdAt of the match
     '''
-    players = []
+    player_items = []
     participants = []
     for item in match_included:
         item_type = item['type']
         item_id = item['id']
         if item_type == "player":
-            players.append(item)
+            player_items.append(item)
         if item_type == "participant":
             participants.append(item)
-    user_data = parse_players_participants(players_list = players, participants_list = participants)
+    user_data = parse_players_participants(players_list = player_items, participants_list = participants, players = players, seen = seen)
     return(user_data)
 
 
-def build_match_url(region, match_ID):
+def build_match_url(region, match_ID, url_base = "https://api.dc01.gamelockerapp.com/shards"):
     '''
     Build the URL to submit to the API match query
     '''
-    url_base = "https://api.dc01.gamelockerapp.com/shards"
     region_url = '/'.join([url_base, region])
     match_url = '/'.join([region_url, "matches"])
     if match_ID != None:
@@ -364,7 +1034,7 @@ def build_match_url(region, match_ID):
 
 def fail_finder(user_data):
     '''
-    Ranks players in a match based on included assets user data
+    Ranks players in a match based on included assets user data, with the Player and Participant records from refactor_included_assets
     '''
     from collections import defaultdict
     from collections import OrderedDict
@@ -372,41 +1042,42 @@ def fail_finder(user_data):
     print_div()
     print_div(message = "Player Match Ranking")
     for key, value in user_data.items():
-        # value['participant']['attributes']['stats']['itemUses']
-        # value['participant']['attributes']['stats']['itemGrants']
-        rankings[key]['hero'] = value['participant']['attributes']['actor']
-        rankings[key]['name'] = value['player']['attributes']['name']
-        rankings[key]['user-stats'] += value['player']['attributes']['stats']['level']
-        rankings[key]['user-stats'] += value['player']['attributes']['stats']['wins'] / 100
-        rankings[key]['user-stats'] += value['player']['attributes']['stats']['played_ranked'] / 75
-        rankings[key]['user-stats'] += value['player']['attributes']['stats']['played'] / 100
-        rankings[key]['user-stats'] += value['player']['attributes']['stats']['winStreak'] * 10
-        rankings[key]['user-stats'] -= value['player']['attributes']['stats']['lossStreak'] * 10
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['karmaLevel'] * 10
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['skillTier'] * 10
-        rankings[key]['match-stats'] += value['player']['attributes']['stats']['lifetimeGold'] / 1000
-        rankings[key]['match-stats'] += value['player']['attributes']['stats']['xp'] / 100000
-        # rankings[key]['match-stats'] -= value['participant']['attributes']['stats']['gold']
-        rankings[key]['match-stats'] -= value['participant']['attributes']['stats']['gold'] / 10
-        rankings[key]['match-stats'] -= value['participant']['attributes']['stats']['deaths']
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['kills']
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['turretCaptures'] * 3
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['jungleKills']
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['farm']
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['assists'] * 0.5
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['minionKills'] / 10
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['krakenCaptures'] * 5
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['goldMineCaptures'] * 3
-        rankings[key]['match-stats'] += value['participant']['attributes']['stats']['crystalMineCaptures'] * 2
-        if value['participant']['attributes']['stats']['winner'] == True:
+        # value['participant'].items
+        participant = value['participant']
+        player = value['player']
+        rankings[key]['hero'] = participant.actor
+        rankings[key]['name'] = player.name
+        rankings[key]['user-stats'] += player.level
+        rankings[key]['user-stats'] += player.wins / 100
+        rankings[key]['user-stats'] += player.played_ranked / 75
+        rankings[key]['user-stats'] += player.played / 100
+        rankings[key]['user-stats'] += player.winStreak * 10
+        rankings[key]['user-stats'] -= player.lossStreak * 10
+        rankings[key]['match-stats'] += participant.karmaLevel * 10
+        rankings[key]['match-stats'] += participant.skillTier * 10
+        rankings[key]['match-stats'] += player.lifetimeGold / 1000
+        rankings[key]['match-stats'] += player.xp / 100000
+        # rankings[key]['match-stats'] -= participant.gold
+        rankings[key]['match-stats'] -= participant.gold / 10
+        rankings[key]['match-stats'] -= participant.deaths
+        rankings[key]['match-stats'] += participant.kills
+        rankings[key]['match-stats'] += participant.turretCaptures * 3
+        rankings[key]['match-stats'] += participant.jungleKills
+        rankings[key]['match-stats'] += participant.farm
+        rankings[key]['match-stats'] += participant.assists * 0.5
+        rankings[key]['match-stats'] += participant.minionKills / 10
+        rankings[key]['match-stats'] += participant.krakenCaptures * 5
+        rankings[key]['match-stats'] += participant.goldMineCaptures * 3
+        rankings[key]['match-stats'] += participant.crystalMineCaptures * 2
+        if participant.winner == True:
             rankings[key]['match-stats'] += 10
-        if value['participant']['attributes']['stats']['firstAfkTime'] > 0:
+        if participant.firstAfkTime > 0:
             rankings[key]['match-stats'] -= 50
-        if value['participant']['attributes']['stats']['wentAfk'] != False:
+        if participant.wentAfk != False:
             rankings[key]['match-stats'] -= 50
-        if value['participant']['attributes']['stats']['winner'] == True:
+        if participant.winner == True:
             rankings[key]['team'] = 'won'
-        if value['participant']['attributes']['stats']['winner'] == False:
+        if participant.winner == False:
             rankings[key]['team'] = 'lost'
         rankings[key]['total'] = rankings[key]['match-stats'] + rankings[key]['user-stats']
     # my_debugger(locals().copy())
@@ -415,17 +1086,74 @@ def fail_finder(user_data):
     print(row_format.format('----------','----------', '----------', '----------', '------------------------------'))
     for key, data in OrderedDict(sorted(rankings.items(), key=lambda x: x[1]['total'], reverse=True)).items():
         print(row_format.format(data['name'], data['hero'], data['team'], str(data['total']), key))
+    return(rankings)
 
-def main(username = None, api_key_file = 'key.txt', region = 'na', match_ID = None,  days = 1, debug_mode = False, page_limit = 3, i_mode = False, harvest_mode = False, fail_mode = False):
+def main(username = None, api_key_file = 'key.txt', region = 'na', match_ID = None,  days = 1, debug_mode = False, page_limit = 3, i_mode = False, harvest_mode = False, fail_mode = False, workers = 4, max_pages = None, api_url = "https://api.dc01.gamelockerapp.com/shards", timeout = 30, retries = 5, store_dir = None, incremental = False, state_dir = 'harvest_state', aggregate_paths = None, processes = None, offline = False, index_file = 'match_index.db', cache_file = 'http_cache.db', cache_ttl = 60, cache_size = 256, telemetry_workers = None, match_file = None):
     '''
     Main control function for the script
     '''
+    if aggregate_paths != None:
+        aggregate.run_aggregation(aggregate_paths, processes = processes)
+        return
     print('Player name: {0}'.format(username))
-    print('Region: {0}'.format(get_region_name(region = region)))
+    regions = get_regions(region)
+    print('Region: {0}'.format(', '.join(get_region_name(region = name) for name in regions)))
+    match_IDs = read_match_ids(match_ID, match_file)
+    match_ID = match_IDs[0] if len(match_IDs) == 1 else None
+    if len(regions) > 1:
+        if len(match_IDs) > 0 or i_mode == True or incremental == True:
+            print("ERROR: Match lookups, interactive mode, and incremental harvests need a single region")
+            print("Exiting...")
+            sys.exit()
+        # offline searches look in every one of the regions
+        region = regions
+    else:
+        region = regions[0]
+    index = None
+    if offline == True or harvest_mode == True:
+        index = MatchIndex(index_file)
+    # the players of looked up matches, kept once each across all of the matches
+    players = PlayerRegistry()
+    if offline == True and i_mode == False and harvest_mode == False:
+        if len(match_IDs) > 1:
+            # only the matches missing from the index are looked up with the API
+            match_IDs = [match_ID for match_ID in match_IDs if lookup_match_index(index, username = username, match_ID = match_ID, days_to_subtract = days, page_limit = page_limit, region = region, fail_mode = fail_mode, players = players) == False]
+            if len(match_IDs) < 1:
+                return
+            match_ID = match_IDs[0] if len(match_IDs) == 1 else None
+        elif lookup_match_index(index, username = username, match_ID = match_ID, days_to_subtract = days, page_limit = page_limit, region = region, fail_mode = fail_mode, players = players) == True:
+            return
+        print('Asking the API instead')
     key = get_api_key(api_key_file)
     print("Retrieving player data...")
-    match_url = build_match_url(region, match_ID)
-    get_match_data(username = username, key = key, match_url = match_url, match_ID = match_ID, days_to_subtract = days, page_limit = page_limit, debug_mode = debug_mode, i_mode = i_mode, harvest_mode = harvest_mode, fail_mode = fail_mode)
+    match_url = build_match_url(regions[0], match_ID, url_base = api_url)
+    cache = None
+    if cache_file != None and harvest_mode == False:
+        # match lookups and searches are cached; harvests always get fresh pages
+        cache = ResponseCache(cache_file, max_bytes = int(cache_size * 1024 * 1024), ttl = cache_ttl)
+    client = APIClient(timeout = (min(5, timeout), timeout), max_retries = retries, pool_size = max(10, workers * len(regions)), cache = cache)
+    store = None
+    if store_dir != None:
+        store = MatchStore(store_dir)
+    if len(regions) > 1:
+        search_regions(username = username, key = key, regions = regions, url_base = api_url, days_to_subtract = days, page_limit = page_limit, debug_mode = debug_mode, harvest_mode = harvest_mode, workers = workers, max_pages = max_pages, client = client, store = store, index = index if harvest_mode == True else None, telemetry_workers = telemetry_workers)
+    elif len(match_IDs) > 1:
+        get_matches(match_IDs, key = key, region = region, url_base = api_url, debug_mode = debug_mode, harvest_mode = harvest_mode, fail_mode = fail_mode, workers = workers, client = client, store = store, index = index if harvest_mode == True else None, telemetry_workers = telemetry_workers, players = players)
+    elif harvest_mode == True and match_ID == None and i_mode == False:
+        state = None
+        if incremental == True:
+            state = HarvestState(state_dir)
+        harvest_matches(username = username, key = key, match_url = match_url, days_to_subtract = days, page_limit = page_limit, debug_mode = debug_mode, workers = workers, max_pages = max_pages, client = client, store = store, state = state, region = region, index = index, telemetry_workers = telemetry_workers)
+        return
+    else:
+        get_match_data(username = username, key = key, match_url = match_url, match_ID = match_ID, days_to_subtract = days, page_limit = page_limit, debug_mode = debug_mode, i_mode = i_mode, harvest_mode = harvest_mode, fail_mode = fail_mode, client = client, store = store, index = index if harvest_mode == True else None, telemetry_workers = telemetry_workers, players = players)
+    if debug_mode == True:
+        print_div()
+        print_client_stats(client)
+        if len(players) > 0:
+            players.print_stats()
+        if cache != None:
+            cache.print_stats()
 
 def run():
     '''
@@ -437,12 +1165,30 @@ def run():
     parser.add_argument("-n", default = None, type = str,  dest = 'username', metavar = 'name', help="Player's in-game username")
     parser.add_argument("-d", default = 1, type = int,  dest = 'days', metavar = 'days', help="Number of past days in which to search for matches")
     parser.add_argument("-p", default = 3, type = int,  dest = 'page_limit', metavar = 'page limit', help="'Page Limit'; number of matches to return")
-    parser.add_argument("-m", default = None, type = str, dest = 'match_ID', metavar = 'match', help="Match ID to look up")
+    parser.add_argument("-m", default = None, nargs = '+', type = str, dest = 'match_ID', metavar = 'match', help="Match ID to look up; give several to look them up at once")
+    parser.add_argument("--match-file", default = None, type = str, dest = 'match_file', metavar = 'match_file', help="Text file of match IDs to look up, one per line")
     parser.add_argument("-k", default = 'key.txt', type = str, dest = 'api_key_file', metavar = 'api_key_file', help="Path to text file containing the player's API key. (get one here: https://developer.vainglorygame.com/)")
-    parser.add_argument("-r", default = 'na', type = str, dest = 'region', metavar = 'region', help="Player's region. Possibilties: na, eu, sa, ea, or sg. Details here: https://developer.vainglorygame.com/docs?python#regions")
+    parser.add_argument("-r", default = 'na', type = str, dest = 'region', metavar = 'region', help="Player's region. Possibilties: na, eu, sa, ea, or sg, a comma separated list of them, or 'all' to search every region at once. Details here: https://developer.vainglorygame.com/docs?python#regions")
     parser.add_argument("--debug", default = False, action='store_true', dest = 'debug_mode', help="Print the query command to console, so you can copy/paste the code elsewhere")
     parser.add_argument("-i", "--interactive", default = False, action='store_true', dest = 'i_mode', help="Start an interactive Python session after querying match data")
-    parser.add_argument("--harvest", default = False, action='store_true', dest = 'harvest_mode', help="'Harvest' mode, saves each match to a JSON file")
+    parser.add_argument("--harvest", default = False, action='store_true', dest = 'harvest_mode', help="'Harvest' mode, saves each match to a JSON file. Without a match ID, follows the API pagination to get every match in the search window")
+    parser.add_argument("-w", "--workers", default = 4, type = int, dest = 'workers', metavar = 'workers', help="Number of pages to fetch at once in harvest mode, or matches to look up at once with several match IDs")
+    parser.add_argument("--max-pages", default = None, type = int, dest = 'max_pages', metavar = 'max pages', help="Maximum number of pages to fetch in harvest mode")
+    parser.add_argument("--api-url", default = "https://api.dc01.gamelockerapp.com/shards", type = str, dest = 'api_url', metavar = 'api_url', help="Base URL for the API shards, e.g. a local test server")
+    parser.add_argument("--store", default = None, type = str, dest = 'store_dir', metavar = 'store_dir', help="In harvest mode, save matches to a compressed match store in this directory instead of one JSON file per item")
+    parser.add_argument("--incremental", default = False, action='store_true', dest = 'incremental', help="In harvest mode, only get matches newer than the last harvest of the same player and region, and skip matches that were already harvested")
+    parser.add_argument("--state-dir", default = 'harvest_state', type = str, dest = 'state_dir', metavar = 'state_dir', help="Directory for the incremental harvest checkpoints")
+    parser.add_argument("--timeout", default = 30, type = float, dest = 'timeout', metavar = 'timeout', help="Seconds to wait for an API response before retrying")
+    parser.add_argument("--retries", default = 5, type = int, dest = 'retries', metavar = 'retries', help="Number of times to retry a failed, rate limited, or timed out API request")
+    parser.add_argument("--aggregate", default = None, nargs = '+', type = str, dest = 'aggregate_paths', metavar = 'path', help="'Aggregate' mode, prints hero win rates and average stats by game mode and patch for every match in harvest directories, match stores, or payload files (no API key needed)")
+    parser.add_argument("-j", "--processes", default = None, type = int, dest = 'processes', metavar = 'processes', help="Number of worker processes in aggregate mode; defaults to the number of CPUs")
+    parser.add_argument("--offline", default = False, action='store_true', dest = 'offline', help="Answer match searches and match lookups from the local match index of harvested matches, and only ask the API if it has no matches")
+    parser.add_argument("--index-file", default = 'match_index.db', type = str, dest = 'index_file', metavar = 'index_file', help="SQLite match index, kept up to date in harvest mode and used in offline mode")
+    parser.add_argument("--cache-file", default = 'http_cache.db', type = str, dest = 'cache_file', metavar = 'cache_file', help="On-disk cache of API responses for match lookups and searches (not used in harvest mode)")
+    parser.add_argument("--cache-ttl", default = 60, type = float, dest = 'cache_ttl', metavar = 'seconds', help="How long cached match searches are used before the API is asked again; matches looked up by ID never expire")
+    parser.add_argument("--cache-size", default = 256, type = float, dest = 'cache_size', metavar = 'MB', help="Size limit of the response cache; the least recently used responses are evicted past it")
+    parser.add_argument("--no-cache", default = False, action='store_true', dest = 'no_cache', help="Do not use the response cache")
+    parser.add_argument("--telemetry", default = None, nargs = '?', const = 8, type = int, dest = 'telemetry_workers', metavar = 'workers', help="In harvest mode, also download and parse the telemetry of each match, this many files at once (default 8)")
     parser.add_argument("--fail", default = False, action='store_true', dest = 'fail_mode', help="'Fail Finder' mode, ranks players in a match (match ID required)")
 
     args = parser.parse_args()
@@ -457,8 +1203,25 @@ def run():
     i_mode = args.i_mode
     harvest_mode = args.harvest_mode
     fail_mode = args.fail_mode
+    workers = args.workers
+    max_pages = args.max_pages
+    api_url = args.api_url
+    timeout = args.timeout
+    retries = args.retries
+    store_dir = args.store_dir
+    incremental = args.incremental
+    state_dir = args.state_dir
+    aggregate_paths = args.aggregate_paths
+    processes = args.processes
+    offline = args.offline
+    index_file = args.index_file
+    cache_file = args.cache_file if args.no_cache == False else None
+    cache_ttl = args.cache_ttl
+    cache_size = args.cache_size
+    telemetry_workers = args.telemetry_workers
+    match_file = args.match_file
 
-    main(username = username, api_key_file = api_key_file, region = region, match_ID = match_ID,  days = days, debug_mode = debug_mode, page_limit = page_limit, i_mode = i_mode, harvest_mode = harvest_mode, fail_mode = fail_mode)
+    main(username = username, api_key_file = api_key_file, region = region, match_ID = match_ID,  days = days, debug_mode = debug_mode, page_limit = page_limit, i_mode = i_mode, harvest_mode = harvest_mode, fail_mode = fail_mode, workers = workers, max_pages = max_pages, api_url = api_url, timeout = timeout, retries = retries, store_dir = store_dir, incremental = incremental, state_dir = state_dir, aggregate_paths = aggregate_paths, processes = processes, offline = offline, index_file = index_file, cache_file = cache_file, cache_ttl = cache_ttl, cache_size = cache_size, telemetry_workers = telemetry_workers, match_file = match_file)
 
 if __name__ == "__main__":
     run()